@@ -0,0 +1,209 @@
+"""
+title: FTP Transfer Benchmark
+description: Moves a batch of small files through a pipeline's FTP tools against a local
+pyftpdlib server and reports the time taken one file at a time and as a batch.
+
+The stand-in server runs in-process on a temporary directory, with an optional login delay and
+an optional delay before every command's reply, to stand in for the round trips of a real server.
+On loopback with no delay, moving a file costs almost nothing but CPU, and one at a time is as
+fast as a batch. It needs pyftpdlib:
+
+    pip install pyftpdlib
+    python benchmarks/ftp_transfer.py external_tools_filter.py --files 500 --login-delay-ms 50 --rtt-ms 10
+
+It also checks that an interrupted download is resumed with REST rather than restarted, and
+that it restarts once the source has changed since the .part file was started.
+Run it from the pipelines server directory so that `schemas`, `utils` and `blueprints` import.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.log import config_logging
+from pyftpdlib.servers import ThreadedFTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load_test import load_pipeline
+
+from blueprints.network_tools import FTP_JOURNAL_DIR, ftp_journal_path, ftp_remote_version, ftp_resume_offset
+
+
+class StubFTPServer:
+    """
+    In-process FTP server serving a directory, with an injectable login delay and round trip time.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        username: str = "user",
+        password: str = "password",
+        login_delay_ms: float = 0,
+        rtt_ms: float = 0,
+    ):
+        """
+        Initialize the stand-in server.
+        :param root: The directory served to the user.
+        :param username: The username to accept.
+        :param password: The password to accept.
+        :param login_delay_ms: The delay added to every login.
+        :param rtt_ms: The delay added before the reply to every command.
+        """
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(username, password, root, perm="elradfmwMT")
+        delay = login_delay_ms / 1000
+        rtt = rtt_ms / 1000
+        self.logins = 0
+        server = self
+
+        class Handler(FTPHandler):
+            def on_login(self, username):
+                server.logins += 1
+                time.sleep(delay)
+
+            def process_command(self, cmd, *args, **kwargs):
+                # Each connection has its own thread, so this only holds up its own client
+                time.sleep(rtt)
+                return super().process_command(cmd, *args, **kwargs)
+
+        Handler.authorizer = authorizer
+        config_logging(level=logging.WARNING)
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), Handler)
+        self.host, self.port = self.server.address
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"handle_exit": False}, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.close_all()
+
+
+def make_files(directory: str, count: int, size: int) -> list:
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"file_{i:05d}.bin")
+        with open(path, "wb") as file:
+            file.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def check_resume(module, tools, server: StubFTPServer, remote_root: str, local_root: str) -> dict:
+    """
+    Leave half a download behind as a .part file, as an interrupted download would, and check
+    only the rest is fetched; then change the source under a .part file and check it restarts.
+    """
+    data = os.urandom(1024 * 1024)
+    remote_path = os.path.join(remote_root, "resume.bin")
+    with open(remote_path, "wb") as file:
+        file.write(data)
+    local_file = os.path.join(local_root, "resume.bin")
+
+    with tools.ftp_pool.connection(server.host, "user", "password", server.port) as ftp:
+        journal = ftp_journal_path(FTP_JOURNAL_DIR, "download", ftp.host, "resume.bin", local_file)
+        # An interrupted download has recorded the version it started from
+        ftp_resume_offset(journal, ftp_remote_version(ftp, "resume.bin"), 0)
+        with open(f"{local_file}.part", "wb") as file:
+            file.write(data[: len(data) // 2])
+        fetched = module.ftp_download(ftp, "resume.bin", local_file)
+        with open(local_file, "rb") as file:
+            intact = file.read() == data
+
+        ftp_resume_offset(journal, ftp_remote_version(ftp, "resume.bin"), 0)
+        with open(f"{local_file}.part", "wb") as file:
+            file.write(data[: len(data) // 2])
+        # The same size, but new content and a new mtime
+        changed = os.urandom(len(data))
+        with open(remote_path, "wb") as file:
+            file.write(changed)
+        os.utime(remote_path, (time.time() - 3600, time.time() - 3600))
+        fetched_changed = module.ftp_download(ftp, "resume.bin", local_file)
+        with open(local_file, "rb") as file:
+            intact_changed = file.read() == changed
+
+    return {
+        "bytes_fetched": fetched,
+        "file_size": len(data),
+        "intact": intact,
+        "bytes_fetched_after_change": fetched_changed,
+        "intact_after_change": intact_changed,
+    }
+
+
+def main(args):
+    pipeline = load_pipeline(args.pipeline)
+    tools = pipeline.tools
+    module = sys.modules[type(pipeline).__module__]
+
+    with tempfile.TemporaryDirectory() as remote_root, tempfile.TemporaryDirectory() as local_root:
+        server = StubFTPServer(remote_root, login_delay_ms=args.login_delay_ms, rtt_ms=args.rtt_ms)
+        server.start()
+        # The tools take a host only, so route the default port to the stand-in
+        tools.ftp_pool.default_port = server.port
+        try:
+            files = make_files(local_root, args.files, args.size)
+            start = time.monotonic()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for path in files:
+                    tools.upload_file_via_ftp(server.host, "user", "password", path, os.path.basename(path))
+            one_by_one = time.monotonic() - start
+            logins_one_by_one = server.logins
+
+            start = time.monotonic()
+            with contextlib.redirect_stdout(io.StringIO()):
+                tools.upload_files_via_ftp(server.host, "user", "password", files, "/")
+            batch = time.monotonic() - start
+
+            download_dir = os.path.join(local_root, "downloaded")
+            start = time.monotonic()
+            with contextlib.redirect_stdout(io.StringIO()):
+                tools.download_files_via_ftp(
+                    server.host, "user", "password", [os.path.basename(path) for path in files], download_dir
+                )
+            batch_download = time.monotonic() - start
+            intact = all(
+                open(path, "rb").read() == open(os.path.join(download_dir, os.path.basename(path)), "rb").read()
+                for path in files
+            )
+
+            resume = check_resume(module, tools, server, remote_root, local_root)
+
+            asyncio.run(pipeline.on_shutdown())
+        finally:
+            server.stop()
+
+    report = {
+        "files": args.files,
+        "file_size": args.size,
+        "rtt_ms": args.rtt_ms,
+        "upload_one_by_one_s": round(one_by_one, 3),
+        "upload_batch_s": round(batch, 3),
+        "download_batch_s": round(batch_download, 3),
+        "logins": server.logins,
+        "logins_during_one_by_one": logins_one_by_one,
+        "downloads_intact": intact,
+        "resume": resume,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("pipeline", help="Path to the pipeline file with the FTP tools.")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=4096, help="Size of each file in bytes.")
+    parser.add_argument("--login-delay-ms", type=float, default=20)
+    parser.add_argument("--rtt-ms", type=float, default=0, help="Delay before every command's reply.")
+    main(parser.parse_args())
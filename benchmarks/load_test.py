@@ -0,0 +1,398 @@
+"""
+title: Pipeline Load Test
+description: Drives a pipeline's inlet/pipe/outlet chain against local stub model servers
+and reports throughput, latency percentiles and time to first token.
+
+The stub server speaks the shapes the pipelines in this repo call:
+  - POST .../chat/completions (OpenAI, Groq and Ollama's /v1), streaming and non-streaming
+  - GET  /api/tags (Ollama)
+  - GET  .../models (OpenAI, Groq)
+  - GET  .../weather (OpenWeatherMap, for file_function_filter.py's weather tools)
+
+Every valve ending in BASE_URL is pointed at the stub server. Each request sends --message with
+{i} replaced by the request number, so that caches and in-flight sharing of identical requests
+don't answer all but the first; the decision cache is also off unless --decision-cache is given. Pipelines with a hardcoded URL,
+such as ollama_pipeline.py, can be served by binding the stub to that port:
+
+    python benchmarks/load_test.py ollama_pipeline.py --port 11434 --requests 500 --concurrency 32
+    python benchmarks/load_test.py file_function_filter.py --content '' --latency-ms 300
+
+Run it from the pipelines server directory so that `schemas`, `utils` and `blueprints` import.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import sys
+import threading
+import time
+import zlib
+from urllib.parse import parse_qs, urlparse
+
+
+class StubModelServer:
+    """
+    In-process OpenAI/Ollama/Groq compatible server with injectable latency and token rate.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 0,
+        tokens_per_second: float = 0,
+        content: str = "Hello! This is a response from the stub model server.",
+        models: Optional[List[str]] = None,
+    ):
+        """
+        Initialize the stub server.
+        :param host: The host to bind to.
+        :param port: The port to bind to. 0 picks a free port.
+        :param latency_ms: The delay before the first byte of every response.
+        :param tokens_per_second: The rate at which streamed tokens are sent. 0 sends them at once.
+        :param content: The assistant message returned for every chat completion.
+        :param models: The model ids listed by /api/tags and /models.
+        """
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.content = content
+        self.models = models or ["stub-model"]
+        self.requests = 0
+        self.weather_requests = 0
+
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve requests on a background thread."""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def tokens(self) -> List[str]:
+        """Split the configured content into word-sized tokens, keeping the whitespace."""
+        words = self.content.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data: dict, status: int = 200):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency_ms / 1000)
+                path = self.path.split("?")[0].rstrip("/")
+                if path.endswith("/api/tags"):
+                    self.send_json(
+                        {"models": [{"model": model, "name": model} for model in stub.models]}
+                    )
+                elif path.endswith("/weather"):
+                    stub.weather_requests += 1
+                    query = parse_qs(urlparse(self.path).query)
+                    location = query.get("q", query.get("id", ["unknown"]))[0]
+                    self.send_json(
+                        {
+                            "id": int(query["id"][0]) if "id" in query else zlib.crc32(location.encode()),
+                            "name": location,
+                            "weather": [{"description": "clear sky"}],
+                            "main": {"temp": 20.0},
+                        }
+                    )
+                elif path.endswith("/models"):
+                    self.send_json(
+                        {
+                            "object": "list",
+                            "data": [
+                                {"id": model, "object": "model", "owned_by": "stub"}
+                                for model in stub.models
+                            ],
+                        }
+                    )
+                else:
+                    self.send_json({"error": f"Unknown path {self.path}"}, 404)
+
+            def do_POST(self):
+                stub.requests += 1
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                time.sleep(stub.latency_ms / 1000)
+
+                if not self.path.split("?")[0].rstrip("/").endswith("/chat/completions"):
+                    self.send_json({"error": f"Unknown path {self.path}"}, 404)
+                    return
+
+                model = body.get("model", stub.models[0])
+                if not body.get("stream"):
+                    time.sleep(
+                        len(stub.tokens()) / stub.tokens_per_second
+                        if stub.tokens_per_second
+                        else 0
+                    )
+                    self.send_json(
+                        {
+                            "id": "chatcmpl-stub",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": model,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": stub.content},
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                        }
+                    )
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in stub.tokens():
+                        self.send_event(model, {"content": token})
+                        if stub.tokens_per_second:
+                            time.sleep(1 / stub.tokens_per_second)
+                    self.send_event(model, {}, "stop")
+                    self.send_chunk(b"data: [DONE]\n\n")
+                    self.send_chunk(b"")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client closed the stream early
+                    pass
+
+            def send_event(self, model: str, delta: dict, finish_reason: Optional[str] = None):
+                event = {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+                self.send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+            def send_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def load_pipeline(path: str):
+    """
+    Import a pipeline file and instantiate its Pipeline class.
+    :param path: The path to the pipeline file.
+    :return: The pipeline instance.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module.Pipeline()
+
+
+def point_valves_at(pipeline, url: str):
+    """Point every valve ending in BASE_URL at the stub server."""
+    valves = getattr(pipeline, "valves", None)
+    if valves is None:
+        return
+    for name in valves.model_dump():
+        if name.upper().endswith("BASE_URL"):
+            setattr(valves, name, url)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def run_request(pipeline, model_id: str, message: str, stream: bool) -> dict:
+    """
+    Drive one request through the pipeline's inlet, pipe and outlet.
+    :return: The request's latency, time to first token and error, if any.
+    """
+    body = {
+        "model": model_id,
+        "messages": [{"role": "user", "content": message}],
+        "stream": stream,
+        "user": {"id": "load-test", "name": "Load Test", "role": "user"},
+    }
+    user = body["user"]
+    start = time.perf_counter()
+    first_token = None
+    error = None
+
+    try:
+        if hasattr(pipeline, "inlet"):
+            body = await pipeline.inlet(body, user)
+
+        if hasattr(pipeline, "pipe"):
+            loop = asyncio.get_running_loop()
+
+            def pipe():
+                nonlocal first_token
+                result = pipeline.pipe(message, model_id, body["messages"], body)
+                if isinstance(result, (str, dict)) or not hasattr(result, "__iter__"):
+                    first_token = time.perf_counter()
+                    return result
+                chunks = []
+                for chunk in result:
+                    if chunk and first_token is None:
+                        first_token = time.perf_counter()
+                    chunks.append(chunk)
+                return chunks
+
+            result = await loop.run_in_executor(None, pipe)
+            if isinstance(result, str) and result.startswith("Error:"):
+                error = result
+
+        if hasattr(pipeline, "outlet"):
+            body = await pipeline.outlet(body, user)
+    except Exception as e:
+        error = str(e)
+
+    end = time.perf_counter()
+    return {
+        "latency": end - start,
+        "ttft": (first_token or end) - start,
+        "error": error,
+    }
+
+
+async def run_load(pipeline, model_id: str, requests: int, concurrency: int, stream: bool, message: str) -> dict:
+    """
+    Run the requests at the target concurrency.
+    :return: The report.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i: int):
+        async with semaphore:
+            return await run_request(pipeline, model_id, message.replace("{i}", str(i)), stream)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[bounded(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    latencies = [result["latency"] * 1000 for result in results]
+    ttfts = [result["ttft"] * 1000 for result in results]
+    errors = [result["error"] for result in results if result["error"]]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            f"p{p}": round(percentile(latencies, p), 2) for p in (50, 95, 99)
+        },
+        "ttft_ms": {f"p{p}": round(percentile(ttfts, p), 2) for p in (50, 95, 99)},
+    }
+
+
+async def main(args):
+    # pipe() is blocking, so give it one thread per concurrent request
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=args.concurrency)
+    )
+
+    server = StubModelServer(
+        port=args.port,
+        latency_ms=args.latency_ms,
+        tokens_per_second=args.tokens_per_second,
+        content=args.content,
+    ).start()
+
+    output = io.StringIO() if args.quiet else sys.stdout
+    try:
+        with contextlib.redirect_stdout(output):
+            pipeline = load_pipeline(args.pipeline)
+            point_valves_at(pipeline, server.url)
+            if not args.decision_cache and hasattr(getattr(pipeline, "valves", None), "DECISION_CACHE_ENABLED"):
+                pipeline.valves.DECISION_CACHE_ENABLED = False
+            if hasattr(pipeline, "on_valves_updated"):
+                await pipeline.on_valves_updated()
+            if hasattr(pipeline, "on_startup"):
+                await pipeline.on_startup()
+
+            model_id = args.model or (
+                pipeline.pipelines[0]["id"]
+                if getattr(pipeline, "pipelines", None) and isinstance(pipeline.pipelines[0], dict)
+                else server.models[0]
+            )
+
+            report = await run_load(
+                pipeline, model_id, args.requests, args.concurrency, args.stream, args.message
+            )
+
+            if hasattr(pipeline, "on_shutdown"):
+                await pipeline.on_shutdown()
+    finally:
+        server.stop()
+
+    report["stub_requests"] = server.requests
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("pipeline", help="Path to the pipeline file to load test.")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--port", type=int, default=0, help="Stub server port, 0 for any free port.")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tokens-per-second", type=float, default=0)
+    parser.add_argument("--content", default="Hello! This is a response from the stub model server.")
+    parser.add_argument(
+        "--message",
+        default="What time is it? This is request {i}.",
+        help="The user message. {i} is replaced by the request number, to keep requests distinct.",
+    )
+    parser.add_argument(
+        "--decision-cache",
+        action="store_true",
+        help="Leave the tool decision cache on, so repeated messages are answered from it.",
+    )
+    parser.add_argument("--model", default=None, help="Model id passed to pipe.")
+    parser.add_argument("--no-stream", dest="stream", action="store_false")
+    parser.add_argument("--verbose", dest="quiet", action="store_false", help="Show pipeline output.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,155 @@
+"""
+title: Tool Checks
+description: Drives a Tools pipeline's local tool router through known queries and asserts
+the decision it makes for each, then drives its weather tools through the load-test stub.
+
+Each case names the tool the router should rank first and what it should decide:
+  - "local": answer with that tool without asking the task model
+  - "task_model": leave the call to the task model, e.g. because the tool needs parameters
+  - "no_tool": answer without any tool
+
+A case's query may also be a list of user messages, oldest first, to check follow-ups that
+only make sense in the conversation they continue.
+
+The weather checks point the pipeline at a StubModelServer, call the weather tools directly and
+through inlet, and assert on what the stub's /weather route served and what the client cached.
+
+    python benchmarks/tool_checks.py file_function_filter.py
+
+Run it from the pipelines server directory so that `schemas`, `utils` and `blueprints` import.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load_test import StubModelServer, load_pipeline, point_valves_at
+
+
+# (query or user messages, tool ranked first for the last message or None, decision)
+ROUTER_CASES = {
+    "file_function_filter": [
+        ("what time is it", "get_current_time", "local"),
+        ("What's the current time?", "get_current_time", "local"),
+        ("list the files", "list_files", "local"),
+        ("compute 2+2", "calculator", "task_model"),
+        ("calculate 3*7", "calculator", "task_model"),
+        ("2+2", None, "task_model"),
+        ("what is the weather in Paris", "get_current_weather", "task_model"),
+        ("delete the file notes.txt", "delete_file", "task_model"),
+        ("search the files for TODO", "search_files", "task_model"),
+        ("tell me a joke", None, "no_tool"),
+        ("hello there", None, "no_tool"),
+        (["what is the weather in Paris", "and in London?"], None, "task_model"),
+        (["what is the weather in Paris", "what about Berlin"], None, "task_model"),
+        (["search the files for TODO", "yes please"], None, "task_model"),
+        (["tell me a joke", "that was funny"], None, "no_tool"),
+    ],
+}
+
+
+def decision(content) -> str:
+    if content is None:
+        return "task_model"
+    if content == "":
+        return "no_tool"
+    return "local"
+
+
+def check_router(pipeline, cases: list) -> list:
+    """
+    Route every case and collect the ones the router gets wrong.
+    :return: A list of failure descriptions, empty if every case passed.
+    """
+    failures = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline.build_tools_index()
+    for query, tool, expected in cases:
+        messages = query if isinstance(query, list) else [query]
+        query = messages[-1]
+        # The window inlet passes, newest first
+        history = [{"role": "user", "content": message} for message in messages[::-1]]
+        ranked = pipeline.router.rank(query)
+        top = ranked[0][1] if ranked and ranked[0][0] > 0 else None
+        content = pipeline.route_locally(query, history)
+        got = decision(content)
+        if top != tool or got != expected or (got == "local" and json.loads(content)["name"] != tool):
+            failures.append(f"{query!r}: ranked {top} first and decided {got} ({content!r}), expected {tool} and {expected}")
+    return failures
+
+
+def check_weather(pipeline) -> list:
+    """
+    Drive the weather tools through the stub server's /weather route.
+    :return: A list of failure descriptions, empty if every check passed.
+    """
+    failures = []
+
+    def expect(condition: bool, description: str):
+        if not condition:
+            failures.append(description)
+
+    stub = StubModelServer(
+        content=json.dumps(
+            {"name": "get_current_weather", "parameters": {"location": "Tokyo", "unit": "metric"}}
+        )
+    ).start()
+    try:
+        point_valves_at(pipeline, stub.url)
+        pipeline.valves.OPENWEATHERMAP_API_KEY = "stub"
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(pipeline.on_valves_updated())
+        tools = pipeline.tools
+
+        result = tools.get_current_weather("Paris", "metric")
+        expect(result == "Paris: Clear sky, 20.0°M", f"get_current_weather returned {result!r}")
+        expect(stub.weather_requests == 1, f"first call made {stub.weather_requests} /weather requests, expected 1")
+
+        tools.get_current_weather("paris", "metric")
+        expect(stub.weather_requests == 1, "repeat call for the same city went to /weather instead of the cache")
+        expect(tools.weather.stats["cached"] == 1, f"weather stats {tools.weather.stats}, expected one cached")
+
+        result = tools.get_weather_batch(["Paris", "London", "Berlin"], "metric")
+        lines = result.split("\n")
+        expect(
+            lines == [f"{city}: Clear sky, 20.0°M" for city in ("Paris", "London", "Berlin")],
+            f"get_weather_batch returned {result!r}",
+        )
+        expect(stub.weather_requests == 3, f"batch made {stub.weather_requests - 1} /weather requests, expected 2")
+
+        body = {"messages": [{"role": "user", "content": "what is the weather in Tokyo"}]}
+        with contextlib.redirect_stdout(io.StringIO()):
+            body = asyncio.run(pipeline.inlet(body))
+        system = next((m["content"] for m in body["messages"] if m["role"] == "system"), "")
+        expect("Tokyo: Clear sky, 20.0°M" in system, f"inlet system prompt {system!r} has no Tokyo weather")
+        expect(stub.weather_requests == 4, f"inlet made {stub.weather_requests - 3} /weather requests, expected 1")
+    finally:
+        stub.stop()
+    return failures
+
+
+def main(args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        pipeline = load_pipeline(args.pipeline)
+    name = os.path.splitext(os.path.basename(args.pipeline))[0]
+    if name not in ROUTER_CASES:
+        sys.exit(f"No router cases for {name}")
+
+    failures = check_router(pipeline, ROUTER_CASES[name])
+    report = {"router_cases": len(ROUTER_CASES[name]), "router_failures": failures}
+    if hasattr(pipeline.tools, "get_current_weather"):
+        report["weather_failures"] = check_weather(pipeline)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if any(report[key] for key in report if key.endswith("_failures")):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("pipeline", help="Path to the pipeline file with the tools.")
+    main(parser.parse_args())
@@ -0,0 +1,1271 @@
+"""
+title: Network Tools Blueprint
+description: Pooled, cached and resumable HTTP, SSH, SFTP and FTP helpers shared by the
+Tools pipelines (external_tools_filter.py, mariadb_filter.py).
+
+Install it next to function_calling_blueprint.py in the pipelines server's blueprints
+directory, and import it from a pipeline as `blueprints.network_tools`.
+"""
+
+import os
+import requests
+import asyncio
+import codecs
+import paramiko
+import ftplib
+import hashlib
+import json
+import posixpath
+import re
+import socket
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from typing import List
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+
+HTTP_CACHE_DIR = os.path.join(tempfile.gettempdir(), "http_cache")
+
+
+class HTTPFetcher:
+    """
+    Fetches pages over a pooled session, with a cap on the bytes read per page, a cap on
+    concurrent requests per host, and an on-disk cache that honors Cache-Control, ETag
+    and Last-Modified. Responses fetched without TLS verification are cached apart from
+    verified ones, so they are never served to a fetch that verifies.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = HTTP_CACHE_DIR,
+        max_bytes: int = 1024 * 1024,
+        max_per_host: int = 4,
+        timeout: float = 15,
+    ):
+        """
+        Initialize the fetcher.
+        :param cache_dir: The directory cached responses are kept in.
+        :param max_bytes: The most bytes read from one response body.
+        :param max_per_host: The most requests in flight to one host.
+        :param timeout: Seconds to wait on the server before giving up.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(max_per_host, 10))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.host_slots = {}
+        self.stats = {"fresh": 0, "revalidated": 0, "fetched": 0, "truncated": 0}
+
+    def slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_slots[host]
+
+    def cache_paths(self, url: str, verify: bool = True) -> tuple:
+        key = hashlib.sha256((url if verify else f"unverified {url}").encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json"), os.path.join(self.cache_dir, f"{key}.body")
+
+    def load(self, url: str, verify: bool = True):
+        """Return the cached entry's metadata and body, or None."""
+        meta_path, body_path = self.cache_paths(url, verify)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            with open(body_path, "rb") as file:
+                body = file.read()
+        except (OSError, ValueError):
+            return None
+        # A body cut short by a smaller cap can't answer for a larger one
+        if meta.get("url") != url or (meta.get("truncated") and len(body) < self.max_bytes):
+            return None
+        return meta, body
+
+    def store(self, url: str, verify: bool, meta: dict, body: bytes = None):
+        """
+        Write the entry atomically, leaving the body alone when only the metadata changed.
+        The cache is best effort: if it can't be written, the response is just not cached.
+        """
+        meta_path, body_path = self.cache_paths(url, verify)
+        items = [(meta_path, json.dumps(meta).encode())]
+        if body is not None:
+            items.insert(0, (body_path, body))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for path, data in items:
+                fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+                try:
+                    with os.fdopen(fd, "wb") as file:
+                        file.write(data)
+                    os.replace(temp_path, path)
+                except OSError:
+                    os.unlink(temp_path)
+                    raise
+        except OSError as e:
+            print(f"Error caching {url}: {e}")
+
+    @staticmethod
+    def freshness(headers) -> tuple:
+        """
+        Read how long a response may be served without asking the server again.
+        :return: The lifetime in seconds, and whether the response may be stored at all.
+        """
+        directives = {}
+        for part in headers.get("Cache-Control", "").lower().split(","):
+            name, _, value = part.strip().partition("=")
+            directives[name] = value.strip('"')
+        if "no-store" in directives:
+            return 0, False
+        if "no-cache" in directives:
+            return 0, True
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name, "").isdigit():
+                return int(directives[name]), True
+        try:
+            date = parsedate_to_datetime(headers["Date"]) if "Date" in headers else None
+            if "Expires" in headers:
+                expires = parsedate_to_datetime(headers["Expires"])
+                return max((expires - (date or expires)).total_seconds(), 0), True
+            if "Last-Modified" in headers and date is not None:
+                # Heuristic freshness: a tenth of the time since the page last changed
+                modified = parsedate_to_datetime(headers["Last-Modified"])
+                return max((date - modified).total_seconds() / 10, 0), True
+        except (TypeError, ValueError):
+            pass
+        return 0, True
+
+    def fetch(self, url: str, verify: bool = True) -> str:
+        """
+        Fetch a page as text, from the cache while fresh and with a conditional request once stale.
+        :param url: The URL to fetch.
+        :param verify: Whether to verify the server's TLS certificate.
+        :return: The page, cut off at max_bytes.
+        """
+        return self.decode(*self.get(url, verify))
+
+    def fetch_text(self, url: str, max_chars: int, verify: bool = True) -> str:
+        """
+        Fetch a page as readable text, converting HTML as it streams in and stopping at max_chars.
+        :param url: The URL to fetch.
+        :param max_chars: The most characters of text to return.
+        :param verify: Whether to verify the server's TLS certificate.
+        :return: The page's text.
+        """
+        extractor = HTMLTextExtractor(max_chars)
+        self.get(url, verify, extractor.consume)
+        return extractor.text()
+
+    def get(self, url: str, verify: bool = True, consume=None) -> tuple:
+        """
+        Get a response's metadata and body, through the cache.
+        :param consume: Called with the body's text as it arrives; returning True stops the read.
+        :return: The response metadata and body.
+        """
+        cached = self.load(url, verify)
+        now = time.time()
+        if cached is not None and now < cached[0]["expires"]:
+            self.stats["fresh"] += 1
+            if consume is not None:
+                consume(self.decode(*cached))
+            return cached
+
+        headers = {}
+        if cached is not None:
+            if cached[0].get("etag"):
+                headers["If-None-Match"] = cached[0]["etag"]
+            if cached[0].get("last_modified"):
+                headers["If-Modified-Since"] = cached[0]["last_modified"]
+
+        with self.slot(url):
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout, verify=verify) as response:
+                lifetime, storable = self.freshness(response.headers)
+                if response.status_code == 304 and cached is not None:
+                    meta, body = cached
+                    meta["expires"] = now + lifetime
+                    self.store(url, verify, meta)
+                    self.stats["revalidated"] += 1
+                    if consume is not None:
+                        consume(self.decode(meta, body))
+                    return meta, body
+
+                body, truncated, stopped = self.read(response, consume)
+                meta = {
+                    "url": url,
+                    "encoding": response.encoding,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "expires": now + lifetime,
+                    "truncated": truncated,
+                }
+
+        self.stats["fetched"] += 1
+        # A body the consumer stopped reading early is of no use to later fetches
+        if response.status_code == 200 and storable and not stopped and (meta["etag"] or meta["last_modified"] or lifetime):
+            self.store(url, verify, meta, body)
+        return meta, body
+
+    def read(self, response, consume=None) -> tuple:
+        """
+        Read the body up to max_bytes, closing the connection early on larger ones.
+        :param consume: Called with the decoded text of each chunk; returning True stops the read.
+        :return: The body, whether max_bytes cut it short, and whether consume did.
+        """
+        try:
+            decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=65536):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.max_bytes:
+                self.stats["truncated"] += 1
+                body = b"".join(chunks)[: self.max_bytes]
+                if consume is not None:
+                    consume(decoder.decode(chunk[: len(chunk) - (size - self.max_bytes)], final=True))
+                return body, True, False
+            if consume is not None and consume(decoder.decode(chunk)):
+                return b"".join(chunks), False, True
+        if consume is not None:
+            consume(decoder.decode(b"", final=True))
+        return b"".join(chunks), False, False
+
+    @staticmethod
+    def decode(meta: dict, body: bytes) -> str:
+        return body.decode(meta.get("encoding") or "utf-8", errors="replace")
+
+    def close(self):
+        self.session.close()
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Turns HTML into readable text as it is fed, dropping scripts, styles and other markup,
+    and stops once it has max_chars of text. Input that isn't HTML is kept as it is.
+    """
+
+    SKIP = {"script", "style", "noscript", "template", "svg", "head", "iframe", "object"}
+    BLOCKS = {
+        "address", "article", "aside", "blockquote", "br", "dd", "div", "dl", "dt", "figcaption",
+        "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav",
+        "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul",
+    }
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+        self.parts = []
+        self.size = 0
+        self.skipping = 0
+        self.saved_skipping = 0
+        self.is_html = None
+
+    def consume(self, text: str) -> bool:
+        """
+        Feed the next piece of the document.
+        :return: True once max_chars of text have been collected.
+        """
+        if self.is_html is None and text.strip():
+            self.is_html = text.lstrip().startswith("<")
+        if self.is_html:
+            self.feed(text)
+        else:
+            self.append(text)
+        return self.size >= self.max_chars
+
+    def append(self, text: str):
+        self.parts.append(text)
+        self.size += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag == "body":
+            # Pages often leave <head> unclosed
+            self.skipping = 0
+        elif tag == "title":
+            # The title is the one part of <head> worth keeping
+            self.skipping, self.saved_skipping = 0, self.skipping
+        elif tag in self.BLOCKS:
+            self.append("\n- " if tag == "li" else "\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag == "title":
+            self.skipping = self.saved_skipping
+            self.append("\n")
+        elif tag in self.BLOCKS and tag != "li":
+            self.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.append(re.sub(r"\s+", " ", data))
+
+    def text(self) -> str:
+        if self.is_html:
+            self.close()
+        text = "".join(self.parts)
+        if self.is_html:
+            text = re.sub(r" *\n[ \n]*\n *", "\n\n", re.sub(r" *\n *", "\n", text))
+        return text.strip()[: self.max_chars]
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion, from a worker thread if this thread already runs a loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def fetch_pages(fetcher: HTTPFetcher, urls: List[str], max_chars: int) -> List[str]:
+    """
+    Fetch pages concurrently as readable text, at most fetcher.max_per_host at a time per host.
+    :return: The text of each page, or the error fetching it, in the order of urls.
+    """
+    loop = asyncio.get_running_loop()
+    slots = {}
+
+    async def fetch(url: str) -> str:
+        slot = slots.setdefault(urlparse(url).netloc, asyncio.Semaphore(fetcher.max_per_host))
+        async with slot:
+            try:
+                return await loop.run_in_executor(None, fetcher.fetch_text, url, max_chars)
+            except requests.RequestException as e:
+                return f"Error fetching page: {str(e)}"
+
+    return await asyncio.gather(*[fetch(url) for url in urls])
+
+
+class PooledSSHConnection:
+    """
+    An SSH connection held by SSHConnectionPool, with its SFTP channel opened on first use
+    and a new channel for every command run on it.
+    """
+
+    def __init__(self, client: paramiko.SSHClient):
+        self.client = client
+        self.sftp_client = None
+
+    def sftp(self) -> paramiko.SFTPClient:
+        """Return the connection's SFTP channel, opening it once."""
+        if self.sftp_client is None:
+            self.sftp_client = self.client.open_sftp()
+        return self.sftp_client
+
+    def run(self, command: str, timeout: float, max_bytes: int) -> dict:
+        """
+        Run a command on a new channel, reading its output as it arrives.
+        :param command: The command to run.
+        :param timeout: Seconds to let the command run.
+        :param max_bytes: The most bytes of output kept. The rest is read and dropped.
+        :return: The exit status (None on timeout), the output, and whether it was truncated or timed out.
+        """
+        deadline = time.monotonic() + timeout
+        channel = self.client.get_transport().open_session(timeout=timeout)
+        chunks = []
+        size = 0
+        result = {"exit_status": None, "truncated": False, "timed_out": False}
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    result["timed_out"] = True
+                    break
+                channel.settimeout(remaining)
+                try:
+                    data = channel.recv(32768)
+                except socket.timeout:
+                    result["timed_out"] = True
+                    break
+                if not data:
+                    break
+                # Keep draining past the cap so the command runs to completion
+                kept = data[: max(max_bytes - size, 0)]
+                if kept:
+                    chunks.append(kept)
+                    size += len(kept)
+                if len(kept) < len(data):
+                    result["truncated"] = True
+            if not result["timed_out"] and channel.status_event.wait(max(deadline - time.monotonic(), 0)):
+                result["exit_status"] = channel.exit_status
+            elif not result["timed_out"]:
+                result["timed_out"] = True
+        finally:
+            channel.close()
+        result["output"] = b"".join(chunks).decode("utf-8", errors="replace")
+        return result
+
+    def is_healthy(self) -> bool:
+        """Check that the transport is still up, probing it with an ignore packet."""
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except (paramiko.SSHException, OSError):
+            return False
+
+    def close(self):
+        """Close the SFTP channel and the connection."""
+        try:
+            if self.sftp_client is not None:
+                self.sftp_client.close()
+            self.client.close()
+        except Exception as e:
+            print(e)
+
+
+class ConnectionPool:
+    """
+    Reusable connections keyed by (host, port, username, credentials), with idle timeouts,
+    health checks and a cap on open connections per host. Subclasses say how connections
+    are opened, checked and closed.
+    """
+
+    default_port = 0
+
+    def __init__(self, max_per_host: int = 4, idle_timeout: float = 300):
+        """
+        Initialize the pool.
+        :param max_per_host: The maximum number of connections open to one host.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        # key -> connections ready to be borrowed
+        self.idle = {}
+        # host -> number of open connections, idle or borrowed
+        self.open = {}
+        # Once closed, connections still borrowed are closed when they are returned
+        self.closed = False
+        self.stats = {"created": 0, "reused": 0, "discarded": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def open_connection(self, host: str, port: int, username: str, password: str):
+        raise NotImplementedError
+
+    def is_healthy(self, connection) -> bool:
+        raise NotImplementedError
+
+    def close_connection(self, connection):
+        raise NotImplementedError
+
+    @staticmethod
+    def make_key(host: str, port: int, username: str, password: str) -> tuple:
+        """Key connections by host and credentials, without keeping the password itself."""
+        return host, port, username, hashlib.sha256(password.encode()).hexdigest()
+
+    def prune(self) -> list:
+        """
+        Take idle connections past the idle timeout out of the pool. Call with the condition held.
+        :return: The (key, connection) pairs to pass to discard once the condition is released.
+        """
+        now = time.monotonic()
+        expired = []
+        for key, connections in self.idle.items():
+            for connection in [c for c in connections if now - c.last_used > self.idle_timeout]:
+                connections.remove(connection)
+                expired.append((key, connection))
+        return expired
+
+    def discard(self, key: tuple, connection):
+        """
+        Close a connection taken out of the pool and free its slot. Call without the condition
+        held: closing can take a round trip to the server.
+        """
+        self.close_connection(connection)
+        with self.condition:
+            self.open[key[0]] -= 1
+            self.stats["discarded"] += 1
+            self.condition.notify_all()
+
+    def acquire(self, host: str, username: str, password: str, port: int = None) -> tuple:
+        """
+        Borrow a healthy connection, opening one if the host is under its cap. Only the
+        bookkeeping runs under the pool's condition; health checks, opening and closing
+        connections run outside it, so borrowers don't queue behind each other's round trips.
+        :return: The pool key and the connection, to be passed back to release.
+        """
+        port = port or self.default_port
+        key = self.make_key(host, port, username, password)
+        waited = False
+        while True:
+            connection = None
+            reserved = False
+            stale = []
+            waiting_since = time.monotonic()
+            with self.condition:
+                while True:
+                    stale += self.prune()
+                    if self.idle.get(key):
+                        connection = self.idle[key].pop()
+                        break
+                    if self.open.get(host, 0) < self.max_per_host:
+                        self.open[host] = self.open.get(host, 0) + 1
+                        reserved = True
+                        break
+                    # Make room by closing an idle connection to the same host with other credentials
+                    other = next((k for k, c in self.idle.items() if k[0] == host and c), None)
+                    if other is not None:
+                        stale.append((other, self.idle[other].pop()))
+                        break
+                    if not waited:
+                        waited = True
+                        self.stats["waits"] += 1
+                    self.condition.wait()
+                self.record_wait(waiting_since)
+
+            for stale_key, stale_connection in stale:
+                self.discard(stale_key, stale_connection)
+
+            if connection is not None:
+                if self.is_healthy(connection):
+                    with self.condition:
+                        self.stats["reused"] += 1
+                    return key, connection
+                self.discard(key, connection)
+            elif reserved:
+                break
+
+        try:
+            connection = self.open_connection(host, port, username, password)
+        except Exception:
+            with self.condition:
+                self.open[host] -= 1
+                self.condition.notify_all()
+            raise
+
+        connection.last_used = time.monotonic()
+        with self.condition:
+            self.stats["created"] += 1
+        return key, connection
+
+    def record_wait(self, waiting_since: float):
+        """
+        Add the time a borrower spent waiting for the pool's condition and for the host to drop
+        under its cap. Call with the condition held.
+        """
+        waited = time.monotonic() - waiting_since
+        self.stats["wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+
+    def release(self, key: tuple, connection, healthy: bool = True):
+        """Return a borrowed connection, or close it if it failed while borrowed or the pool is closed."""
+        with self.condition:
+            if healthy and not self.closed:
+                connection.last_used = time.monotonic()
+                self.idle.setdefault(key, []).append(connection)
+                self.condition.notify_all()
+                return
+        self.discard(key, connection)
+
+    @contextmanager
+    def connection(self, host: str, username: str, password: str, port: int = None):
+        """Borrow a connection for the duration of a with block."""
+        key, connection = self.acquire(host, username, password, port)
+        failed = False
+        try:
+            yield connection
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Errors such as a missing file leave the connection usable
+            self.release(key, connection, not failed or self.is_healthy(connection))
+
+    def close(self):
+        """Close every idle connection, and each borrowed one as it is returned."""
+        with self.condition:
+            self.closed = True
+            idle = [(key, connection) for key, connections in self.idle.items() for connection in connections]
+            self.idle = {}
+        for key, connection in idle:
+            self.discard(key, connection)
+
+
+class SSHConnectionPool(ConnectionPool):
+    """
+    Pooled SSH connections, kept alive with keepalive packets.
+    """
+
+    default_port = 22
+
+    def __init__(
+        self,
+        max_per_host: int = 4,
+        idle_timeout: float = 300,
+        keepalive: int = 30,
+        channels_per_connection: int = 8,
+        connect_timeout: float = 15,
+    ):
+        """
+        Initialize the pool.
+        :param max_per_host: The maximum number of connections open to one host.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        :param keepalive: Seconds between keepalive packets on open connections.
+        :param channels_per_connection: The most commands run at once over one shared connection.
+        :param connect_timeout: Seconds to wait for a new connection to be set up.
+        """
+        super().__init__(max_per_host, idle_timeout)
+        self.keepalive = keepalive
+        self.channels_per_connection = channels_per_connection
+        self.connect_timeout = connect_timeout
+        # key -> connections lent out by shared(), with their number of borrowers
+        self.shared_connections = {}
+
+    def open_connection(self, host: str, port: int, username: str, password: str) -> PooledSSHConnection:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=host,
+            port=port,
+            username=username,
+            password=password,
+            timeout=self.connect_timeout,
+            banner_timeout=self.connect_timeout,
+            auth_timeout=self.connect_timeout,
+        )
+        client.get_transport().set_keepalive(self.keepalive)
+        return PooledSSHConnection(client)
+
+    @contextmanager
+    def shared(self, host: str, username: str, password: str, port: int = None):
+        """
+        Borrow a connection that up to channels_per_connection borrowers use at once, each on
+        its own channel. Use connection() instead for work that needs the connection to itself.
+        """
+        key = self.make_key(host, port or self.default_port, username, password)
+        with self.condition:
+            entries = self.shared_connections.setdefault(key, [])
+            entry = next(
+                (
+                    e
+                    for e in entries
+                    if e["users"] < self.channels_per_connection
+                    and (not e["ready"].is_set() or ("connection" in e and self.is_healthy(e["connection"])))
+                ),
+                None,
+            )
+            opener = entry is None
+            if opener:
+                # Borrowers arriving while this connection is opened wait for it instead of opening more
+                entry = {"users": 0, "ready": threading.Event()}
+                entries.append(entry)
+            entry["users"] += 1
+
+        if opener:
+            try:
+                key, entry["connection"] = self.acquire(host, username, password, port)
+            except Exception as e:
+                entry["error"] = e
+            entry["ready"].set()
+        else:
+            entry["ready"].wait()
+        try:
+            if "error" in entry:
+                raise entry["error"]
+            yield entry["connection"]
+        finally:
+            with self.condition:
+                entry["users"] -= 1
+                last = entry["users"] == 0
+                if last:
+                    entries.remove(entry)
+            if last and "connection" in entry:
+                self.release(key, entry["connection"], self.is_healthy(entry["connection"]))
+
+    def is_healthy(self, connection: PooledSSHConnection) -> bool:
+        return connection.is_healthy()
+
+    def close_connection(self, connection: PooledSSHConnection):
+        connection.close()
+
+
+def ssh_exec_on(
+    pool: SSHConnectionPool,
+    host: str,
+    username: str,
+    password: str,
+    command: str,
+    timeout: float = 60,
+    max_bytes: int = 65536,
+) -> dict:
+    """
+    Run a command on one host over a shared pooled connection.
+    :return: The host, the run's result or error, and the seconds it took.
+    """
+    start = time.monotonic()
+    try:
+        with pool.shared(host, username, password) as connection:
+            result = connection.run(command, timeout, max_bytes)
+    except (paramiko.SSHException, OSError) as e:
+        result = {"error": str(e)}
+    result["host"] = host
+    result["seconds"] = round(time.monotonic() - start, 3)
+    return result
+
+
+def format_exec_result(result: dict) -> str:
+    if "error" in result:
+        return f"Error running command on {result['host']}: {result['error']}"
+    status = "timed out" if result["timed_out"] else f"exit status {result['exit_status']}"
+    output = result["output"] + ("\n[output truncated]" if result["truncated"] else "")
+    return f"{result['host']} ({status}, {result['seconds']}s):\n{output}"
+
+
+def exec_timeout(tools, hosts: List[str] = None, **kwargs) -> float:
+    """
+    The tool timeout for running SSH commands: connecting plus running the command, once for
+    every wave of SSH_FANOUT_PARALLELISM hosts.
+    """
+    valves = tools.pipeline.valves
+    waves = -(-len(hosts) // max(valves.SSH_FANOUT_PARALLELISM, 1)) if hosts else 1
+    return (valves.SSH_CONNECT_TIMEOUT + valves.SSH_EXEC_TIMEOUT) * waves
+
+
+def transfer_timeout(tools, **kwargs) -> float:
+    """The tool timeout for SFTP and FTP transfers."""
+    return tools.pipeline.valves.TRANSFER_TIMEOUT
+
+
+class SFTPTransfer:
+    """
+    Moves files over pooled SFTP connections. Files are split into ranges that run
+    concurrently on a bounded worker pool, each range with pipelined requests. Ranges
+    finished by an interrupted transfer are recorded in a journal in journal_dir and
+    skipped when the transfer is retried.
+    """
+
+    BLOCK_SIZE = 32768
+
+    def __init__(
+        self,
+        pool: SSHConnectionPool,
+        host: str,
+        username: str,
+        password: str,
+        workers: int = 4,
+        chunk_size: int = 8 * 1024 * 1024,
+        journal_dir: str = os.path.join(tempfile.gettempdir(), "sftp_journals"),
+    ):
+        """
+        Initialize the transfer.
+        :param pool: The pool to borrow connections from, one per running range.
+        :param host: The hostname or IP address of the SFTP server.
+        :param username: The username to use for the SFTP connection.
+        :param password: The password to use for the SFTP connection.
+        :param workers: The number of ranges transferred at once.
+        :param chunk_size: The size in bytes of each range.
+        :param journal_dir: The directory journals are kept in. Transfers are not journaled if it isn't writable.
+        """
+        self.pool = pool
+        self.host = host
+        self.username = username
+        self.password = password
+        self.workers = max(workers, 1)
+        self.chunk_size = max(chunk_size, self.BLOCK_SIZE)
+        self.journal_dir = journal_dir
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.last_report = 0.0
+
+    def connection(self):
+        return self.pool.connection(self.host, self.username, self.password)
+
+    def upload(self, local_file: str, remote_file: str) -> dict:
+        return self.run("upload", lambda sftp: [(local_file, remote_file)])
+
+    def download(self, remote_file: str, local_file: str) -> dict:
+        return self.run("download", lambda sftp: [(local_file, remote_file)])
+
+    def upload_directory(self, local_dir: str, remote_dir: str) -> dict:
+        def collect(sftp):
+            pairs = []
+            for root, dirs, files in os.walk(local_dir):
+                remote_root = posixpath.join(remote_dir, os.path.relpath(root, local_dir).replace(os.sep, "/"))
+                self.make_remote_dirs(sftp, posixpath.normpath(remote_root))
+                for name in files:
+                    pairs.append((os.path.join(root, name), posixpath.join(posixpath.normpath(remote_root), name)))
+            return pairs
+
+        return self.run("upload", collect)
+
+    def download_directory(self, remote_dir: str, local_dir: str) -> dict:
+        def collect(sftp):
+            pairs = []
+            pending = [(remote_dir, local_dir)]
+            while pending:
+                remote_root, local_root = pending.pop()
+                os.makedirs(local_root, exist_ok=True)
+                for attributes in sftp.listdir_attr(remote_root):
+                    remote_path = posixpath.join(remote_root, attributes.filename)
+                    local_path = os.path.join(local_root, attributes.filename)
+                    if stat.S_ISDIR(attributes.st_mode):
+                        pending.append((remote_path, local_path))
+                    elif stat.S_ISREG(attributes.st_mode):
+                        pairs.append((local_path, remote_path))
+            return pairs
+
+        return self.run("download", collect)
+
+    @staticmethod
+    def make_remote_dirs(sftp: paramiko.SFTPClient, remote_dir: str):
+        """Create a remote directory and its missing parents."""
+        missing = []
+        while remote_dir not in ("", "/", "."):
+            try:
+                sftp.stat(remote_dir)
+                break
+            except IOError:
+                missing.append(remote_dir)
+                remote_dir = posixpath.dirname(remote_dir)
+        for path in reversed(missing):
+            sftp.mkdir(path)
+
+    def run(self, direction: str, collect) -> dict:
+        """
+        Transfer every (local_file, remote_file) pair returned by collect.
+        :param direction: "upload" or "download".
+        :param collect: Called with an SFTP client, returns the pairs to transfer.
+        :return: The transferred, skipped and failed files, with bytes moved and seconds taken.
+        """
+        start = time.monotonic()
+        summary = {"transferred": [], "skipped": [], "failed": {}, "bytes": 0}
+        jobs = []
+        # Hold a connection only while planning, so the ranges can use every slot on the host
+        with self.connection() as connection:
+            sftp = connection.sftp()
+            for local_file, remote_file in collect(sftp):
+                try:
+                    job = self.plan(sftp, direction, local_file, remote_file)
+                except (IOError, OSError) as e:
+                    summary["failed"][local_file if direction == "upload" else remote_file] = str(e)
+                    continue
+                if job is None:
+                    summary["skipped"].append(local_file if direction == "upload" else remote_file)
+                else:
+                    jobs.append(job)
+
+        self.total_bytes = sum(self.range_length(job, offset) for job in jobs for offset in job["ranges"])
+        self.done_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.transfer_range, job, offset): job
+                for job in jobs
+                for offset in job["ranges"]
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (IOError, OSError, paramiko.SSHException) as e:
+                    futures[future]["error"] = str(e)
+
+        with self.connection() as connection:
+            sftp = connection.sftp()
+            for job in jobs:
+                if "error" not in job:
+                    try:
+                        self.finish(sftp, job)
+                    except (IOError, OSError) as e:
+                        job["error"] = str(e)
+                if "error" in job:
+                    summary["failed"][job["source"]] = job["error"]
+                else:
+                    summary["transferred"].append(job["source"])
+
+        summary["bytes"] = self.done_bytes
+        summary["seconds"] = round(time.monotonic() - start, 3)
+        print(f"sftp_{direction}:{summary['bytes']} bytes in {summary['seconds']}s, {len(summary['skipped'])} up to date, {len(summary['failed'])} failed")
+        return summary
+
+    def plan(self, sftp: paramiko.SFTPClient, direction: str, local_file: str, remote_file: str):
+        """
+        Work out which ranges of a file still need to move.
+        :return: The job, or None if the destination already matches the source.
+        """
+        if direction == "upload":
+            source = os.stat(local_file)
+            part = f"{remote_file}.part"
+            try:
+                target = sftp.stat(remote_file)
+            except IOError:
+                target = None
+        else:
+            source = sftp.stat(remote_file)
+            part = f"{local_file}.part"
+            target = os.stat(local_file) if os.path.exists(local_file) else None
+
+        job = {
+            "direction": direction,
+            "source": local_file if direction == "upload" else remote_file,
+            "local": local_file,
+            "remote": remote_file,
+            "part": part,
+            "journal": self.journal_path(direction, local_file, remote_file),
+            "size": source.st_size,
+            "mtime": int(source.st_mtime),
+        }
+        if target is not None and target.st_size == job["size"] and self.same_content(sftp, job, int(target.st_mtime)):
+            return None
+
+        done = self.load_journal(job)
+        if done and self.part_size(sftp, job) != job["size"]:
+            done = set()
+        if not done:
+            self.create_part(sftp, job)
+        job["done"] = done
+        job["ranges"] = [offset for offset in range(0, job["size"], self.chunk_size) if offset not in done]
+        return job
+
+    @staticmethod
+    def same_content(sftp: paramiko.SFTPClient, job: dict, target_mtime: int) -> bool:
+        """Compare checksums where the server supports check-file, else fall back to the mtime."""
+        try:
+            with sftp.open(job["remote"], "r") as file:
+                remote_hash = file.check("sha256")
+        except IOError:
+            return target_mtime == job["mtime"]
+        local_hash = hashlib.sha256()
+        with open(job["local"], "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                local_hash.update(block)
+        return remote_hash == local_hash.digest()
+
+    def journal_path(self, direction: str, local_file: str, remote_file: str) -> str:
+        """Name the journal after the transfer, so the local file's directory is never written to."""
+        transfer = f"{direction}:{self.username}@{self.host}:{remote_file}:{os.path.abspath(local_file)}"
+        return os.path.join(self.journal_dir, f"{hashlib.sha256(transfer.encode()).hexdigest()}.json")
+
+    def load_journal(self, job: dict) -> set:
+        """Return the ranges already done, if the journal belongs to this same source."""
+        try:
+            with open(job["journal"]) as file:
+                journal = json.load(file)
+        except (OSError, ValueError):
+            return set()
+        expected = {"remote": job["remote"], "size": job["size"], "mtime": job["mtime"], "chunk_size": self.chunk_size}
+        if any(journal.get(key) != value for key, value in expected.items()):
+            return set()
+        return set(journal.get("done", []))
+
+    def save_journal(self, job: dict):
+        """Record the ranges done so far, or stop journaling the job if the journal can't be written."""
+        if job["journal"] is None:
+            return
+        try:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            with open(job["journal"], "w") as file:
+                json.dump(
+                    {
+                        "remote": job["remote"],
+                        "size": job["size"],
+                        "mtime": job["mtime"],
+                        "chunk_size": self.chunk_size,
+                        "done": sorted(job["done"]),
+                    },
+                    file,
+                )
+        except OSError as e:
+            print(f"Not journaling {job['source']}, so it will restart from zero if interrupted: {e}")
+            job["journal"] = None
+
+    @staticmethod
+    def part_size(sftp: paramiko.SFTPClient, job: dict) -> int:
+        try:
+            if job["direction"] == "upload":
+                return sftp.stat(job["part"]).st_size
+            return os.path.getsize(job["part"])
+        except (IOError, OSError):
+            return -1
+
+    @staticmethod
+    def create_part(sftp: paramiko.SFTPClient, job: dict):
+        """Create the partial file at full size, so ranges can be written in any order."""
+        if job["direction"] == "upload":
+            with sftp.open(job["part"], "w") as file:
+                file.truncate(job["size"])
+        else:
+            with open(job["part"], "wb") as file:
+                file.truncate(job["size"])
+
+    def range_length(self, job: dict, offset: int) -> int:
+        return min(self.chunk_size, job["size"] - offset)
+
+    def transfer_range(self, job: dict, offset: int):
+        """Move one range of a file over its own pooled connection."""
+        length = self.range_length(job, offset)
+        with self.connection() as connection:
+            sftp = connection.sftp()
+            if job["direction"] == "upload":
+                with open(job["local"], "rb") as source, sftp.open(job["part"], "r+") as target:
+                    target.set_pipelined(True)
+                    source.seek(offset)
+                    target.seek(offset)
+                    remaining = length
+                    while remaining:
+                        block = source.read(min(self.BLOCK_SIZE, remaining))
+                        if not block:
+                            raise IOError(f"{job['local']} changed during the upload")
+                        target.write(block)
+                        remaining -= len(block)
+            else:
+                blocks = [
+                    (position, min(self.BLOCK_SIZE, offset + length - position))
+                    for position in range(offset, offset + length, self.BLOCK_SIZE)
+                ]
+                with sftp.open(job["remote"], "r") as source, open(job["part"], "r+b") as target:
+                    target.seek(offset)
+                    # readv keeps every block request in flight instead of waiting on each
+                    for block in source.readv(blocks):
+                        target.write(block)
+
+        with self.lock:
+            job["done"].add(offset)
+            self.save_journal(job)
+            self.done_bytes += length
+            now = time.monotonic()
+            if now - self.last_report >= 1 or self.done_bytes == self.total_bytes:
+                self.last_report = now
+                print(f"sftp_{job['direction']}:{self.done_bytes}/{self.total_bytes} bytes")
+
+    @staticmethod
+    def finish(sftp: paramiko.SFTPClient, job: dict):
+        """Move the partial file into place and carry the source mtime over."""
+        if job["direction"] == "upload":
+            try:
+                sftp.posix_rename(job["part"], job["remote"])
+            except IOError:
+                try:
+                    sftp.remove(job["remote"])
+                except IOError:
+                    pass
+                sftp.rename(job["part"], job["remote"])
+            sftp.utime(job["remote"], (job["mtime"], job["mtime"]))
+        else:
+            os.replace(job["part"], job["local"])
+            os.utime(job["local"], (job["mtime"], job["mtime"]))
+        try:
+            if job["journal"] is not None:
+                os.remove(job["journal"])
+        except OSError:
+            pass
+
+
+class FTPConnectionPool(ConnectionPool):
+    """
+    Pooled FTP control connections, logged in and switched to binary mode once.
+    """
+
+    default_port = 21
+
+    def __init__(self, max_per_host: int = 4, idle_timeout: float = 60, timeout: float = 30):
+        """
+        Initialize the pool.
+        :param max_per_host: The maximum number of connections open to one host.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        :param timeout: Seconds to wait on the server before giving up.
+        """
+        super().__init__(max_per_host, idle_timeout)
+        self.timeout = timeout
+
+    def open_connection(self, host: str, port: int, username: str, password: str) -> ftplib.FTP:
+        ftp = ftplib.FTP()
+        try:
+            ftp.connect(host, port, timeout=self.timeout)
+            ftp.login(username, password)
+            ftp.voidcmd("TYPE I")
+        except ftplib.all_errors:
+            ftp.close()
+            raise
+        return ftp
+
+    def is_healthy(self, ftp: ftplib.FTP) -> bool:
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except ftplib.all_errors:
+            return False
+
+    def close_connection(self, ftp: ftplib.FTP):
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+
+FTP_JOURNAL_DIR = os.path.join(tempfile.gettempdir(), "ftp_journals")
+
+
+def ftp_journal_path(journal_dir: str, direction: str, host: str, remote_file: str, local_file: str) -> str:
+    """Name the sidecar of a .part file after the transfer, so no transferred directory is written to."""
+    transfer = f"{direction}:{host}:{remote_file}:{os.path.abspath(local_file)}"
+    return os.path.join(journal_dir, f"{hashlib.sha256(transfer.encode()).hexdigest()}.json")
+
+
+def ftp_remote_version(ftp: ftplib.FTP, remote_file: str) -> dict:
+    """The size and, where the server supports MDTM, the modification time of a remote file."""
+    version = {"size": ftp.size(remote_file) or 0}
+    try:
+        version["mtime"] = ftp.voidcmd(f"MDTM {remote_file}")[4:].strip()
+    except ftplib.error_perm:
+        pass
+    return version
+
+
+def ftp_resume_offset(journal: str, version: dict, part_size: int) -> int:
+    """
+    Decide where a .part file continues from: its size, if its sidecar shows it was started
+    from this same version of the source, else zero. A restart records the version it starts from.
+    :param journal: The path of the sidecar.
+    :param version: The size and mtime of the source now.
+    :param part_size: The size of the .part file, 0 if there is none.
+    :return: The offset to continue from.
+    """
+    try:
+        with open(journal) as file:
+            started_from = json.load(file)
+    except (OSError, ValueError):
+        started_from = None
+    if started_from == version and 0 < part_size <= version["size"]:
+        return part_size
+
+    try:
+        os.makedirs(os.path.dirname(journal), exist_ok=True)
+        with open(journal, "w") as file:
+            json.dump(version, file)
+    except OSError as e:
+        print(f"Not journaling the transfer, so it will restart from zero if interrupted: {e}")
+    return 0
+
+
+def ftp_finish_journal(journal: str):
+    try:
+        os.remove(journal)
+    except OSError:
+        pass
+
+
+def ftp_upload(
+    ftp: ftplib.FTP, local_file: str, remote_file: str, blocksize: int = 65536, journal_dir: str = FTP_JOURNAL_DIR
+) -> int:
+    """
+    Upload a file to a .part file on the server and rename it into place. If a .part file
+    is left over from an interrupted upload of the same version of the file, continue it
+    from where it stopped with REST; otherwise start over.
+    :param journal_dir: The directory the size and mtime each .part file was started from are kept in.
+    :return: The number of bytes sent.
+    """
+    part = f"{remote_file}.part"
+    source = os.stat(local_file)
+    try:
+        part_size = ftp.size(part) or 0
+    except ftplib.error_perm:
+        part_size = 0
+    journal = ftp_journal_path(journal_dir, "upload", ftp.host, remote_file, local_file)
+    offset = ftp_resume_offset(journal, {"size": source.st_size, "mtime": int(source.st_mtime)}, part_size)
+    with open(local_file, "rb") as file:
+        file.seek(offset)
+        ftp.storbinary(f"STOR {part}", file, blocksize, rest=offset or None)
+    try:
+        ftp.rename(part, remote_file)
+    except ftplib.error_perm:
+        # Some servers refuse to rename over an existing file
+        ftp.delete(remote_file)
+        ftp.rename(part, remote_file)
+    ftp_finish_journal(journal)
+    return source.st_size - offset
+
+
+def ftp_download(
+    ftp: ftplib.FTP, remote_file: str, local_file: str, blocksize: int = 65536, journal_dir: str = FTP_JOURNAL_DIR
+) -> int:
+    """
+    Download a file to a local .part file and rename it into place. If a .part file is
+    left over from an interrupted download of the same version of the file, continue it
+    from where it stopped with REST; otherwise start over.
+    :param journal_dir: The directory the size and mtime each .part file was started from are kept in.
+    :return: The number of bytes received.
+    """
+    part = f"{local_file}.part"
+    part_size = os.path.getsize(part) if os.path.exists(part) else 0
+    journal = ftp_journal_path(journal_dir, "download", ftp.host, remote_file, local_file)
+    offset = ftp_resume_offset(journal, ftp_remote_version(ftp, remote_file), part_size)
+    received = 0
+    with open(part, "ab" if offset else "wb") as file:
+
+        def write(block: bytes):
+            nonlocal received
+            file.write(block)
+            received += len(block)
+
+        ftp.retrbinary(f"RETR {remote_file}", write, blocksize, rest=offset or None)
+    os.replace(part, local_file)
+    ftp_finish_journal(journal)
+    return received
+
+
+def ftp_transfer_many(
+    pool: FTPConnectionPool,
+    host: str,
+    username: str,
+    password: str,
+    direction: str,
+    pairs: list,
+    workers: int = 4,
+    blocksize: int = 65536,
+    journal_dir: str = FTP_JOURNAL_DIR,
+) -> dict:
+    """
+    Move many files at once, each on a connection borrowed from the pool.
+    :param direction: "upload" or "download".
+    :param pairs: (local_file, remote_file) pairs.
+    :param workers: The number of files transferred at once.
+    :param journal_dir: The directory the size and mtime each .part file was started from are kept in.
+    :return: The transferred and failed files, with bytes moved and seconds taken.
+    """
+
+    def transfer(local_file: str, remote_file: str) -> int:
+        with pool.connection(host, username, password) as ftp:
+            if direction == "upload":
+                return ftp_upload(ftp, local_file, remote_file, blocksize, journal_dir)
+            return ftp_download(ftp, remote_file, local_file, blocksize, journal_dir)
+
+    start = time.monotonic()
+    summary = {"transferred": [], "failed": {}, "bytes": 0}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(transfer, *pair): pair for pair in pairs}
+        for future in as_completed(futures):
+            local_file, remote_file = futures[future]
+            source = local_file if direction == "upload" else remote_file
+            try:
+                summary["bytes"] += future.result()
+                summary["transferred"].append(source)
+            except ftplib.all_errors as e:
+                summary["failed"][source] = str(e)
+
+    summary["seconds"] = round(time.monotonic() - start, 3)
+    print(f"ftp_{direction}:{len(summary['transferred'])} files, {summary['bytes']} bytes in {summary['seconds']}s, {len(summary['failed'])} failed")
+    return summary
@@ -2,18 +2,83 @@ import os
 import requests
 import paramiko
 import ftplib
-from typing import Literal
+import json
+import posixpath
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
-from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint
+from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint, tool_timeout
+from blueprints.network_tools import (
+    FTPConnectionPool,
+    HTTPFetcher,
+    SFTPTransfer,
+    SSHConnectionPool,
+    exec_timeout,
+    fetch_pages,
+    format_exec_result,
+    ftp_download,
+    ftp_transfer_many,
+    ftp_upload,
+    run_coroutine,
+    ssh_exec_on,
+    transfer_timeout,
+)
 
 
 class Pipeline(FunctionCallingBlueprint):
     class Valves(FunctionCallingBlueprint.Valves):
-        pass
+        # Valves for the HTTP fetcher
+        HTTP_CACHE_DIR: str = os.path.join(tempfile.gettempdir(), "http_cache")
+        HTTP_MAX_BYTES: int = 1048576
+        HTTP_MAX_PER_HOST: int = 4
+        HTTP_TIMEOUT: int = 15
+        FETCH_MAX_CHARS: int = 4000
+        # Valves for the pooled SSH/SFTP connections
+        SSH_MAX_SESSIONS_PER_HOST: int = 4
+        SSH_IDLE_TIMEOUT: int = 300
+        SSH_KEEPALIVE: int = 30
+        SSH_CONNECT_TIMEOUT: int = 15
+        # Valves for running commands over SSH
+        SSH_CHANNELS_PER_CONNECTION: int = 8
+        SSH_EXEC_TIMEOUT: int = 60
+        SSH_EXEC_MAX_BYTES: int = 65536
+        SSH_FANOUT_PARALLELISM: int = 16
+        # Valves for SFTP transfers
+        SFTP_TRANSFER_WORKERS: int = 4
+        SFTP_CHUNK_SIZE_MB: int = 8
+        # Where interrupted transfers record their progress, outside the transferred directories
+        SFTP_JOURNAL_DIR: str = os.path.join(tempfile.gettempdir(), "sftp_journals")
+        # Valves for the pooled FTP connections and transfers
+        FTP_MAX_CONNECTIONS_PER_HOST: int = 4
+        FTP_IDLE_TIMEOUT: int = 60
+        FTP_BLOCK_SIZE: int = 65536
+        # Where the source size and mtime of each .part file are recorded, so a changed source restarts
+        FTP_JOURNAL_DIR: str = os.path.join(tempfile.gettempdir(), "ftp_journals")
+        # How long an SFTP or FTP transfer tool may run, instead of TOOL_TIMEOUT
+        TRANSFER_TIMEOUT: int = 600
+        FTP_TRANSFER_WORKERS: int = 4
 
     class Tools:
         def __init__(self, pipeline) -> None:
             self.pipeline = pipeline
+            self.fetcher = HTTPFetcher(
+                pipeline.valves.HTTP_CACHE_DIR,
+                pipeline.valves.HTTP_MAX_BYTES,
+                pipeline.valves.HTTP_MAX_PER_HOST,
+                pipeline.valves.HTTP_TIMEOUT,
+            )
+            self.ssh_pool = SSHConnectionPool(
+                pipeline.valves.SSH_MAX_SESSIONS_PER_HOST,
+                pipeline.valves.SSH_IDLE_TIMEOUT,
+                pipeline.valves.SSH_KEEPALIVE,
+                pipeline.valves.SSH_CHANNELS_PER_CONNECTION,
+                pipeline.valves.SSH_CONNECT_TIMEOUT,
+            )
+            self.ftp_pool = FTPConnectionPool(
+                pipeline.valves.FTP_MAX_CONNECTIONS_PER_HOST,
+                pipeline.valves.FTP_IDLE_TIMEOUT,
+            )
 
         def make_http_request(self, url: str) -> str:
             """
@@ -22,8 +87,7 @@ class Pipeline(FunctionCallingBlueprint):
             :return: The response from the server.
             """
             try:
-                response = requests.get(url)
-                return response.text
+                return self.fetcher.fetch(url)
             except requests.RequestException as e:
                 return f"Error making HTTP request: {str(e)}"
 
@@ -34,11 +98,19 @@ class Pipeline(FunctionCallingBlueprint):
             :return: The response from the server.
             """
             try:
-                response = requests.get(url, verify=False)
-                return response.text
+                return self.fetcher.fetch(url, verify=False)
             except requests.RequestException as e:
                 return f"Error making HTTPS request: {str(e)}"
 
+        def fetch_many(self, urls: List[str]) -> str:
+            """
+            Fetch several web pages at once as readable text. Prefer this over repeated make_http_request calls.
+            :param urls: The URLs to fetch.
+            :return: The text of each page, under its URL.
+            """
+            pages = run_coroutine(fetch_pages(self.fetcher, urls, self.pipeline.valves.FETCH_MAX_CHARS))
+            return "\n\n".join(f"# {url}\n{page}" for url, page in zip(urls, pages))
+
         def connect_to_ssh(self, host: str, username: str, password: str) -> str:
             """
             Connect to an SSH server.
@@ -48,13 +120,58 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the connection is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=host, username=username, password=password)
-                return f"Connected to SSH server {host} as {username}"
+                with self.ssh_pool.connection(host, username, password):
+                    return f"Connected to SSH server {host} as {username}"
             except paramiko.SSHException as e:
                 return f"Error connecting to SSH server: {str(e)}"
 
+        @tool_timeout(exec_timeout)
+        def ssh_exec(self, host: str, username: str, password: str, command: str) -> str:
+            """
+            Run a command on an SSH server.
+            :param host: The hostname or IP address of the SSH server.
+            :param username: The username to use for the SSH connection.
+            :param password: The password to use for the SSH connection.
+            :param command: The command to run.
+            :return: The command's exit status and output.
+            """
+            result = ssh_exec_on(
+                self.ssh_pool,
+                host,
+                username,
+                password,
+                command,
+                self.pipeline.valves.SSH_EXEC_TIMEOUT,
+                self.pipeline.valves.SSH_EXEC_MAX_BYTES,
+            )
+            return format_exec_result(result)
+
+        @tool_timeout(exec_timeout)
+        def ssh_exec_many(self, hosts: List[str], username: str, password: str, command: str) -> str:
+            """
+            Run the same command on several SSH servers at once. Prefer this over repeated ssh_exec calls.
+            :param hosts: The hostnames or IP addresses of the SSH servers.
+            :param username: The username to use for the SSH connections.
+            :param password: The password to use for the SSH connections.
+            :param command: The command to run.
+            :return: Each server's exit status and output.
+            """
+            with ThreadPoolExecutor(max_workers=max(self.pipeline.valves.SSH_FANOUT_PARALLELISM, 1)) as executor:
+                results = executor.map(
+                    lambda host: ssh_exec_on(
+                        self.ssh_pool,
+                        host,
+                        username,
+                        password,
+                        command,
+                        self.pipeline.valves.SSH_EXEC_TIMEOUT,
+                        self.pipeline.valves.SSH_EXEC_MAX_BYTES,
+                    ),
+                    hosts,
+                )
+                return "\n\n".join(format_exec_result(result) for result in results)
+
+        @tool_timeout(transfer_timeout)
         def upload_file_via_sftp(self, host: str, username: str, password: str, local_file: str, remote_file: str) -> str:
             """
             Upload a file via SFTP.
@@ -66,17 +183,51 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the upload is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username=username, password=password)
-                sftp = ssh.open_sftp()
-                sftp.put(local_file, remote_file)
-                sftp.close()
-                ssh.close()
-                return f"Uploaded file '{local_file}' to '{remote_file}'"
-            except paramiko.SSHException as e:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.upload(local_file, remote_file)
+            except (paramiko.SSHException, IOError) as e:
                 return f"Error uploading file: {str(e)}"
+            if summary["failed"]:
+                return f"Error uploading file: {summary['failed'][local_file]}"
+            if summary["skipped"]:
+                return f"'{remote_file}' is already up to date with '{local_file}'"
+            return f"Uploaded file '{local_file}' to '{remote_file}'"
+
+        @tool_timeout(transfer_timeout)
+        def upload_directory_via_sftp(self, host: str, username: str, password: str, local_dir: str, remote_dir: str) -> str:
+            """
+            Upload a directory and everything under it via SFTP, skipping files already up to date.
+            :param host: The hostname or IP address of the SFTP server.
+            :param username: The username to use for the SFTP connection.
+            :param password: The password to use for the SFTP connection.
+            :param local_dir: The local directory to upload.
+            :param remote_dir: The remote directory to upload to.
+            :return: A summary of the files uploaded, skipped and failed.
+            """
+            try:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.upload_directory(local_dir, remote_dir)
+            except (paramiko.SSHException, IOError) as e:
+                return f"Error uploading directory: {str(e)}"
+            return f"Uploaded '{local_dir}' to '{remote_dir}': {json.dumps(summary)}"
 
+        @tool_timeout(transfer_timeout)
         def download_file_via_sftp(self, host: str, username: str, password: str, remote_file: str, local_file: str) -> str:
             """
             Download a file via SFTP.
@@ -88,16 +239,49 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the download is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username=username, password=password)
-                sftp = ssh.open_sftp()
-                sftp.get(remote_file, local_file)
-                sftp.close()
-                ssh.close()
-                return f"Downloaded file '{remote_file}' to '{local_file}'"
-            except paramiko.SSHException as e:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.download(remote_file, local_file)
+            except (paramiko.SSHException, IOError) as e:
                 return f"Error downloading file: {str(e)}"
+            if summary["failed"]:
+                return f"Error downloading file: {summary['failed'][remote_file]}"
+            if summary["skipped"]:
+                return f"'{local_file}' is already up to date with '{remote_file}'"
+            return f"Downloaded file '{remote_file}' to '{local_file}'"
+
+        @tool_timeout(transfer_timeout)
+        def download_directory_via_sftp(self, host: str, username: str, password: str, remote_dir: str, local_dir: str) -> str:
+            """
+            Download a remote directory and everything under it via SFTP, skipping files already up to date.
+            :param host: The hostname or IP address of the SFTP server.
+            :param username: The username to use for the SFTP connection.
+            :param password: The password to use for the SFTP connection.
+            :param remote_dir: The remote directory to download.
+            :param local_dir: The local directory to save the download to.
+            :return: A summary of the files downloaded, skipped and failed.
+            """
+            try:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.download_directory(remote_dir, local_dir)
+            except (paramiko.SSHException, IOError) as e:
+                return f"Error downloading directory: {str(e)}"
+            return f"Downloaded '{remote_dir}' to '{local_dir}': {json.dumps(summary)}"
 
         def connect_to_ftp(self, host: str, username: str, password: str) -> str:
             """
@@ -108,12 +292,12 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the connection is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                return f"Connected to FTP server {host} as {username}"
+                with self.ftp_pool.connection(host, username, password):
+                    return f"Connected to FTP server {host} as {username}"
             except ftplib.all_errors as e:
                 return f"Error connecting to FTP server: {str(e)}"
 
+        @tool_timeout(transfer_timeout)
         def upload_file_via_ftp(self, host: str, username: str, password: str, local_file: str, remote_file: str) -> str:
             """
             Upload a file via FTP.
@@ -125,14 +309,40 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the upload is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                with open(local_file, 'rb') as file:
-                    ftp.storbinary(f"STOR {remote_file}", file)
+                with self.ftp_pool.connection(host, username, password) as ftp:
+                    ftp_upload(
+                        ftp, local_file, remote_file, self.pipeline.valves.FTP_BLOCK_SIZE, self.pipeline.valves.FTP_JOURNAL_DIR
+                    )
                 return f"Uploaded file '{local_file}' to '{remote_file}'"
             except ftplib.all_errors as e:
                 return f"Error uploading file: {str(e)}"
 
+        @tool_timeout(transfer_timeout)
+        def upload_files_via_ftp(self, host: str, username: str, password: str, local_files: List[str], remote_dir: str) -> str:
+            """
+            Upload several files via FTP at once. Prefer this over repeated upload_file_via_ftp calls.
+            :param host: The hostname or IP address of the FTP server.
+            :param username: The username to use for the FTP connection.
+            :param password: The password to use for the FTP connection.
+            :param local_files: The local files to upload.
+            :param remote_dir: The remote directory to upload them to.
+            :return: A summary of the files uploaded and failed.
+            """
+            pairs = [(local_file, posixpath.join(remote_dir, os.path.basename(local_file))) for local_file in local_files]
+            summary = ftp_transfer_many(
+                self.ftp_pool,
+                host,
+                username,
+                password,
+                "upload",
+                pairs,
+                self.pipeline.valves.FTP_TRANSFER_WORKERS,
+                self.pipeline.valves.FTP_BLOCK_SIZE,
+                self.pipeline.valves.FTP_JOURNAL_DIR,
+            )
+            return f"Uploaded files to '{remote_dir}': {json.dumps(summary)}"
+
+        @tool_timeout(transfer_timeout)
         def download_file_via_ftp(self, host: str, username: str, password: str, remote_file: str, local_file: str) -> str:
             """
             Download a file via FTP.
@@ -144,14 +354,40 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the download is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                with open(local_file, 'wb') as file:
-                    ftp.retrbinary(f"RETR {remote_file}", file.write)
+                with self.ftp_pool.connection(host, username, password) as ftp:
+                    ftp_download(
+                        ftp, remote_file, local_file, self.pipeline.valves.FTP_BLOCK_SIZE, self.pipeline.valves.FTP_JOURNAL_DIR
+                    )
                 return f"Downloaded file '{remote_file}' to '{local_file}'"
             except ftplib.all_errors as e:
                 return f"Error downloading file: {str(e)}"
 
+        @tool_timeout(transfer_timeout)
+        def download_files_via_ftp(self, host: str, username: str, password: str, remote_files: List[str], local_dir: str) -> str:
+            """
+            Download several files via FTP at once. Prefer this over repeated download_file_via_ftp calls.
+            :param host: The hostname or IP address of the FTP server.
+            :param username: The username to use for the FTP connection.
+            :param password: The password to use for the FTP connection.
+            :param remote_files: The remote files to download.
+            :param local_dir: The local directory to save them to.
+            :return: A summary of the files downloaded and failed.
+            """
+            os.makedirs(local_dir, exist_ok=True)
+            pairs = [(os.path.join(local_dir, posixpath.basename(remote_file)), remote_file) for remote_file in remote_files]
+            summary = ftp_transfer_many(
+                self.ftp_pool,
+                host,
+                username,
+                password,
+                "download",
+                pairs,
+                self.pipeline.valves.FTP_TRANSFER_WORKERS,
+                self.pipeline.valves.FTP_BLOCK_SIZE,
+                self.pipeline.valves.FTP_JOURNAL_DIR,
+            )
+            return f"Downloaded files to '{local_dir}': {json.dumps(summary)}"
+
     def __init__(self):
         super().__init__()
         self.name = "My Tools Pipeline"
@@ -159,6 +395,67 @@ class Pipeline(FunctionCallingBlueprint):
             **{
                 **self.valves.model_dump(),
                 "pipelines": ["*"],  # Connect to all pipelines
+                "HTTP_CACHE_DIR": os.getenv(
+                    "HTTP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "http_cache")
+                ),
+                "HTTP_MAX_BYTES": int(os.getenv("HTTP_MAX_BYTES", 1048576)),
+                "HTTP_MAX_PER_HOST": int(os.getenv("HTTP_MAX_PER_HOST", 4)),
+                "HTTP_TIMEOUT": int(os.getenv("HTTP_TIMEOUT", 15)),
+                "FETCH_MAX_CHARS": int(os.getenv("FETCH_MAX_CHARS", 4000)),
+                "SSH_MAX_SESSIONS_PER_HOST": int(os.getenv("SSH_MAX_SESSIONS_PER_HOST", 4)),
+                "SSH_IDLE_TIMEOUT": int(os.getenv("SSH_IDLE_TIMEOUT", 300)),
+                "SSH_KEEPALIVE": int(os.getenv("SSH_KEEPALIVE", 30)),
+                "SSH_CONNECT_TIMEOUT": int(os.getenv("SSH_CONNECT_TIMEOUT", 15)),
+                "SSH_CHANNELS_PER_CONNECTION": int(os.getenv("SSH_CHANNELS_PER_CONNECTION", 8)),
+                "SSH_EXEC_TIMEOUT": int(os.getenv("SSH_EXEC_TIMEOUT", 60)),
+                "SSH_EXEC_MAX_BYTES": int(os.getenv("SSH_EXEC_MAX_BYTES", 65536)),
+                "SSH_FANOUT_PARALLELISM": int(os.getenv("SSH_FANOUT_PARALLELISM", 16)),
+                "SFTP_TRANSFER_WORKERS": int(os.getenv("SFTP_TRANSFER_WORKERS", 4)),
+                "SFTP_CHUNK_SIZE_MB": int(os.getenv("SFTP_CHUNK_SIZE_MB", 8)),
+                "SFTP_JOURNAL_DIR": os.getenv(
+                    "SFTP_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "sftp_journals")
+                ),
+                "FTP_MAX_CONNECTIONS_PER_HOST": int(os.getenv("FTP_MAX_CONNECTIONS_PER_HOST", 4)),
+                "FTP_IDLE_TIMEOUT": int(os.getenv("FTP_IDLE_TIMEOUT", 60)),
+                "FTP_BLOCK_SIZE": int(os.getenv("FTP_BLOCK_SIZE", 65536)),
+                "FTP_JOURNAL_DIR": os.getenv(
+                    "FTP_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "ftp_journals")
+                ),
+                "TRANSFER_TIMEOUT": int(os.getenv("TRANSFER_TIMEOUT", 600)),
+                "FTP_TRANSFER_WORKERS": int(os.getenv("FTP_TRANSFER_WORKERS", 4)),
             },
         )
         self.tools = self.Tools(self)
+
+    async def on_valves_updated(self):
+        await super().on_valves_updated()
+        # The fetcher and pools size themselves from the valves, so they are built again
+        self.tools.fetcher.close()
+        self.tools.fetcher = HTTPFetcher(
+            self.valves.HTTP_CACHE_DIR,
+            self.valves.HTTP_MAX_BYTES,
+            self.valves.HTTP_MAX_PER_HOST,
+            self.valves.HTTP_TIMEOUT,
+        )
+        self.tools.ssh_pool.close()
+        self.tools.ssh_pool = SSHConnectionPool(
+            self.valves.SSH_MAX_SESSIONS_PER_HOST,
+            self.valves.SSH_IDLE_TIMEOUT,
+            self.valves.SSH_KEEPALIVE,
+            self.valves.SSH_CHANNELS_PER_CONNECTION,
+            self.valves.SSH_CONNECT_TIMEOUT,
+        )
+        self.tools.ftp_pool.close()
+        self.tools.ftp_pool = FTPConnectionPool(
+            self.valves.FTP_MAX_CONNECTIONS_PER_HOST,
+            self.valves.FTP_IDLE_TIMEOUT,
+        )
+
+    async def on_shutdown(self):
+        await super().on_shutdown()
+        print(f"http_fetcher:{self.tools.fetcher.stats}")
+        print(f"ssh_pool:{self.tools.ssh_pool.stats}")
+        print(f"ftp_pool:{self.tools.ftp_pool.stats}")
+        self.tools.fetcher.close()
+        self.tools.ssh_pool.close()
+        self.tools.ftp_pool.close()
@@ -1,20 +1,786 @@
 import os
+import re
+import ast
+import math
+import mmap
+import fnmatch
+import hashlib
+import sqlite3
+import shutil
+import string
+import tempfile
+import threading
+import time
 import requests
-from typing import Literal
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, reduce
+from typing import Iterable, List, Literal, Optional, Union
 from datetime import datetime
 
-from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from blueprints.function_calling_blueprint import (
+    Pipeline as FunctionCallingBlueprint,
+    cache_tool,
+    warm_tool,
+)
+
+
+def file_version(tools, file_name: str, **kwargs) -> tuple:
+    """Cache version of a file tool call: the file's mtime and size."""
+    stat = os.stat(os.path.join(os.getcwd(), file_name))
+    return stat.st_mtime_ns, stat.st_size
+
+
+def count_lines(buffer, start: int, end: int, chunk_size: int = 1 << 20) -> int:
+    """Count the newlines in buffer[start:end] without copying more than one chunk at a time."""
+    count = 0
+    for position in range(start, end, chunk_size):
+        count += buffer[position : min(position + chunk_size, end)].count(b"\n")
+    return count
+
+
+def line_start(buffer, line: int) -> int:
+    """Return the byte offset of a 1-based line number, or the buffer size past the end."""
+    position = 0
+    for _ in range(line - 1):
+        position = buffer.find(b"\n", position)
+        if position == -1:
+            return len(buffer)
+        position += 1
+    return position
+
+
+def tail_start(buffer, lines: int) -> int:
+    """Return the byte offset of the last `lines` lines."""
+    position = len(buffer)
+    if position and buffer[position - 1 : position] == b"\n":
+        position -= 1
+    for _ in range(lines):
+        position = buffer.rfind(b"\n", 0, position)
+        if position == -1:
+            return 0
+    return position + 1
+
+
+def search_buffer(buffer, pattern: str, max_bytes: int, flags: int = 0) -> tuple:
+    """
+    Find the lines matching a regex in a buffer.
+    :return: The matching lines prefixed with their line numbers, and the number of matches.
+    """
+    regex = re.compile(pattern.encode("utf-8"), re.MULTILINE | flags)
+    lines, size, matches = [], 0, 0
+    line_number, counted_to, last_line = 1, 0, -1
+    for match in regex.finditer(buffer):
+        start = buffer.rfind(b"\n", 0, match.start()) + 1
+        if start == last_line:
+            continue
+        end = buffer.find(b"\n", match.end())
+        end = len(buffer) if end == -1 else end
+
+        line_number += count_lines(buffer, counted_to, start)
+        counted_to, last_line = start, start
+        matches += 1
+
+        line = f"{line_number}: " + buffer[start:end].decode("utf-8", errors="replace")
+        if size + len(line) > max_bytes:
+            lines.append("... (more matches, narrow the pattern or page with offset)")
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines), matches
+
+
+class DirectoryIndex:
+    """
+    Cached directory listings, rescanned when a directory's mtime changes or a tool writes to it.
+    Editing a file in place doesn't change its directory's mtime, so the tools that write
+    invalidate the directory themselves; in-place edits made outside the tools show up once
+    something is added to or removed from the directory.
+    """
+
+    def __init__(self):
+        # path -> (directory mtime, [(name, is_dir, size, mtime)])
+        self.directories = {}
+        self.stats = {"reused": 0, "scanned": 0}
+
+    def entries(self, path: str) -> list:
+        """
+        Return the entries of a directory, from the index if it has not changed.
+        :param path: The absolute path of the directory.
+        :return: A list of (name, is_dir, size, mtime) tuples.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.directories.get(path)
+        if cached is not None and cached[0] == mtime:
+            self.stats["reused"] += 1
+            return cached[1]
+
+        entries = []
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entries.append((entry.name, is_dir, 0 if is_dir else stat.st_size, stat.st_mtime))
+
+        self.directories[path] = (mtime, entries)
+        self.stats["scanned"] += 1
+        return entries
+
+    def invalidate(self, path: str):
+        """
+        Drop the cached listings of the directory holding path, and of path if it is a directory.
+        :param path: The absolute path of a file or directory that was written, created or deleted.
+        """
+        path = os.path.normpath(path)
+        self.directories.pop(os.path.dirname(path), None)
+        self.directories.pop(path, None)
+
+    def walk(self, root: str, recursive: bool, hidden: bool = True):
+        """
+        Yield (relative path, is_dir, size, mtime) for everything under root.
+        :param root: The absolute path of the directory to list.
+        :param recursive: Whether to descend into subdirectories.
+        :param hidden: Whether to include, and descend into, entries whose name starts with a dot.
+        """
+        pending = [("", root)]
+        while pending:
+            relative, path = pending.pop()
+            try:
+                entries = self.entries(path)
+            except OSError:
+                # The directory vanished or is unreadable
+                self.directories.pop(path, None)
+                continue
+            for name, is_dir, size, mtime in entries:
+                if not hidden and name.startswith("."):
+                    continue
+                relative_name = os.path.join(relative, name)
+                yield relative_name, is_dir, size, mtime
+                if recursive and is_dir:
+                    pending.append((relative_name, os.path.join(path, name)))
+
+
+QUANTIFIER = re.compile(r"\{\d*(,\d*)?\}")
+
+
+def class_end(pattern: str, start: int) -> int:
+    """Return the index of the ] closing the character class opened at start."""
+    i = start + 1
+    if pattern[i : i + 1] == "^":
+        i += 1
+    # A ] right after the opening bracket is part of the class
+    if pattern[i : i + 1] == "]":
+        i += 1
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+        if pattern[i] == "]":
+            return i
+        i += 1
+    return len(pattern)
+
+
+def escape_end(pattern: str, start: int) -> int:
+    """Return the index of the last character of the alphanumeric escape whose letter is at start."""
+    char = pattern[start]
+    if char in "xuU":
+        digits = {"x": 2, "u": 4, "U": 8}[char]
+        end = start
+        while end - start < digits and end + 1 < len(pattern) and pattern[end + 1] in string.hexdigits:
+            end += 1
+        return end
+    if char == "N" and pattern[start + 1 : start + 2] == "{":
+        close = pattern.find("}", start)
+        return len(pattern) - 1 if close == -1 else close
+    if char.isdigit():
+        # Octal escapes take up to three digits, backreferences up to two
+        end = start
+        while end - start < 2 and end + 1 < len(pattern) and pattern[end + 1].isdigit():
+            end += 1
+        return end
+    return start
+
+
+def required_literals(pattern: str) -> list:
+    """
+    Extract literal runs that every match of a regex must contain, for trigram prefiltering.
+    Only top-level, unquantified literals are used; patterns with alternation return nothing.
+    Character classes and the bodies of {m,n} quantifiers are never taken as literals.
+    """
+    if "|" in pattern:
+        return []
+
+    runs, run, depth, i = [], "", 0, 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == "\\" and i + 1 < len(pattern):
+            i += 1
+            if not pattern[i].isalnum():
+                literal = pattern[i]
+            else:
+                # Classes, anchors, backreferences and character codes end the run, with their arguments
+                i = escape_end(pattern, i)
+        elif char == "[":
+            i = class_end(pattern, i)
+        elif char == "{":
+            braces = QUANTIFIER.match(pattern, i)
+            if braces:
+                i = braces.end() - 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char not in ".^$*+?{}" and depth == 0:
+            literal = char
+
+        quantifier = pattern[i + 1] if i + 1 < len(pattern) else ""
+        if literal is not None and quantifier not in ("?", "*", "{"):
+            run += literal
+            if quantifier != "+":
+                i += 1
+                continue
+        runs.append(run)
+        run = ""
+        i += 1
+    runs.append(run)
+    return [run for run in runs if len(run) >= 3]
+
+
+class TrigramIndex:
+    """
+    Persistent trigram index over the text files under a directory, stored in SQLite and
+    updated incrementally from file mtimes and sizes. Files are found through a DirectoryIndex,
+    so only directories whose mtime changed are listed again, but every file is stat'ed on
+    update so that edits made in place are reindexed too.
+    """
+
+    MAX_FILE_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, root: str, index_dir: str, directory_index: DirectoryIndex):
+        """
+        Initialize the index.
+        :param root: The directory to index.
+        :param index_dir: The directory the index file is stored in, one file per root.
+        :param directory_index: The listings to find the files with.
+        """
+        self.root = root
+        self.index_dir = index_dir
+        self.path = os.path.join(index_dir, f"{hashlib.sha256(root.encode()).hexdigest()[:16]}.sqlite3")
+        self.directory_index = directory_index
+
+    def connect(self) -> sqlite3.Connection:
+        """Open the index database, creating its tables if needed."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS trigrams (
+                trigram TEXT, file_id INTEGER, PRIMARY KEY (trigram, file_id)
+            ) WITHOUT ROWID;
+            """
+        )
+        return conn
+
+    @staticmethod
+    def trigrams(text: str) -> set:
+        """Return the set of lowercased trigrams of a text."""
+        text = text.lower()
+        return {text[i : i + 3] for i in range(len(text) - 2)}
+
+    def read_text(self, path: str) -> Optional[str]:
+        """Read a file for indexing, skipping binary and oversized files."""
+        with open(path, "rb") as file:
+            data = file.read(self.MAX_FILE_SIZE + 1)
+        if len(data) > self.MAX_FILE_SIZE or b"\0" in data[:8192]:
+            return None
+        return data.decode("utf-8", errors="ignore")
+
+    def update(self, conn: sqlite3.Connection) -> dict:
+        """
+        Reindex the files whose mtime or size changed and drop the files that are gone.
+        :return: The number of files added, updated, removed and unchanged.
+        """
+        indexed = {
+            path: (file_id, mtime, size)
+            for file_id, path, mtime, size in conn.execute(
+                "SELECT id, path, mtime, size FROM files"
+            )
+        }
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+
+        for relative, is_dir, size, mtime in self.directory_index.walk(self.root, True, hidden=False):
+            if is_dir:
+                continue
+            seen.add(relative)
+
+            # The listing keeps the size and mtime a file had when its directory was scanned
+            file_path = os.path.join(self.root, relative)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            mtime, size = stat.st_mtime, stat.st_size
+
+            current = indexed.get(relative)
+            if current is not None and current[1:] == (mtime, size):
+                stats["unchanged"] += 1
+                continue
+
+            try:
+                text = self.read_text(file_path)
+            except OSError:
+                continue
+
+            with conn:
+                if current is not None:
+                    conn.execute("DELETE FROM trigrams WHERE file_id = ?", (current[0],))
+                    conn.execute(
+                        "UPDATE files SET mtime = ?, size = ? WHERE id = ?",
+                        (mtime, size, current[0]),
+                    )
+                    file_id = current[0]
+                    stats["updated"] += 1
+                else:
+                    file_id = conn.execute(
+                        "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)",
+                        (relative, mtime, size),
+                    ).lastrowid
+                    stats["added"] += 1
+                if text:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO trigrams (trigram, file_id) VALUES (?, ?)",
+                        ((trigram, file_id) for trigram in self.trigrams(text)),
+                    )
+
+        removed = [(file_id,) for path, (file_id, _, _) in indexed.items() if path not in seen]
+        if removed:
+            with conn:
+                conn.executemany("DELETE FROM trigrams WHERE file_id = ?", removed)
+                conn.executemany("DELETE FROM files WHERE id = ?", removed)
+        stats["removed"] = len(removed)
+        return stats
+
+    def candidates(self, conn: sqlite3.Connection, literals: list) -> list:
+        """
+        Return the indexed files containing every trigram of the literals.
+        Without literals, every indexed file is a candidate.
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams |= self.trigrams(literal)
+
+        if not trigrams:
+            return [path for (path,) in conn.execute("SELECT path FROM files ORDER BY path")]
+
+        placeholders = ",".join("?" * len(trigrams))
+        return [
+            path
+            for (path,) in conn.execute(
+                f"""
+                SELECT files.path FROM trigrams JOIN files ON files.id = trigrams.file_id
+                WHERE trigram IN ({placeholders})
+                GROUP BY trigrams.file_id HAVING COUNT(*) = ?
+                ORDER BY files.path
+                """,
+                (*trigrams, len(trigrams)),
+            )
+        ]
+
+
+class AtomicWriter:
+    """
+    Writes files through a temp file and os.replace, so readers never see a partial file.
+    Appends are written to the file in place. Writes queued behind another write to the
+    same path are applied together in one flush.
+    """
+
+    def __init__(self, coalesce_ms: float = 20):
+        """
+        Initialize the writer.
+        :param coalesce_ms: How long a write with others queued behind it waits for more writes to the path.
+        """
+        self.coalesce_ms = coalesce_ms
+        self.lock = threading.Lock()
+        # path -> [(append, chunks, future)] waiting for the next flush
+        self.pending = {}
+        # path -> [lock held while a flush writes the file, number of writers using it]
+        self.path_locks = {}
+        # New files get the mode open() would give them, which temp files don't
+        umask = os.umask(0)
+        os.umask(umask)
+        self.new_file_mode = 0o666 & ~umask
+        self.stats = {"writes": 0, "flushes": 0}
+
+    def write(self, path: str, chunks: Union[str, bytes, Iterable], append: bool = False):
+        """
+        Write to a file atomically, blocking until the write is on disk.
+        :param path: The path of the file.
+        :param chunks: The content, or an iterable of str/bytes chunks to stream into the file.
+        :param append: Whether to append to the existing content instead of replacing it.
+        """
+        if isinstance(chunks, (str, bytes)):
+            chunks = [chunks]
+
+        future = Future()
+        with self.lock:
+            self.stats["writes"] += 1
+            queue = self.pending.get(path)
+            leader = queue is None
+            if leader:
+                queue = self.pending[path] = []
+                path_lock = self.path_locks.setdefault(path, [threading.Lock(), 0])
+                path_lock[1] += 1
+            queue.append((append, chunks, future))
+
+        if leader:
+            # The first writer flushes the whole queue, once any flush already writing the path is done
+            with path_lock[0]:
+                with self.lock:
+                    burst = len(self.pending[path]) > 1
+                if burst and self.coalesce_ms > 0:
+                    # Others are writing the path too, so give the burst a moment to finish
+                    time.sleep(self.coalesce_ms / 1000)
+                with self.lock:
+                    operations = self.pending.pop(path)
+                self.flush(path, operations)
+            with self.lock:
+                path_lock[1] -= 1
+                if path_lock[1] == 0:
+                    del self.path_locks[path]
+
+        return future.result()
+
+    def flush(self, path: str, operations: list):
+        """Apply queued writes, in order, appending in place or through a temp file moved over the path."""
+        # Everything before the last full write is overwritten anyway
+        start = 0
+        for i, (append, _, _) in enumerate(operations):
+            if not append:
+                start = i
+
+        temp = None
+        try:
+            if operations[start][0]:
+                # Only appends: nothing is replaced, so write them to the end of the file
+                with open(path, "ab") as file:
+                    for _, chunks, _ in operations[start:]:
+                        for chunk in chunks:
+                            file.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            else:
+                with tempfile.NamedTemporaryFile(
+                    "wb", dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp", delete=False
+                ) as temp:
+                    for _, chunks, _ in operations[start:]:
+                        for chunk in chunks:
+                            temp.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+                if os.path.exists(path):
+                    shutil.copymode(path, temp.name)
+                else:
+                    os.chmod(temp.name, self.new_file_mode)
+                os.replace(temp.name, path)
+            self.stats["flushes"] += 1
+        except Exception as e:
+            if temp is not None and os.path.exists(temp.name):
+                os.remove(temp.name)
+            for _, _, future in operations:
+                future.set_exception(e)
+            return
+
+        for _, _, future in operations:
+            future.set_result(True)
+
+
+MAX_EXPRESSION_LENGTH = 1000
+MAX_EXPONENT = 10000
+MAX_RESULT_BITS = 4096
+
+BINARY_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+    ast.FloorDiv: lambda a, b: a // b,
+    ast.Mod: lambda a, b: a % b,
+    ast.Pow: lambda a, b: a**b,
+}
+UNARY_OPERATORS = {ast.UAdd: lambda a: +a, ast.USub: lambda a: -a}
+CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau}
+# name -> (scalar function, vectorized function name in numpy)
+FUNCTIONS = {
+    "abs": (abs, "abs"),
+    "sqrt": (math.sqrt, "sqrt"),
+    "exp": (math.exp, "exp"),
+    "log": (math.log, "log"),
+    "log10": (math.log10, "log10"),
+    "log2": (math.log2, "log2"),
+    "sin": (math.sin, "sin"),
+    "cos": (math.cos, "cos"),
+    "tan": (math.tan, "tan"),
+    "asin": (math.asin, "arcsin"),
+    "acos": (math.acos, "arccos"),
+    "atan": (math.atan, "arctan"),
+    "floor": (math.floor, "floor"),
+    "ceil": (math.ceil, "ceil"),
+    "round": (round, "round"),
+    "min": (min, "minimum"),
+    "max": (max, "maximum"),
+}
+# numpy functions of exactly two arrays, folded pairwise over calls with more arguments
+PAIRWISE_FUNCTIONS = {"minimum", "maximum"}
+
+
+def check_size(value):
+    """Reject integer results too large to compute or print in bounded time."""
+    if isinstance(value, int) and value.bit_length() > MAX_RESULT_BITS:
+        raise ValueError(f"Result exceeds {MAX_RESULT_BITS} bits")
+    return value
+
+
+def power(base, exponent):
+    """Exponentiation that refuses to build huge integers, e.g. 9**9**9."""
+    if np is not None and isinstance(exponent, np.ndarray):
+        return base**exponent
+    if abs(exponent) > MAX_EXPONENT:
+        raise ValueError(f"Exponent {exponent} exceeds {MAX_EXPONENT}")
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 0:
+        if max(abs(base), 1).bit_length() * exponent > MAX_RESULT_BITS * 2:
+            raise ValueError(f"Result exceeds {MAX_RESULT_BITS} bits")
+    return base**exponent
+
+
+def compile_node(node):
+    """Compile an AST node into a function of (variables, vectorized)."""
+    if isinstance(node, ast.Expression):
+        return compile_node(node.body)
+
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        value = node.value
+        return lambda variables, vectorized: value
+
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name in CONSTANTS:
+            value = CONSTANTS[name]
+            return lambda variables, vectorized: value
+        if name == "x":
+
+            def variable(variables, vectorized):
+                if "x" not in variables:
+                    raise ValueError("x can only be used when values are given")
+                return variables["x"]
+
+            return variable
+        raise ValueError(f"Unknown name '{name}'")
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        left, right = compile_node(node.left), compile_node(node.right)
+        operator = power if isinstance(node.op, ast.Pow) else BINARY_OPERATORS[type(node.op)]
+        return lambda variables, vectorized: check_size(
+            operator(left(variables, vectorized), right(variables, vectorized))
+        )
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        operand = compile_node(node.operand)
+        operator = UNARY_OPERATORS[type(node.op)]
+        return lambda variables, vectorized: operator(operand(variables, vectorized))
+
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in FUNCTIONS
+        and not node.keywords
+    ):
+        scalar, vector = FUNCTIONS[node.func.id]
+        arguments = [compile_node(argument) for argument in node.args]
+
+        def call(variables, vectorized):
+            values = [argument(variables, vectorized) for argument in arguments]
+            if not vectorized:
+                return check_size(scalar(*values))
+            function = getattr(np, vector)
+            if vector in PAIRWISE_FUNCTIONS:
+                # np.maximum(a, b, c) would take c as the output array
+                return check_size(reduce(function, values))
+            return check_size(function(*values))
+
+        return call
+
+    raise ValueError(f"Unsupported expression: {ast.dump(node)[:80]}")
+
+
+@lru_cache(maxsize=512)
+def compile_expression(equation: str):
+    """Parse and compile an arithmetic expression, caching the compiled form."""
+    if len(equation) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"Expression longer than {MAX_EXPRESSION_LENGTH} characters")
+    return compile_node(ast.parse(equation.strip(), mode="eval"))
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by the threads calling a rate-limited API.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Initialize the bucket, full.
+        :param rate_per_minute: The number of requests allowed per minute.
+        :param capacity: The largest burst allowed. Defaults to the per-minute rate.
+        """
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(rate_per_minute, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate if self.rate > 0 else 1
+            time.sleep(wait)
+
+
+class WeatherClient:
+    """
+    OpenWeatherMap client over a pooled session, with a long-lived location to city id
+    cache, a short-lived observation cache per city and a rate limit.
+    """
+
+    def __init__(self, base_url: str, rate_per_minute: float, observation_ttl: float, pool_size: int = 8):
+        """
+        Initialize the client.
+        :param base_url: The OpenWeatherMap API base URL.
+        :param rate_per_minute: The provider's request limit.
+        :param observation_ttl: How long an observation is reused, in seconds.
+        :param pool_size: The number of pooled connections and concurrent lookups.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.observation_ttl = observation_ttl
+        self.pool_size = pool_size
+        self.bucket = TokenBucket(rate_per_minute)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        # normalized location -> city id
+        self.city_ids = {}
+        # (city id, units) -> (expires at, observation)
+        self.observations = {}
+        self.stats = {"requests": 0, "cached": 0}
+
+    def get(self, location: str, units: str, api_key: str) -> dict:
+        """
+        Get the current observation for a location.
+        :return: The OpenWeatherMap /weather response.
+        """
+        key = " ".join(location.lower().split())
+        with self.lock:
+            city_id = self.city_ids.get(key)
+            cached = self.observations.get((city_id, units)) if city_id else None
+        if cached and cached[0] > time.monotonic():
+            self.stats["cached"] += 1
+            return cached[1]
+
+        params = {"appid": api_key, "units": units}
+        if city_id:
+            params["id"] = city_id
+        else:
+            params["q"] = location
+
+        self.bucket.acquire()
+        self.stats["requests"] += 1
+        response = self.session.get(f"{self.base_url}/weather", params=params, timeout=10)
+        response.raise_for_status()  # Raises an HTTPError for bad responses
+        data = response.json()
+
+        with self.lock:
+            if data.get("id"):
+                self.city_ids[key] = data["id"]
+                self.observations[(data["id"], units)] = (
+                    time.monotonic() + self.observation_ttl,
+                    data,
+                )
+        return data
+
+    def get_many(self, locations: List[str], units: str, api_key: str) -> list:
+        """
+        Get the observations for several locations concurrently.
+        :return: One observation or exception per location, in order.
+        """
+
+        def get(location):
+            try:
+                return self.get(location, units, api_key)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(len(locations), self.pool_size) or 1) as executor:
+            return list(executor.map(get, locations))
+
+    def close(self):
+        """Close the pooled session."""
+        self.session.close()
+
+
+def format_weather(location: str, data: dict, unit: str) -> str:
+    """Format an OpenWeatherMap observation the way the weather tools report it."""
+    weather_description = data["weather"][0]["description"]
+    temperature = data["main"]["temp"]
+    return f"{location}: {weather_description.capitalize()}, {temperature}°{unit.capitalize()[0]}"
+
+
+def warm_weather(tools):
+    """Open a pooled connection to the weather API before the tool is called."""
+    tools.weather.session.head(tools.weather.base_url, timeout=5)
 
 
 class Pipeline(FunctionCallingBlueprint):
     class Valves(FunctionCallingBlueprint.Valves):
         # Add your custom parameters here
         OPENWEATHERMAP_API_KEY: str = ""
+        OPENWEATHERMAP_BASE_URL: str = "http://api.openweathermap.org/data/2.5"
+        # Provider request limit, and how long an observation is reused
+        OPENWEATHERMAP_RATE_PER_MINUTE: int = 60
+        OPENWEATHERMAP_CACHE_TTL: int = 600
+        # Writes queued behind another write to the same file wait this long to be coalesced into one
+        FILE_WRITE_COALESCE_MS: int = 20
+        # Where search_files keeps its trigram index, outside the directory it searches
+        SEARCH_INDEX_DIR: str = os.path.join(tempfile.gettempdir(), "search_index")
         pass
 
     class Tools:
         def __init__(self, pipeline) -> None:
             self.pipeline = pipeline
+            self.directory_index = DirectoryIndex()
+            self.file_writer = AtomicWriter(pipeline.valves.FILE_WRITE_COALESCE_MS)
+            self.weather = WeatherClient(
+                pipeline.valves.OPENWEATHERMAP_BASE_URL,
+                pipeline.valves.OPENWEATHERMAP_RATE_PER_MINUTE,
+                pipeline.valves.OPENWEATHERMAP_CACHE_TTL,
+            )
 
         def get_current_time(self) -> str:
             """
@@ -26,6 +792,7 @@ class Pipeline(FunctionCallingBlueprint):
             current_time = now.strftime("%H:%M:%S")
             return f"Current Time = {current_time}"
 
+        @warm_tool(warm_weather)
         def get_current_weather(self, location: str, unit: Literal["metric", "fahrenheit"] = "fahrenheit") -> str:
             """
             Get the current weather for a location. If the location is not found, return an empty string.
@@ -38,35 +805,57 @@ class Pipeline(FunctionCallingBlueprint):
                 return "OpenWeatherMap API Key not set, ask the user to set it up."
             else:
                 units = "imperial" if unit == "fahrenheit" else "metric"
-                params = {
-                    "q": location,
-                    "appid": self.pipeline.valves.OPENWEATHERMAP_API_KEY,
-                    "units": units,
-                }
-
-                response = requests.get(
-                    "http://api.openweathermap.org/data/2.5/weather", params=params
+                data = self.weather.get(
+                    location, units, self.pipeline.valves.OPENWEATHERMAP_API_KEY
                 )
-                response.raise_for_status()  # Raises an HTTPError for bad responses
-                data = response.json()
+                return format_weather(location, data, unit)
+
+        @warm_tool(warm_weather)
+        def get_weather_batch(self, locations: List[str], unit: Literal["metric", "fahrenheit"] = "fahrenheit") -> str:
+            """
+            Get the current weather for several locations at once. Prefer this over repeated get_current_weather calls.
 
-                weather_description = data["weather"][0]["description"]
-                temperature = data["main"]["temp"]
+            :param locations: The locations to get the weather for.
+            :param unit: The unit to get the weather in. Default is fahrenheit.
+            :return: The current weather for each location, one per line.
+            """
+            if self.pipeline.valves.OPENWEATHERMAP_API_KEY == "":
+                return "OpenWeatherMap API Key not set, ask the user to set it up."
 
-                return f"{location}: {weather_description.capitalize()}, {temperature}°{unit.capitalize()[0]}"
+            units = "imperial" if unit == "fahrenheit" else "metric"
+            results = self.weather.get_many(
+                locations, units, self.pipeline.valves.OPENWEATHERMAP_API_KEY
+            )
+            return "\n".join(
+                f"{location}: not found ({result})"
+                if isinstance(result, Exception)
+                else format_weather(location, result, unit)
+                for location, result in zip(locations, results)
+            )
 
-        def calculator(self, equation: str) -> str:
+        @cache_tool()
+        def calculator(self, equation: str, values: Optional[List[float]] = None) -> str:
             """
-            Calculate the result of an equation.
+            Calculate, compute or evaluate the result of a math equation or arithmetic expression, e.g. 2+2.
+            Supports + - * / // % **, pi, e and math functions such as sqrt, log, sin and round.
 
-            :param equation: The equation to calculate.
+            :param equation: The equation to calculate. Use x as the variable when values are given.
+            :param values: Optional list of values for x; the equation is evaluated once per value.
             """
             try:
-                result = eval(equation)
-                return f"{equation} = {result}"
+                expression = compile_expression(equation)
+                if not values:
+                    return f"{equation} = {expression({}, False)}"
+
+                if np is not None:
+                    results = expression({"x": np.asarray(values, dtype=float)}, True)
+                    results = np.broadcast_to(results, (len(values),)).tolist()
+                else:
+                    results = [expression({"x": value}, False) for value in values]
+                return f"{equation} for x in {len(values)} values = {results}"
             except Exception as e:
                 print(e)
-                return "Invalid equation"
+                return f"Invalid equation: {e}"
 
         def create_folder(self, folder_name: str) -> str:
             """
@@ -77,6 +866,7 @@ class Pipeline(FunctionCallingBlueprint):
             folder_path = os.path.join(os.getcwd(), folder_name)
             if not os.path.exists(folder_path):
                 os.makedirs(folder_path)
+                self.directory_index.invalidate(folder_path)
                 return f"Folder '{folder_name}' created successfully!"
             else:
                 return f"Folder '{folder_name}' already exists."
@@ -90,6 +880,7 @@ class Pipeline(FunctionCallingBlueprint):
             folder_path = os.path.join(os.getcwd(), folder_name)
             if os.path.exists(folder_path):
                 os.rmdir(folder_path)
+                self.directory_index.invalidate(folder_path)
                 return f"Folder '{folder_name}' deleted successfully!"
             else:
                 return f"Folder '{folder_name}' does not exist."
@@ -102,8 +893,8 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the file is created successfully.
             """
             file_path = os.path.join(os.getcwd(), file_name)
-            with open(file_path, "w") as file:
-                file.write(content)
+            self.file_writer.write(file_path, content)
+            self.directory_index.invalidate(file_path)
             return f"File '{file_name}' created successfully!"
 
         def delete_file(self, file_name: str) -> str:
@@ -115,24 +906,80 @@ class Pipeline(FunctionCallingBlueprint):
             file_path = os.path.join(os.getcwd(), file_name)
             if os.path.exists(file_path):
                 os.remove(file_path)
+                self.directory_index.invalidate(file_path)
                 return f"File '{file_name}' deleted successfully!"
             else:
                 return f"File '{file_name}' does not exist."
 
-        def read_file(self, file_name: str) -> str:
+        @cache_tool(version=file_version)
+        def read_file(
+            self,
+            file_name: str,
+            offset: int = 0,
+            length: int = 0,
+            start_line: int = 0,
+            end_line: int = 0,
+            tail: int = 0,
+            pattern: str = "",
+        ) -> str:
             """
-            Read the content of a file.
+            Read part of a file. Large files are read a window at a time; use the reported size to page through them.
             :param file_name: The name of the file to read.
+            :param offset: The byte offset to start reading from.
+            :param length: The maximum number of bytes to return. Default is as many as fit in one tool result.
+            :param start_line: The first line to read (1-based). Overrides offset when set.
+            :param end_line: The last line to read (inclusive). Defaults to reading up to length bytes.
+            :param tail: Read the last N lines of the file instead. Overrides offset and lines when set.
+            :param pattern: Only return lines matching this regular expression, with their line numbers.
             :return: The content of the file.
             """
             file_path = os.path.join(os.getcwd(), file_name)
-            if os.path.exists(file_path):
-                with open(file_path, "r") as file:
-                    content = file.read()
-                return content
-            else:
+            if not os.path.exists(file_path):
                 return f"File '{file_name}' does not exist."
 
+            total = os.path.getsize(file_path)
+            if total == 0:
+                return f"File '{file_name}' is empty."
+
+            # A longer window would be cut down to FUNCTION_RESULT_MAX_CHARS after the range was reported.
+            # function_calling_blueprint.py has no such valve, so its default is used there.
+            budget = max(getattr(self.pipeline.valves, "FUNCTION_RESULT_MAX_CHARS", 8000) - 200, 1)
+            length = budget if length <= 0 else min(length, budget)
+
+            with open(file_path, "rb") as file, mmap.mmap(
+                file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as buffer:
+                if pattern:
+                    try:
+                        content, matches = search_buffer(buffer, pattern, length)
+                    except re.error as e:
+                        return f"Invalid pattern: {e}"
+                    return f"File '{file_name}' ({total} bytes), {matches} matching lines for /{pattern}/:\n{content}"
+
+                if tail > 0:
+                    # Anchor the window to the end of the file so the last lines always come back,
+                    # dropping leading lines that don't fit rather than the trailing ones
+                    start = max(tail_start(buffer, tail), total - length)
+                    if start > 0 and buffer[start - 1] != ord("\n"):
+                        newline = buffer.find(b"\n", start)
+                        if 0 <= newline < total - 1:
+                            start = newline + 1
+                elif start_line > 0:
+                    start = line_start(buffer, start_line)
+                else:
+                    start = min(max(offset, 0), total)
+
+                end = min(start + max(length, 0), total)
+                if start_line > 0 and end_line >= start_line:
+                    line_end = line_start(buffer, end_line + 1)
+                    end = min(end, line_end)
+
+                content = buffer[start:end].decode("utf-8", errors="replace")
+
+            if start == 0 and end == total:
+                return content
+            return f"File '{file_name}' ({total} bytes), bytes {start}-{end}:\n{content}"
+
         def write_to_file(self, file_name: str, content: str) -> str:
             """
             Write content to a file.
@@ -141,17 +988,126 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the content is written successfully.
             """
             file_path = os.path.join(os.getcwd(), file_name)
-            with open(file_path, "w") as file:
-                file.write(content)
+            self.file_writer.write(file_path, content)
+            self.directory_index.invalidate(file_path)
             return f"Content written to file '{file_name}' successfully!"
 
-        def list_files(self) -> str:
+        def append_to_file(self, file_name: str, content: str) -> str:
             """
-            List all files in the current directory.
-            :return: A list of files in the current directory.
+            Append content to the end of a file, creating it if needed.
+            :param file_name: The name of the file to append to.
+            :param content: The content to append.
+            :return: A success message if the content is appended successfully.
             """
-            files = os.listdir(os.getcwd())
-            return "Files in the current directory:\n" + "\n".join(files)
+            file_path = os.path.join(os.getcwd(), file_name)
+            self.file_writer.write(file_path, content, append=True)
+            self.directory_index.invalidate(file_path)
+            return f"Content appended to file '{file_name}' successfully!"
+
+        def list_files(
+            self,
+            path: str = ".",
+            recursive: bool = False,
+            pattern: str = "",
+            sort_by: Literal["name", "size", "mtime"] = "name",
+            page: int = 1,
+            page_size: int = 100,
+        ) -> str:
+            """
+            List the files in a directory, one page at a time.
+            :param path: The directory to list, relative to and inside the current directory. Default is the current directory.
+            :param recursive: Whether to include the files in subdirectories.
+            :param pattern: Only list files whose name or path matches this glob, e.g. "*.log".
+            :param sort_by: Sort by "name", "size" (largest first) or "mtime" (newest first).
+            :param page: The page to return, starting at 1.
+            :param page_size: The number of entries per page. Default is 100.
+            :return: A page of files with their sizes and modification times.
+            """
+            cwd = os.path.realpath(os.getcwd())
+            root = os.path.realpath(os.path.join(cwd, path))
+            if os.path.commonpath([cwd, root]) != cwd:
+                return f"Directory '{path}' is outside the current directory."
+            if not os.path.isdir(root):
+                return f"Directory '{path}' does not exist."
+
+            entries = [
+                entry
+                for entry in self.directory_index.walk(root, recursive)
+                if not pattern
+                or fnmatch.fnmatch(os.path.basename(entry[0]), pattern)
+                or fnmatch.fnmatch(entry[0], pattern)
+            ]
+            if sort_by == "size":
+                entries.sort(key=lambda entry: entry[2], reverse=True)
+            elif sort_by == "mtime":
+                entries.sort(key=lambda entry: entry[3], reverse=True)
+            else:
+                entries.sort(key=lambda entry: entry[0])
+
+            page_size = max(page_size, 1)
+            pages = max((len(entries) + page_size - 1) // page_size, 1)
+            page = min(max(page, 1), pages)
+            lines = [
+                f"{name}/" if is_dir else f"{name}\t{size} bytes\t{datetime.fromtimestamp(mtime).isoformat(timespec='seconds')}"
+                for name, is_dir, size, mtime in entries[(page - 1) * page_size : page * page_size]
+            ]
+            return (
+                f"{len(entries)} entries in '{path}' (page {page} of {pages}, sorted by {sort_by}):\n"
+                + "\n".join(lines)
+            )
+
+        def search_files(
+            self, query: str, regex: bool = False, path: str = "", max_results: int = 50
+        ) -> str:
+            """
+            Search the contents of the files under the current directory, case-insensitively.
+            :param query: The text to search for, or a regular expression if regex is true.
+            :param regex: Whether the query is a regular expression.
+            :param path: Only search files under this subdirectory.
+            :param max_results: The maximum number of matching lines to return. Default is 50.
+            :return: The matching lines with their file paths and line numbers.
+            """
+            pattern = query if regex else re.escape(query)
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                return f"Invalid pattern: {e}"
+
+            index = TrigramIndex(os.getcwd(), self.pipeline.valves.SEARCH_INDEX_DIR, self.directory_index)
+            conn = index.connect()
+            try:
+                print(f"search_index: {index.update(conn)}")
+                literals = required_literals(query) if regex else [query]
+                candidates = index.candidates(conn, literals)
+            finally:
+                conn.close()
+
+            path = os.path.normpath(path) if path else "."
+            prefix = "" if path == "." else path + os.sep
+            results = []
+            for relative in candidates:
+                if len(results) >= max_results:
+                    break
+                if not relative.startswith(prefix):
+                    continue
+                file_path = os.path.join(os.getcwd(), relative)
+                try:
+                    if os.path.getsize(file_path) == 0:
+                        continue
+                    with open(file_path, "rb") as file, mmap.mmap(
+                        file.fileno(), 0, access=mmap.ACCESS_READ
+                    ) as buffer:
+                        content, matches = search_buffer(
+                            buffer, pattern, 4096, re.IGNORECASE
+                        )
+                except (OSError, ValueError):
+                    continue
+                for line in content.split("\n")[: max_results - len(results)] if matches else []:
+                    results.append(f"{relative}:{line[:300]}")
+
+            if not results:
+                return f"No matches for '{query}'."
+            return f"{len(results)} matching lines for '{query}':\n" + "\n".join(results)
 
     def __init__(self):
         super().__init__()
@@ -161,6 +1117,32 @@ class Pipeline(FunctionCallingBlueprint):
                 **self.valves.model_dump(),
                 "pipelines": ["*"],  # Connect to all pipelines
                 "OPENWEATHERMAP_API_KEY": os.getenv("OPENWEATHERMAP_API_KEY", ""),
+                "OPENWEATHERMAP_BASE_URL": os.getenv(
+                    "OPENWEATHERMAP_BASE_URL", "http://api.openweathermap.org/data/2.5"
+                ),
+                "OPENWEATHERMAP_RATE_PER_MINUTE": int(
+                    os.getenv("OPENWEATHERMAP_RATE_PER_MINUTE", 60)
+                ),
+                "OPENWEATHERMAP_CACHE_TTL": int(os.getenv("OPENWEATHERMAP_CACHE_TTL", 600)),
+                "FILE_WRITE_COALESCE_MS": int(os.getenv("FILE_WRITE_COALESCE_MS", 20)),
+                "SEARCH_INDEX_DIR": os.getenv(
+                    "SEARCH_INDEX_DIR", os.path.join(tempfile.gettempdir(), "search_index")
+                ),
             },
         )
         self.tools = self.Tools(self)
+
+    async def on_valves_updated(self):
+        await super().on_valves_updated()
+        self.tools.file_writer.coalesce_ms = self.valves.FILE_WRITE_COALESCE_MS
+        self.tools.weather.close()
+        self.tools.weather = WeatherClient(
+            self.valves.OPENWEATHERMAP_BASE_URL,
+            self.valves.OPENWEATHERMAP_RATE_PER_MINUTE,
+            self.valves.OPENWEATHERMAP_CACHE_TTL,
+        )
+
+    async def on_shutdown(self):
+        await super().on_shutdown()
+        print(f"weather:{self.tools.weather.stats}")
+        self.tools.weather.close()
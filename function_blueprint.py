@@ -1,9 +1,19 @@
-from typing import List, Optional
+from typing import Callable, List, Optional, Union
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import bisect
+import inspect
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import hashlib
+import math
+import re
+import time
 
 from utils.pipelines.main import (
     get_last_user_message,
@@ -12,6 +22,553 @@ from utils.pipelines.main import (
 )
 
 
+class DecisionCache:
+    """
+    LRU cache with a TTL for task model tool-selection decisions.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: int = 300):
+        """
+        Initialize the decision cache.
+        :param max_size: The maximum number of decisions to keep.
+        :param ttl: The number of seconds a decision stays valid.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Lowercase the text, collapse whitespace and drop trailing punctuation."""
+        return re.sub(r"\s+", " ", str(text)).strip().lower().rstrip("?!. ")
+
+    def make_key(self, query: str, history: List[dict], tools_hash: str) -> str:
+        """
+        Build a cache key from the query, the history window and the tools specs.
+        :param query: The last user message.
+        :param history: The messages sent to the task model as history.
+        :param tools_hash: A hash of the tools specs.
+        :return: The cache key.
+        """
+        key = json.dumps(
+            {
+                "query": self.normalize(query),
+                "history": [
+                    [message["role"], self.normalize(message["content"])]
+                    for message in history
+                ],
+                "tools": tools_hash,
+            }
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached decision for the key, or None on a miss."""
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, decision: str):
+        """Store a decision, evicting the least recently used one when full."""
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (time.time(), decision)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters and the current size."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.entries),
+        }
+
+
+class ToolRouter:
+    """
+    Lexical index over the tools specs used to route queries without the task model.
+    """
+
+    STOPWORDS = {
+        "a", "an", "and", "are", "as", "at", "be", "can", "do", "does", "for",
+        "from", "get", "give", "how", "i", "if", "in", "is", "it", "me", "my",
+        "of", "on", "or", "param", "please", "return", "the", "to", "what",
+        "whats", "which", "with", "you", "your",
+    }
+
+    def __init__(self):
+        self.tools = {}
+        self.idf = {}
+        self.unknown_idf = 1.0
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """Split text (including snake_case and camelCase names) into stemmed terms."""
+        text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text)).lower()
+        tokens = []
+        for token in re.findall(r"[a-z0-9]+", text):
+            if token in cls.STOPWORDS:
+                continue
+            if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+                token = token[:-1]
+            tokens.append(token)
+        return tokens
+
+    @classmethod
+    def intent_terms(cls, text: str) -> set:
+        """
+        The terms that say what is asked for. Numbers are values, e.g. the 2s of "compute 2+2",
+        and single letters are mostly left over from contractions, e.g. the s of "what's".
+        """
+        return {term for term in cls.tokenize(text) if len(term) > 1 and not term.isdigit()}
+
+    def build(self, tools_specs: List[dict]):
+        """
+        Index each tool's name, description and parameter names.
+        :param tools_specs: The output of get_tools_specs.
+        """
+        self.tools = {}
+        for spec in tools_specs:
+            parameters = spec.get("parameters", {}) or {}
+            properties = parameters.get("properties", {}) or {}
+            text = " ".join(
+                [spec["name"], str(spec.get("description") or "")]
+                + [
+                    f"{name} {prop.get('description', '')}"
+                    for name, prop in properties.items()
+                ]
+            )
+            self.tools[spec["name"]] = {
+                "terms": self.intent_terms(text),
+                "name_terms": self.intent_terms(spec["name"]),
+                "required": parameters.get("required", []) or [],
+            }
+
+        document_count = len(self.tools)
+        document_frequency = {}
+        for tool in self.tools.values():
+            for term in tool["terms"]:
+                document_frequency[term] = document_frequency.get(term, 0) + 1
+
+        self.idf = {
+            term: math.log(1 + document_count / count)
+            for term, count in document_frequency.items()
+        }
+        self.unknown_idf = math.log(1 + document_count) if document_count else 1.0
+
+    def rank(self, query: str) -> List[tuple]:
+        """
+        Score every tool by the share of the query's idf weight it covers, averaged over its whole
+        spec and its name alone, so that of the tools whose descriptions match equally well, the
+        one named after the request wins ("what time is it" picks get_current_time over
+        list_files, which mentions modification times).
+        :param query: The text to score the tools against.
+        :return: A list of (score, tool name) tuples, best first. Empty if the query has no terms.
+        """
+        terms = self.intent_terms(query)
+        total = sum(self.idf.get(term, self.unknown_idf) for term in terms)
+        if total == 0:
+            return []
+
+        scores = [
+            (
+                (
+                    sum(self.idf[term] for term in terms & tool["terms"])
+                    + sum(self.idf[term] for term in terms & tool["name_terms"])
+                )
+                / (2 * total),
+                name,
+            )
+            for name, tool in self.tools.items()
+        ]
+        # Stable sort so that ties keep the tools specs order
+        return sorted(scores, key=lambda score: score[0], reverse=True)
+
+    def route(self, query: str) -> tuple:
+        """
+        Pick the best matching tool for a query.
+        :param query: The last user message.
+        :return: A (tool name, best score, runner-up score) tuple. The name is None if the
+            query has no terms to route by.
+        """
+        scores = self.rank(query)
+        if not scores:
+            return None, 0.0, 0.0
+
+        best_score, best_name = scores[0]
+        second_score = scores[1][0] if len(scores) > 1 else 0.0
+        return best_name, best_score, second_score
+
+
+def cache_tool(ttl: Optional[float] = None, version: Optional[Callable] = None):
+    """
+    Declare that a Tools method's results can be cached. Undecorated tools are never cached.
+    :param ttl: The number of seconds a result stays valid. None means no expiry.
+    :param version: A callable taking the Tools instance and the call parameters that returns
+        a token, e.g. a file mtime. Cached results are dropped when the token changes.
+    """
+
+    def decorator(function):
+        function.cache_policy = {"ttl": ttl, "version": version}
+        return function
+
+    return decorator
+
+
+def warm_tool(warm_up: Callable):
+    """
+    Declare a warm-up callable for a Tools method, e.g. opening its connection.
+    It is called with the Tools instance as soon as the task model's streamed answer names
+    the tool, while the parameters are still being generated.
+    :param warm_up: A callable taking the Tools instance.
+    """
+
+    def decorator(function):
+        function.warm_up = warm_up
+        return function
+
+    return decorator
+
+
+def tool_timeout(seconds: Union[float, Callable]):
+    """
+    Override TOOL_TIMEOUT for a Tools method that is expected to run longer or shorter.
+    :param seconds: The timeout in seconds, or a callable taking the Tools instance and the call
+        parameters that returns it, e.g. to read a valve. 0 or less means no timeout.
+    """
+
+    def decorator(function):
+        function.timeout = seconds
+        return function
+
+    return decorator
+
+
+class ToolResultCache:
+    """
+    Size-bounded LRU cache for tool results, following each tool's cache_tool policy.
+    """
+
+    def __init__(self, max_size: int = 256):
+        """
+        Initialize the tool result cache.
+        :param max_size: The maximum number of results to keep.
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = {}
+
+    @staticmethod
+    def make_key(name: str, parameters: dict) -> str:
+        """Build a cache key from the tool name and its canonicalized parameters."""
+        parameters = {
+            key: value.strip() if isinstance(value, str) else value
+            for key, value in parameters.items()
+        }
+        return f"{name}:{json.dumps(parameters, sort_keys=True, default=str)}"
+
+    def count(self, name: str, event: str):
+        """Increment a per-tool hit/miss/eviction counter."""
+        tool_stats = self.stats.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+        tool_stats[event] += 1
+
+    def get(self, name: str, key: str, version):
+        """Return (True, result) for a fresh entry, otherwise (False, None)."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, entry_version, result = entry
+            if (expires_at is None or time.time() < expires_at) and entry_version == version:
+                self.entries.move_to_end(key)
+                self.count(name, "hits")
+                return True, result
+            del self.entries[key]
+
+        self.count(name, "misses")
+        return False, None
+
+    def set(self, name: str, key: str, version, ttl: Optional[float], result):
+        """Store a result, evicting the least recently used one when full."""
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + ttl if ttl is not None else None
+        self.entries[key] = (expires_at, version, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.count(evicted_key.split(":", 1)[0], "evictions")
+
+
+class TaskModelBatcher:
+    """
+    Collects task model requests arriving within a short window and sends them together.
+    Identical requests share one in-flight request and its response.
+    """
+
+    def __init__(self, send: Callable, window_ms: float = 15, max_batch_size: int = 16):
+        """
+        Initialize the batcher.
+        :param send: A blocking callable that sends one request payload and returns the response.
+        :param window_ms: How long to wait for more requests after the first one arrives.
+        :param max_batch_size: The number of requests that triggers an immediate flush.
+        """
+        self.send = send
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.flush_handle = None
+        # Serialized payload -> the future of its queued or in-flight request
+        self.in_flight = {}
+        self.stats = {"batches": 0, "requests": 0, "shared": 0}
+
+    async def submit(self, payload: dict) -> dict:
+        """
+        Queue a request payload and wait for its response.
+        :param payload: The /chat/completions request body.
+        :return: The response JSON.
+        """
+        key = json.dumps(payload, sort_keys=True)
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.stats["shared"] += 1
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.in_flight[key] = future
+        future.add_done_callback(lambda future: self.in_flight.pop(key, None))
+        self.pending.append((payload, future))
+
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window_ms / 1000, self.flush)
+
+        # A caller giving up must not cancel the request for the others sharing it
+        return await asyncio.shield(future)
+
+    def flush(self):
+        """Send every pending request concurrently and fan the responses back out."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+
+        loop = asyncio.get_running_loop()
+        for payload, future in batch:
+            task = loop.run_in_executor(None, self.send, payload)
+            task.add_done_callback(
+                lambda task, future=future: self.resolve(task, future)
+            )
+
+    @staticmethod
+    def resolve(task, future):
+        """Copy the outcome of a sent request to the future its caller awaits."""
+        if future.done():
+            return
+        if task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+# A JSON string, possibly cut off at the end of a partial answer, or a structural character
+JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*(?:"|$)|[{}\[\]:,]')
+
+
+def streamed_tool_names(content: str) -> List[str]:
+    """
+    Find the tool names in a task model answer that may still be streaming in.
+    Only the "name" keys of the call objects themselves count, not keys of the same name
+    nested in their parameters.
+    :param content: The answer so far: a call object, or a list of them.
+    :return: The names whose values have fully arrived, in order.
+    """
+    tokens = JSON_TOKEN.findall(content)
+    if not tokens or tokens[0] not in "{[":
+        return []
+
+    # Call objects sit right inside the answer, or right inside its list
+    call_depth = 1 if tokens[0] == "{" else 2
+    names = []
+    depth = 0
+    for i, token in enumerate(tokens):
+        if token in "{[":
+            depth += 1
+        elif token in "}]":
+            depth -= 1
+        elif token == '"name"' and depth == call_depth and tokens[i - 1] in "{," and tokens[i + 1 : i + 2] == [":"]:
+            try:
+                value = json.loads(tokens[i + 2]) if len(tokens) > i + 2 else None
+            except ValueError:
+                # The value is still streaming in
+                continue
+            if isinstance(value, str):
+                names.append(value)
+    return names
+
+
+def is_empty(result) -> bool:
+    """Check for an empty tool result without relying on truthiness (DataFrames have none)."""
+    return result is None or (
+        isinstance(result, (str, list, tuple, dict)) and len(result) == 0
+    )
+
+
+class ResultGovernor:
+    """
+    Fits tool results into a character budget before they are injected into the system prompt.
+    """
+
+    def __init__(self, max_chars: int = 8000, table_rows: int = 5):
+        """
+        Initialize the result governor.
+        :param max_chars: The character budget for all results of a request (about 4 chars per token).
+        :param table_rows: The number of rows shown from tabular results.
+        """
+        self.max_chars = max_chars
+        self.table_rows = table_rows
+
+    def summarize_table(self, table) -> str:
+        """Describe a DataFrame-like result by its shape, columns, first rows and statistics."""
+        rows, columns = table.shape[0], table.shape[1] if len(table.shape) > 1 else 1
+        lines = [f"Table with {rows} rows and {columns} columns."]
+        if hasattr(table, "dtypes") and hasattr(table.dtypes, "items"):
+            lines.append(
+                "Columns: "
+                + ", ".join(f"{name} ({dtype})" for name, dtype in table.dtypes.items())
+            )
+        lines += [f"First {min(rows, self.table_rows)} rows:", table.head(self.table_rows).to_string()]
+        try:
+            lines += ["Statistics:", table.describe().to_string()]
+        except Exception:
+            pass
+        return "\n".join(lines)
+
+    def to_text(self, result) -> str:
+        """Convert a tool result to text, summarizing tabular results."""
+        if hasattr(result, "shape") and hasattr(result, "head"):
+            return self.summarize_table(result)
+        if isinstance(result, (list, tuple)):
+            return f"{len(result)} items:\n" + "\n".join(str(item) for item in result)
+        return str(result)
+
+    @staticmethod
+    def head_tail(text: str, budget: int) -> str:
+        """Keep the start and the end of the text, dropping the middle, in at most budget characters."""
+        marker = "\n... [{} characters omitted] ...\n"
+        # The omitted count has no more digits than len(text), so the marker fits in what is left
+        keep = budget - len(marker.format(len(text)))
+        if keep <= 0:
+            return text[:budget]
+        head = keep * 2 // 3
+        return text[:head] + marker.format(len(text) - keep) + text[len(text) - (keep - head) :]
+
+    @staticmethod
+    def omitted_marker(count: int) -> str:
+        return f"... [{count} sentences omitted] ..." if count > 0 else ""
+
+    @staticmethod
+    def join_sentences(sentences: List[str], kept: List[int]) -> str:
+        """Join the kept sentences, marking where sentences were left out."""
+        parts, previous = [], -1
+        for i in kept + [len(sentences)]:
+            if i > previous + 1:
+                parts.append(ResultGovernor.omitted_marker(i - previous - 1))
+            if i < len(sentences):
+                parts.append(sentences[i])
+            previous = i
+        return " ".join(parts)
+
+    @staticmethod
+    def extract(text: str, budget: int, query: str) -> Optional[str]:
+        """
+        Keep the sentences sharing the most terms with the query, in their original order,
+        with a marker wherever sentences were left out.
+        :return: The compressed text, or None if the query gives nothing to rank by.
+        """
+        query_terms = set(ToolRouter.tokenize(query))
+        sentences = re.split(r"(?<=[.!?])\s+", text)
+        if not query_terms or len(sentences) < 3:
+            return None
+
+        ranked = sorted(
+            range(len(sentences)),
+            key=lambda i: (
+                # Always keep the opening sentence, then rank by query overlap
+                i != 0,
+                -len(query_terms & set(ToolRouter.tokenize(sentences[i]))),
+                i,
+            ),
+        )
+
+        def gap(count: int) -> tuple:
+            # The characters and the number of parts a run of omitted sentences adds
+            return (len(ResultGovernor.omitted_marker(count)), 1) if count > 0 else (0, 0)
+
+        # The joined length is tracked as the kept sentences change, as the characters of
+        # all parts plus one separator between each two: nothing kept is one big gap
+        kept = []
+        chars, parts = gap(len(sentences))
+        for i in ranked:
+            position = bisect.bisect_left(kept, i)
+            previous = kept[position - 1] if position > 0 else -1
+            following = kept[position] if position < len(kept) else len(sentences)
+            changes = [
+                (-1, gap(following - previous - 1)),
+                (1, gap(i - previous - 1)),
+                (1, gap(following - i - 1)),
+            ]
+            new_chars = chars + len(sentences[i]) + sum(sign * size for sign, (size, _) in changes)
+            new_parts = parts + 1 + sum(sign * count for sign, (_, count) in changes)
+            if new_chars + new_parts - 1 > budget:
+                continue
+            kept.insert(position, i)
+            chars, parts = new_chars, new_parts
+        return ResultGovernor.join_sentences(sentences, kept) if kept else None
+
+    def govern(self, result, budget: int, query: str = "") -> str:
+        """
+        Fit a tool result into the budget.
+        :param result: The tool result.
+        :param budget: The number of characters available for this result.
+        :param query: The last user message, used to pick sentences from long prose.
+        :return: The result as text within the budget.
+        """
+        text = self.to_text(result)
+        size = f"{len(text)} chars" if isinstance(result, str) else f"{type(result).__name__}"
+        if budget > 0 and len(text) > budget:
+            lines = text.count("\n") + 1
+            # Line-oriented output (logs, listings, rows) keeps its head and tail;
+            # prose is compressed to the sentences most relevant to the query.
+            compressed = None
+            if lines < 5 or len(text) / lines > 200:
+                compressed = self.extract(text, budget, query)
+            text = compressed or self.head_tail(text, budget)
+
+        if not isinstance(result, str) or f"{len(text)} chars" != size:
+            print(f"function_result: {size} -> {len(text)} chars")
+        return text
+
+
 class Pipeline:
     class Valves(BaseModel):
         # List target pipeline ids (models) that this filter will be connected to.
@@ -29,6 +586,48 @@ class Pipeline:
         TASK_MODEL: str
         TEMPLATE: str
 
+        # Valves for the tool-selection decision cache
+        DECISION_CACHE_ENABLED: bool = True
+        DECISION_CACHE_SIZE: int = 1024
+        DECISION_CACHE_TTL: int = 300
+
+        # Valves for the local tool router
+        # Queries scoring below the floor skip the task model with no tool.
+        # Queries scoring above the threshold pick a parameterless tool locally.
+        ROUTER_ENABLED: bool = False
+        ROUTER_NO_TOOL_FLOOR: float = 0.05
+        ROUTER_CONFIDENCE_THRESHOLD: float = 0.75
+        ROUTER_MARGIN: float = 0.25
+
+        # Valves for the tools specs sent to the task model
+        # Compact specs drop the JSON indentation; TOOLS_TOP_K > 0 only sends the
+        # k tools most relevant to the query.
+        COMPACT_TOOLS_SPECS: bool = False
+        TOOLS_TOP_K: int = 0
+
+        # Valves for tool execution
+        # Multiple tool calls run concurrently on a bounded thread pool, each with its own timeout.
+        # Tools decorated with tool_timeout use their own timeout instead of TOOL_TIMEOUT.
+        TOOL_MAX_WORKERS: int = 8
+        TOOL_TIMEOUT: float = 30
+
+        # Valves for batching task model requests across concurrent chats
+        # Requests arriving within TASK_BATCH_WINDOW_MS are sent together over one pooled session.
+        TASK_BATCH_ENABLED: bool = False
+        TASK_BATCH_WINDOW_MS: float = 15
+        TASK_BATCH_MAX_SIZE: int = 16
+
+        # Stream the task model's answer, stopping as soon as it is clearly not a tool call
+        TASK_MODEL_STREAM: bool = True
+
+        # Valves for the function result injected into the system prompt
+        # Results larger than the budget are truncated or compressed; 0 disables the limit.
+        FUNCTION_RESULT_MAX_CHARS: int = 8000
+
+        # Valves for the tool result cache (see cache_tool)
+        TOOL_CACHE_ENABLED: bool = True
+        TOOL_CACHE_SIZE: int = 256
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -60,17 +659,444 @@ When answer to user:
 - If you don't know when you are not sure, ask for clarification.
 Avoid mentioning that you obtained the information from the context.
 And answer according to the language of the user's question.""",
+                "DECISION_CACHE_ENABLED": os.getenv(
+                    "DECISION_CACHE_ENABLED", "true"
+                ).lower()
+                == "true",
+                "DECISION_CACHE_SIZE": int(os.getenv("DECISION_CACHE_SIZE", 1024)),
+                "DECISION_CACHE_TTL": int(os.getenv("DECISION_CACHE_TTL", 300)),
+                "ROUTER_ENABLED": os.getenv("ROUTER_ENABLED", "false").lower()
+                == "true",
+                "ROUTER_NO_TOOL_FLOOR": float(os.getenv("ROUTER_NO_TOOL_FLOOR", 0.05)),
+                "ROUTER_CONFIDENCE_THRESHOLD": float(
+                    os.getenv("ROUTER_CONFIDENCE_THRESHOLD", 0.75)
+                ),
+                "ROUTER_MARGIN": float(os.getenv("ROUTER_MARGIN", 0.25)),
+                "COMPACT_TOOLS_SPECS": os.getenv("COMPACT_TOOLS_SPECS", "false").lower()
+                == "true",
+                "TOOLS_TOP_K": int(os.getenv("TOOLS_TOP_K", 0)),
+                "TOOL_MAX_WORKERS": int(os.getenv("TOOL_MAX_WORKERS", 8)),
+                "TOOL_TIMEOUT": float(os.getenv("TOOL_TIMEOUT", 30)),
+                "TASK_BATCH_ENABLED": os.getenv("TASK_BATCH_ENABLED", "false").lower()
+                == "true",
+                "TASK_BATCH_WINDOW_MS": float(os.getenv("TASK_BATCH_WINDOW_MS", 15)),
+                "TASK_BATCH_MAX_SIZE": int(os.getenv("TASK_BATCH_MAX_SIZE", 16)),
+                "TASK_MODEL_STREAM": os.getenv("TASK_MODEL_STREAM", "true").lower()
+                == "true",
+                "FUNCTION_RESULT_MAX_CHARS": int(
+                    os.getenv("FUNCTION_RESULT_MAX_CHARS", 8000)
+                ),
+                "TOOL_CACHE_ENABLED": os.getenv("TOOL_CACHE_ENABLED", "true").lower()
+                == "true",
+                "TOOL_CACHE_SIZE": int(os.getenv("TOOL_CACHE_SIZE", 256)),
             }
         )
 
+        self.decision_cache = DecisionCache(
+            self.valves.DECISION_CACHE_SIZE, self.valves.DECISION_CACHE_TTL
+        )
+
+        # Tools specs index, built on startup once the subclass has set self.tools
+        self.tools_specs = None
+        self.tools_hash = None
+        self.serialized_specs = {}
+        self.router = None
+        self.router_stats = {"local": 0, "no_tool": 0, "ambiguous": 0}
+
+        # Thread pool for blocking tools, so they don't stall the event loop
+        self.executor = ThreadPoolExecutor(max_workers=self.valves.TOOL_MAX_WORKERS)
+
+        # Results of tools declared with cache_tool
+        self.tool_cache = ToolResultCache(self.valves.TOOL_CACHE_SIZE)
+
+        # Pooled session and optional batcher for task model requests
+        self.task_stats = {"streamed": 0, "early_exits": 0, "warm_ups": 0, "shared": 0}
+        # Serialized payload -> the task of its in-flight request, shared by identical requests
+        self.task_in_flight = {}
+        self.session = None
+        self.batcher = None
+        self.setup_task_model_client()
+
+    def setup_task_model_client(self):
+        """Create the pooled session (and the batcher, if enabled) for task model requests."""
+        if self.session is not None:
+            self.session.close()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(self.valves.TASK_BATCH_MAX_SIZE, 1)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.batcher = None
+        if self.valves.TASK_BATCH_ENABLED:
+            self.batcher = TaskModelBatcher(
+                self.post_task_model,
+                self.valves.TASK_BATCH_WINDOW_MS,
+                self.valves.TASK_BATCH_MAX_SIZE,
+            )
+
+    def build_task_request(self, user_message: str, history: List[dict]) -> dict:
+        """
+        Build the tool-selection request for the task model.
+        :param user_message: The last user message.
+        :param history: The history window sent to the task model.
+        :return: The /chat/completions request body.
+        """
+        # System prompt for function calling
+        fc_system_prompt = (
+            f"Tools: {self.get_tools_block(user_message, history)}"
+            + """
+If a function tool doesn't match the query, return an empty string. Else, pick a function tool, fill in the parameters from the function tool's schema, and return it in the format { "name": \"functionName\", "parameters": { "key": "value" } }. If the query needs several independent function tool calls, return a list of such objects instead. Only pick a function if the user asks.  Only return the object. Do not return any other text."
+"""
+        )
+
+        return {
+            "model": self.valves.TASK_MODEL,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": fc_system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": "History:\n"
+                    + "\n".join(
+                        [
+                            f"{message['role']}: {message['content']}"
+                            for message in history
+                        ]
+                    )
+                    + f"Query: {user_message}",
+                },
+            ],
+            # TODO: dynamically add response_format?
+            # "response_format": {"type": "json_object"},
+        }
+
+    def post_task_model(self, payload: dict) -> dict:
+        """
+        Send a request to the task model over the pooled session.
+        :param payload: The /chat/completions request body.
+        :return: The response JSON.
+        """
+        r = self.session.post(
+            url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+            json=payload,
+            headers={
+                "Authorization": f"Bearer {self.valves.OPENAI_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            stream=False,
+        )
+        try:
+            r.raise_for_status()
+        except requests.HTTPError:
+            print(r.text)
+            raise
+        return r.json()
+
+    def stream_task_model(self, payload: dict) -> str:
+        """
+        Stream a request to the task model, parsing the answer as it arrives.
+        The stream is closed as soon as the answer can't be a tool call, and tools are
+        warmed up as soon as their name has streamed in.
+        :param payload: The /chat/completions request body.
+        :return: The content of the task model's answer, or "" if it is not a tool call.
+        """
+        r = self.session.post(
+            url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+            json={**payload, "stream": True},
+            headers={
+                "Authorization": f"Bearer {self.valves.OPENAI_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            stream=True,
+        )
+        try:
+            try:
+                r.raise_for_status()
+            except requests.HTTPError:
+                print(r.text)
+                raise
+
+            self.task_stats["streamed"] += 1
+            content = ""
+            warmed = set()
+            for line in r.iter_lines():
+                line = line.decode("utf-8") if isinstance(line, bytes) else line
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+
+                choices = json.loads(data).get("choices") or [{}]
+                content += (choices[0].get("delta") or {}).get("content") or ""
+
+                # A tool call is a JSON object or list, anything else means no tool
+                stripped = content.lstrip()
+                if stripped and stripped[0] not in "{[":
+                    self.task_stats["early_exits"] += 1
+                    return ""
+
+                for name in streamed_tool_names(content):
+                    if name not in warmed:
+                        warmed.add(name)
+                        self.warm_up_tool(name)
+
+            return content
+        finally:
+            # Closing the response cancels the rest of the stream
+            r.close()
+
+    def warm_up_tool(self, name: str):
+        """Run a tool's warm_tool callable, if it has one, on the tool thread pool."""
+        function = getattr(self.tools, name, None)
+        warm_up = getattr(function, "warm_up", None)
+        if name.startswith("_") or warm_up is None:
+            return
+
+        self.task_stats["warm_ups"] += 1
+        self.executor.submit(warm_up, self.tools).add_done_callback(
+            lambda future: future.exception() and print(future.exception())
+        )
+
+    async def call_task_model(self, payload: dict) -> str:
+        """
+        Get the tool-selection decision from the task model without blocking the event loop.
+        Concurrent identical requests, e.g. the same question from several chats before the
+        decision cache has its answer, share one request to the task model.
+        :param payload: The /chat/completions request body.
+        :return: The content of the task model's answer.
+        """
+        if self.batcher is not None:
+            # The batcher shares identical requests itself
+            return await self.request_task_model(payload)
+
+        key = json.dumps(payload, sort_keys=True)
+        task = self.task_in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.request_task_model(payload))
+            self.task_in_flight[key] = task
+            task.add_done_callback(lambda task: self.task_in_flight.pop(key, None))
+        else:
+            self.task_stats["shared"] += 1
+        return await asyncio.shield(task)
+
+    async def request_task_model(self, payload: dict) -> str:
+        """Send one tool-selection request, batched, streamed or plain as the valves say."""
+        if self.batcher is not None:
+            response = await self.batcher.submit(payload)
+        elif self.valves.TASK_MODEL_STREAM:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.stream_task_model, payload)
+        else:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, self.post_task_model, payload)
+        return response["choices"][0]["message"]["content"]
+
+    def build_tools_index(self):
+        """Serialize the tools specs once and index them for the local tool router."""
+        self.tools_specs = get_tools_specs(self.tools)
+        self.tools_hash = hashlib.sha256(
+            json.dumps(self.tools_specs, sort_keys=True).encode()
+        ).hexdigest()
+
+        if self.valves.COMPACT_TOOLS_SPECS:
+            # Collapse docstring indentation as well as the JSON whitespace
+            self.serialized_specs = {
+                spec["name"]: json.dumps(
+                    {**spec, "description": " ".join(str(spec.get("description") or "").split())},
+                    separators=(",", ":"),
+                )
+                for spec in self.tools_specs
+            }
+        else:
+            self.serialized_specs = {
+                spec["name"]: json.dumps(spec, indent=2) for spec in self.tools_specs
+            }
+
+        self.router = ToolRouter()
+        self.router.build(self.tools_specs)
+
+    def get_tools_block(self, user_message: str, history: List[dict]) -> str:
+        """
+        Build the tools specs block of the function calling system prompt.
+        :param user_message: The last user message.
+        :param history: The history window sent to the task model.
+        :return: The serialized tools specs.
+        """
+        names = [spec["name"] for spec in self.tools_specs]
+        if 0 < self.valves.TOOLS_TOP_K < len(names):
+            scores = self.router.rank(user_message)
+            if not scores or scores[0][0] == 0:
+                # Nothing in the query matches, so fall back to the whole window
+                # to keep follow-ups like "and in London?" on the right tools.
+                scores = self.router.rank(
+                    " ".join(str(message["content"]) for message in history)
+                )
+            # If nothing matches at all, the task model gets every tool
+            if scores and scores[0][0] > 0:
+                names = [name for _, name in scores[: self.valves.TOOLS_TOP_K]]
+
+        separator = "," if self.valves.COMPACT_TOOLS_SPECS else ",\n"
+        block = "[" + separator.join(self.serialized_specs[name] for name in names) + "]"
+        print(
+            f"tools_specs: {len(names)}/{len(self.tools_specs)} tools, {len(block)} chars"
+        )
+        return block
+
+    def route_locally(self, user_message: str, history: Optional[List[dict]] = None) -> Optional[str]:
+        """
+        Try to make the tool-selection decision without the task model.
+        :param user_message: The last user message.
+        :param history: The history window sent to the task model, used to recognize follow-ups.
+        :return: The decision in the task model's format, or None if it is ambiguous.
+        """
+        name, score, second_score = self.router.route(user_message)
+        if name is None:
+            # Nothing to go on, e.g. a bare "2+2": leave it to the task model
+            self.router_stats["ambiguous"] += 1
+            return None
+
+        if score < self.valves.ROUTER_NO_TOOL_FLOOR:
+            # A follow-up like "and in London?" matches nothing by itself, but
+            # continues a conversation about a tool: leave it to the task model
+            context = self.router.rank(
+                " ".join(str(message["content"]) for message in history or [])
+            )
+            if context and context[0][0] >= self.valves.ROUTER_NO_TOOL_FLOOR:
+                self.router_stats["ambiguous"] += 1
+                return None
+
+            self.router_stats["no_tool"] += 1
+            return ""
+
+        if (
+            score >= self.valves.ROUTER_CONFIDENCE_THRESHOLD
+            and score - second_score >= self.valves.ROUTER_MARGIN
+            and not self.router.tools[name]["required"]
+        ):
+            self.router_stats["local"] += 1
+            return json.dumps({"name": name, "parameters": {}})
+
+        self.router_stats["ambiguous"] += 1
+        return None
+
+    async def run_tool(self, call: dict):
+        """
+        Run a single tool call with its timeout: the tool's own, or TOOL_TIMEOUT.
+        :param call: A { "name", "parameters" } object returned by the task model.
+        :return: The tool result, or None if the tool is unknown, failed or timed out.
+        """
+        name = call.get("name")
+        if not name or name.startswith("_") or not hasattr(self.tools, name):
+            print(f"Unknown tool: {name}")
+            return None
+
+        function = getattr(self.tools, name)
+        parameters = call.get("parameters") or {}
+
+        policy = getattr(function, "cache_policy", None)
+        cache_key = None
+        version = None
+        if policy is not None and self.valves.TOOL_CACHE_ENABLED:
+            try:
+                if policy["version"] is not None:
+                    version = policy["version"](self.tools, **parameters)
+                cache_key = self.tool_cache.make_key(name, parameters)
+                hit, result = self.tool_cache.get(name, cache_key, version)
+                if hit:
+                    return result
+            except Exception as e:
+                # If the version can't be computed, the call is not cacheable
+                print(e)
+                cache_key = None
+
+        timeout = self.valves.TOOL_TIMEOUT
+        try:
+            timeout = getattr(function, "timeout", timeout)
+            if callable(timeout):
+                timeout = timeout(self.tools, **parameters)
+            if timeout <= 0:
+                timeout = None
+
+            if inspect.iscoroutinefunction(function):
+                result = await asyncio.wait_for(function(**parameters), timeout=timeout)
+            else:
+                loop = asyncio.get_running_loop()
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, lambda: function(**parameters)),
+                    timeout=timeout,
+                )
+
+            if cache_key is not None and not is_empty(result):
+                self.tool_cache.set(name, cache_key, version, policy["ttl"], result)
+            return result
+        except asyncio.TimeoutError:
+            print(f"Tool {name} timed out after {timeout}s")
+        except Exception as e:
+            print(e)
+        return None
+
+    async def run_tools(self, calls: List[dict], user_message: str = "") -> str:
+        """
+        Run the tool calls concurrently and merge their results.
+        :param calls: The { "name", "parameters" } objects returned by the task model.
+        :param user_message: The last user message, used to compress long results.
+        :return: The non-empty results, fitted into the result budget, joined in the order of the calls.
+        """
+        results = await asyncio.gather(*[self.run_tool(call) for call in calls])
+        results = [result for result in results if not is_empty(result)]
+        if not results:
+            return ""
+
+        governor = ResultGovernor(self.valves.FUNCTION_RESULT_MAX_CHARS)
+        budget = self.valves.FUNCTION_RESULT_MAX_CHARS // len(results)
+        # Compressing a large page takes long enough to stall other requests on the loop
+        loop = asyncio.get_running_loop()
+        governed = await asyncio.gather(
+            *[
+                loop.run_in_executor(self.executor, governor.govern, result, budget, user_message)
+                for result in results
+            ]
+        )
+        return "\n".join(governed)
+
     async def on_startup(self):
         # This function is called when the server is started.
         print(f"on_startup:{__name__}")
+        if getattr(self, "tools", None) is not None:
+            self.build_tools_index()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
         print(f"on_shutdown:{__name__}")
+        print(f"decision_cache:{self.decision_cache.stats()}")
+        print(f"router:{self.router_stats}")
+        print(f"tool_cache:{self.tool_cache.stats}")
+        print(f"task_model:{self.task_stats}")
+        if self.batcher is not None:
+            print(f"task_batcher:{self.batcher.stats}")
+        self.executor.shutdown(wait=False)
+        self.session.close()
+        pass
+
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated.
+        print(f"on_valves_updated:{__name__}")
+        self.decision_cache = DecisionCache(
+            self.valves.DECISION_CACHE_SIZE, self.valves.DECISION_CACHE_TTL
+        )
+        self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(max_workers=self.valves.TOOL_MAX_WORKERS)
+        self.tool_cache = ToolResultCache(self.valves.TOOL_CACHE_SIZE)
+        self.setup_task_model_client()
+        if getattr(self, "tools", None) is not None:
+            self.build_tools_index()
         pass
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
@@ -85,67 +1111,42 @@ And answer according to the language of the user's question.""",
         user_message = get_last_user_message(body["messages"])
 
         # Get the tools specs
-        tools_specs = get_tools_specs(self.tools)
+        if self.tools_specs is None:
+            self.build_tools_index()
 
-        # System prompt for function calling
-        fc_system_prompt = (
-            f"Tools: {json.dumps(tools_specs, indent=2)}"
-            + """
-If a function tool doesn't match the query, return an empty string. Else, pick a function tool, fill in the parameters from the function tool's schema, and return it in the format { "name": \"functionName\", "parameters": { "key": "value" } }. Only pick a function if the user asks.  Only return the object. Do not return any other text."
-"""
-        )
+        # The history window sent to the task model
+        history = body["messages"][::-1][:4]
 
-        r = None
-        try:
-            # Call the OpenAI API to get the function response
-            r = requests.post(
-                url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
-                json={
-                    "model": self.valves.TASK_MODEL,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": fc_system_prompt,
-                        },
-                        {
-                            "role": "user",
-                            "content": "History:\n"
-                            + "\n".join(
-                                [
-                                    f"{message['role']}: {message['content']}"
-                                    for message in body["messages"][::-1][:4]
-                                ]
-                            )
-                            + f"Query: {user_message}",
-                        },
-                    ],
-                    # TODO: dynamically add response_format?
-                    # "response_format": {"type": "json_object"},
-                },
-                headers={
-                    "Authorization": f"Bearer {self.valves.OPENAI_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                stream=False,
+        cache_key = None
+        content = None
+        if self.valves.ROUTER_ENABLED:
+            content = self.route_locally(user_message, history)
+
+        if content is None and self.valves.DECISION_CACHE_ENABLED:
+            cache_key = self.decision_cache.make_key(
+                user_message, history, self.tools_hash
             )
-            r.raise_for_status()
+            content = self.decision_cache.get(cache_key)
 
-            response = r.json()
-            content = response["choices"][0]["message"]["content"]
+        try:
+            if content is None:
+                # Call the OpenAI API to get the function response
+                payload = self.build_task_request(user_message, history)
+                content = await self.call_task_model(payload)
+
+                if cache_key is not None:
+                    self.decision_cache.set(cache_key, content)
 
             # Parse the function response
             if content != "":
                 result = json.loads(content)
                 print(result)
 
-                # Call the function
-                if "name" in result:
-                    function = getattr(self.tools, result["name"])
-                    function_result = None
-                    try:
-                        function_result = function(**result["parameters"])
-                    except Exception as e:
-                        print(e)
+                # Call the functions
+                calls = result if isinstance(result, list) else [result]
+                calls = [call for call in calls if isinstance(call, dict) and "name" in call]
+                if calls:
+                    function_result = await self.run_tools(calls, user_message)
 
                     # Add the function result to the system prompt
                     if function_result:
@@ -164,10 +1165,4 @@ If a function tool doesn't match the query, return an empty string. Else, pick a
         except Exception as e:
             print(f"Error: {e}")
 
-            if r:
-                try:
-                    print(r.json())
-                except:
-                    pass
-
         return body
@@ -1,11 +1,60 @@
-from typing import List, Optional
+from typing import Callable, List, Optional, Union
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
 import os
+import asyncio
 import requests
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from utils.pipelines.main import get_last_user_message, add_or_update_system_message, get_tools_specs
 
+
+# Tool declarations shared with function_blueprint.py, so that Tools pipelines written against
+# it also load on this blueprint. This blueprint has no tool result cache and doesn't stream the
+# task model, so cache_tool and warm_tool are only recorded on the method here.
+def cache_tool(ttl: Optional[float] = None, version: Optional[Callable] = None):
+    """
+    Declare that a Tools method's results can be cached. Undecorated tools are never cached.
+    :param ttl: The number of seconds a result stays valid. None means no expiry.
+    :param version: A callable taking the Tools instance and the call parameters that returns
+        a token, e.g. a file mtime. Cached results are dropped when the token changes.
+    """
+
+    def decorator(function):
+        function.cache_policy = {"ttl": ttl, "version": version}
+        return function
+
+    return decorator
+
+
+def warm_tool(warm_up: Callable):
+    """
+    Declare a warm-up callable for a Tools method, e.g. opening its connection.
+    :param warm_up: A callable taking the Tools instance.
+    """
+
+    def decorator(function):
+        function.warm_up = warm_up
+        return function
+
+    return decorator
+
+
+def tool_timeout(seconds: Union[float, Callable]):
+    """
+    Give a Tools method its own timeout instead of the tool_timeout valve.
+    :param seconds: The timeout in seconds, or a callable taking the Tools instance and the call
+        parameters that returns it, e.g. to read a valve. 0 or less means no timeout.
+    """
+
+    def decorator(function):
+        function.timeout = seconds
+        return function
+
+    return decorator
+
+
 class Pipeline:
     class Valves(BaseModel):
         pipelines: List[str] = []
@@ -14,6 +63,14 @@ class Pipeline:
         openai_api_key: str
         task_model: str
         template: str
+        # Total time budget for tool selection; past it the request continues without tools.
+        # 0 or less (the default) waits for the task model however long it takes. Task model calls
+        # take 300-900 ms, so a budget such as 400 trades tools on slow selections for latency.
+        tool_selection_timeout_ms: int = 0
+        # Tools run on a bounded thread pool, so they don't stall the event loop, each for at most
+        # tool_timeout seconds unless it declares its own with tool_timeout(). 0 or less means no timeout.
+        tool_max_workers: int = 8
+        tool_timeout: float = 30
 
     def __init__(self):
         self.type = "filter"
@@ -23,6 +80,9 @@ class Pipeline:
             openai_api_base_url=os.getenv("OPENAI_API_BASE_URL", "https://api.groq.com/openai/v1"),
             openai_api_key=os.getenv("OPENAI_API_KEY", "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"),
             task_model=os.getenv("TASK_MODEL", "llama3-8b-8192"),
+            tool_selection_timeout_ms=int(os.getenv("TOOL_SELECTION_TIMEOUT_MS", 0)),
+            tool_max_workers=int(os.getenv("TOOL_MAX_WORKERS", 8)),
+            tool_timeout=float(os.getenv("TOOL_TIMEOUT", 30)),
             template='''
 <context>
   {{CONTEXT}}
@@ -43,12 +103,69 @@ Constraints:
 </context>
 '''
         )
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=self.valves.tool_max_workers)
+        self.selection_stats = {"successes": 0, "timeouts": 0, "errors": 0}
 
     async def on_startup(self):
         print(f"on_startup:{__name__}")
 
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
+        print(f"tool_selection:{self.selection_stats}")
+        self.session.close()
+        self.executor.shutdown(wait=False)
+
+    async def on_valves_updated(self):
+        print(f"on_valves_updated:{__name__}")
+        self.session.close()
+        self.session = requests.Session()
+        self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(max_workers=self.valves.tool_max_workers)
+
+    def select_tool(self, payload: dict, timeout: Optional[float]) -> str:
+        response = self.session.post(
+            url=f"{self.valves.openai_api_base_url}/chat/completions",
+            json=payload,
+            headers={
+                "Authorization": f"Bearer {self.valves.openai_api_key}",
+                "Content-Type": "application/json",
+            },
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def run_tool(self, name: str, parameters: dict):
+        """
+        Run a tool on the tool thread pool with its timeout: its own, or the tool_timeout valve.
+        :param name: The name of the Tools method.
+        :param parameters: The parameters picked by the task model.
+        :return: The tool result, or None if the tool is unknown, failed or timed out.
+        """
+        function = getattr(self.tools, name, None)
+        if name.startswith("_") or function is None:
+            print(f"Unknown tool: {name}")
+            return None
+
+        timeout = self.valves.tool_timeout
+        try:
+            timeout = getattr(function, "timeout", timeout)
+            if callable(timeout):
+                timeout = timeout(self.tools, **parameters)
+            if timeout <= 0:
+                timeout = None
+
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, lambda: function(**parameters)),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            print(f"Tool {name} timed out after {timeout}s")
+        except Exception as e:
+            print(e)
+        return None
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         if body.get("title", False):
@@ -57,6 +174,8 @@ Constraints:
         print(f"pipe:{__name__}")
         print(user)
 
+        budget = self.valves.tool_selection_timeout_ms / 1000
+        deadline = time.monotonic() + budget if budget > 0 else None
         user_message = get_last_user_message(body["messages"])
         tools_specs = get_tools_specs(self.tools)
 
@@ -66,50 +185,53 @@ Constraints:
 If a function tool doesn't match the query, return an empty string. Else, pick a function tool, fill in the parameters from the function tool's schema, and return it in the format { "name": "functionName", "parameters": { "key": "value" } }. Only pick a function if the user asks.  Only return the object. Do not return any other text."""
         )
 
-        try:
-            async with requests.post(
-                url=f"{self.valves.openai_api_base_url}/chat/completions",
-                json={
-                    "model": self.valves.task_model,
-                    "messages": [
-                        {"role": "system", "content": fc_system_prompt},
-                        {
-                            "role": "user",
-                            "content": "History:\n"
-                            + "\n".join(
-                                [
-                                    f"{message['role']}: {message['content']}"
-                                    for message in body["messages"][::-1][:4]
-                                ]
-                            )
-                            + f"Query: {user_message}",
-                        },
-                    ],
+        payload = {
+            "model": self.valves.task_model,
+            "messages": [
+                {"role": "system", "content": fc_system_prompt},
+                {
+                    "role": "user",
+                    "content": "History:\n"
+                    + "\n".join(
+                        [
+                            f"{message['role']}: {message['content']}"
+                            for message in body["messages"][::-1][:4]
+                        ]
+                    )
+                    + f"Query: {user_message}",
                 },
-                headers={
-                    "Authorization": f"Bearer {self.valves.openai_api_key}",
-                    "Content-Type": "application/json",
-                },
-                stream=False,
-            ) as response:
-                response.raise_for_status()
-                response_json = response.json()
-                content = response_json["choices"][0]["message"]["content"]
+            ],
+        }
 
+        timeout = max(deadline - time.monotonic(), 0) if deadline is not None else None
+        loop = asyncio.get_running_loop()
+        try:
+            content = await asyncio.wait_for(
+                loop.run_in_executor(None, self.select_tool, payload, timeout),
+                timeout=timeout,
+            )
+            self.selection_stats["successes"] += 1
+        except (asyncio.TimeoutError, requests.Timeout):
+            self.selection_stats["timeouts"] += 1
+            print(
+                f"Tool selection exceeded {self.valves.tool_selection_timeout_ms}ms, continuing without tools"
+            )
+            return body
+        except Exception as e:
+            self.selection_stats["errors"] += 1
+            print(f"Error: {e}")
+            return body
+
+        try:
             if content:
                 result = json.loads(content)
                 print(result)
 
                 if "name" in result:
-                    function = getattr(self.tools, result["name"])
-                    function_result = None
-                    try:
-                        function_result = function(**result["parameters"])
-                    except Exception as e:
-                        print(e)
+                    function_result = await self.run_tool(result["name"], result.get("parameters") or {})
 
                     if function_result:
-                            system_prompt = self.valves.template.replace(
+                        system_prompt = self.valves.template.replace(
                             "{{CONTEXT}}", function_result
                         )
                         print(system_prompt)
@@ -120,9 +242,4 @@ If a function tool doesn't match the query, return an empty string. Else, pick a
         except Exception as e:
             print(f"Error: {e}")
 
-            try:
-                print(response.json())
-                except:
-                    pass
-
         return body
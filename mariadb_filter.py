@@ -2,41 +2,307 @@ import os
 import requests
 import paramiko
 import ftplib
+import json
+import posixpath
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Literal
 import mysql.connector
 
-from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint
+from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint, tool_timeout
+from blueprints.network_tools import (
+    ConnectionPool,
+    FTPConnectionPool,
+    HTTPFetcher,
+    SFTPTransfer,
+    SSHConnectionPool,
+    exec_timeout,
+    fetch_pages,
+    format_exec_result,
+    ftp_download,
+    ftp_transfer_many,
+    ftp_upload,
+    run_coroutine,
+    ssh_exec_on,
+    transfer_timeout,
+)
+
+
+class UnconfirmedWriteError(mysql.connector.errors.OperationalError):
+    """The connection was lost after a write was sent, so it may or may not have been applied."""
+
+
+CONNECTION_ERRORS = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
+
+
+def is_read(query: str) -> bool:
+    return query.lstrip()[:6].upper() in ("SELECT", "SHOW")
 
 
 class MariaDBConnection:
-    def __init__(self, host: str, user: str, password: str, database: str):
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        database: str,
+        pool_size: int = 5,
+        idle_timeout: float = 300,
+        batch_rows: int = 0,
+        batch_ms: float = 200,
+    ):
         """
-        Initialize the MariaDB connection.
+        Initialize the MariaDB connection pool. Connections are opened as queries need them.
         :param host: The host of the MariaDB server.
         :param user: The username to use for authentication.
         :param password: The password to use for authentication.
         :param database: The database to connect to.
+        :param pool_size: The most connections open at once.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        :param batch_rows: Buffer writes and flush them once this many are waiting. 0 writes each one at once.
+        :param batch_ms: The longest a buffered write waits before it is flushed.
         """
-        self.conn = mysql.connector.connect(
-            host=host, user=user, password=password, database=database
-        )
-        self.cursor = self.conn.cursor()
+        self.host = host
+        self.user = user
+        self.password = password
+        self.pool = MariaDBConnectionPool(database, pool_size, idle_timeout)
+        self.write_buffer = WriteBehindBuffer(self, batch_rows, batch_ms) if batch_rows > 0 else None
+        # table -> the columns it lacks, from the last check_memory_schema
+        self.outdated_tables = {}
 
     def execute_query(self, query: str, params: tuple = None):
         """
-        Execute a query on the MariaDB server.
+        Execute a query on the MariaDB server, on a pooled connection with a cursor of its own.
+        If the connection is lost before the query is sent, or during a read, the query is
+        retried once on a fresh connection. A write that was sent is never retried, since the
+        server may have applied it: UnconfirmedWriteError is raised instead.
         :param query: The SQL query to execute.
         :param params: The parameters to pass to the query.
         :return: The results of the query.
         """
-        self.cursor.execute(query, params)
-        self.conn.commit()
-        return self.cursor.fetchall()
+        # Flush buffered writes first, so reads see them
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+        for attempt in range(2):
+            sent = False
+            try:
+                with self.pool.connection(self.host, self.user, self.password) as connection:
+                    cursor = connection.cursor()
+                    try:
+                        sent = True
+                        cursor.execute(query, params)
+                        results = cursor.fetchall() if cursor.with_rows else []
+                        connection.commit()
+                        return results
+                    finally:
+                        cursor.close()
+            except CONNECTION_ERRORS as e:
+                if sent and not is_read(query):
+                    raise UnconfirmedWriteError(str(e)) from e
+                if attempt:
+                    raise
+
+    def stream_query(self, query: str, params: tuple = None, batch_size: int = 1000):
+        """
+        Execute a query and yield its rows as the server sends them, from an unbuffered cursor.
+        The connection stays borrowed until the generator is exhausted or closed.
+        :param query: The SQL query to execute.
+        :param params: The parameters to pass to the query.
+        :param batch_size: The number of rows fetched from the server at a time.
+        :return: A generator of rows.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.flush()
+        key, connection = self.pool.acquire(self.host, self.user, self.password)
+        finished = False
+        try:
+            cursor = connection.cursor(buffered=False)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+            cursor.close()
+            connection.commit()
+            finished = True
+        finally:
+            # A connection with unread rows can't run another query, so an abandoned export closes it
+            self.pool.release(key, connection, finished)
+
+    def ensure_schema(self, statements: list):
+        """
+        Run schema statements, reporting rather than raising on ones the server refuses.
+        :param statements: The CREATE/ALTER statements to run.
+        """
+        for statement in statements:
+            try:
+                self.execute_query(statement)
+            except mysql.connector.Error as e:
+                print(f"Error applying schema statement '{statement}': {e}")
+
+    def execute_write(self, query: str, params: tuple = None):
+        """
+        Execute a write on the MariaDB server, or buffer it if write-behind batching is on.
+        :param query: The SQL query to execute.
+        :param params: The parameters to pass to the query.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.add(query, params)
+        else:
+            self.execute_query(query, params)
+
+    def execute_many(self, batches: dict):
+        """
+        Execute queries once per row of parameters, all in one transaction.
+        Like execute_query, the batch is only retried if the connection was lost before it was sent.
+        :param batches: Maps each query to the list of parameter tuples to run it with.
+        """
+        for attempt in range(2):
+            sent = False
+            try:
+                with self.pool.connection(self.host, self.user, self.password) as connection:
+                    cursor = connection.cursor()
+                    try:
+                        sent = True
+                        for query, rows in batches.items():
+                            cursor.executemany(query, rows)
+                        connection.commit()
+                        return
+                    except mysql.connector.Error:
+                        try:
+                            connection.rollback()
+                        except mysql.connector.Error:
+                            pass
+                        raise
+                    finally:
+                        cursor.close()
+            except CONNECTION_ERRORS as e:
+                if sent:
+                    raise UnconfirmedWriteError(str(e)) from e
+                if attempt:
+                    raise
 
     def close_connection(self):
         """
-        Close the MariaDB connection.
+        Flush buffered writes and close the MariaDB connections.
+        """
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+        self.pool.close()
+
+
+class WriteBehindBuffer:
+    """
+    Gathers writes and runs them with executemany in one transaction, once max_rows are
+    waiting or max_delay_ms after the first of them, whichever comes first.
+    """
+
+    def __init__(self, mariadb_connection: MariaDBConnection, max_rows: int = 100, max_delay_ms: float = 200):
         """
-        self.conn.close()
+        Initialize the buffer.
+        :param mariadb_connection: The connection to flush writes through.
+        :param max_rows: The number of waiting writes that triggers a flush.
+        :param max_delay_ms: The longest a write waits before it is flushed.
+        """
+        self.mariadb_connection = mariadb_connection
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        self.lock = threading.Lock()
+        # Held for the whole of a flush, so batches reach the database in order
+        self.flush_lock = threading.Lock()
+        # query -> [params] waiting for the next flush
+        self.pending = {}
+        self.size = 0
+        self.timer = None
+        self.stats = {"rows": 0, "flushes": 0, "errors": 0, "dropped": 0, "unconfirmed": 0}
+
+    def add(self, query: str, params: tuple):
+        with self.lock:
+            self.pending.setdefault(query, []).append(params)
+            self.size += 1
+            self.stats["rows"] += 1
+            full = self.size >= self.max_rows
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.max_delay_ms / 1000, self.flush_in_background)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every buffered row. Rows that failed on a lost connection before they were sent are
+        kept for the next flush; rows sent before the connection was lost may already be written,
+        so they are dropped rather than written twice. If the server rejects the batch, its rows
+        are written one at a time and only those it still rejects are dropped, so one bad row
+        doesn't cost the rest of the batch.
+        """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.size = self.pending, {}, 0
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not pending:
+                return
+            try:
+                self.mariadb_connection.execute_many(pending)
+            except UnconfirmedWriteError:
+                count = sum(len(rows) for rows in pending.values())
+                self.stats["errors"] += 1
+                self.stats["unconfirmed"] += count
+                print(f"Lost the connection after sending {count} buffered writes; they may not have been written")
+                raise
+            except CONNECTION_ERRORS:
+                self.stats["errors"] += 1
+                self.requeue(pending)
+                raise
+            except mysql.connector.Error as e:
+                self.stats["errors"] += 1
+                print(f"Error flushing buffered writes, retrying them one at a time: {e}")
+                self.write_each(pending)
+            self.stats["flushes"] += 1
+
+    def write_each(self, pending: dict):
+        """Write rows one at a time, dropping the ones the server rejects. Call with flush_lock held."""
+        rows = [(query, params) for query, batch in pending.items() for params in batch]
+        for i, (query, params) in enumerate(rows):
+            try:
+                self.mariadb_connection.execute_many({query: [params]})
+            except CONNECTION_ERRORS as e:
+                unconfirmed = isinstance(e, UnconfirmedWriteError)
+                if unconfirmed:
+                    self.stats["unconfirmed"] += 1
+                remaining = {}
+                for remaining_query, remaining_params in rows[i + 1 if unconfirmed else i :]:
+                    remaining.setdefault(remaining_query, []).append(remaining_params)
+                self.requeue(remaining)
+                raise
+            except mysql.connector.Error as e:
+                # Rows the server rejects would fail again, so they are dropped
+                self.stats["dropped"] += 1
+                print(f"Dropped buffered write '{query}': {e}")
+
+    def requeue(self, pending: dict):
+        """Put rows back in front of the ones buffered since, for the next flush."""
+        with self.lock:
+            for query, rows in pending.items():
+                self.pending[query] = rows + self.pending.get(query, [])
+                self.size += len(rows)
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        except mysql.connector.Error as e:
+            print(f"Error flushing buffered writes: {e}")
+
+    def close(self):
+        self.flush_in_background()
+        with self.lock:
+            if self.size:
+                print(f"Dropped {self.size} buffered writes that could not be flushed")
 
 
 class Authenticator:
@@ -59,121 +325,340 @@ class Authenticator:
         return bool(results)
 
 
-class ShortTermMemory:
+class MariaDBTable:
+    """
+    A table of stored values, with keyset-paginated retrieval and a streaming export.
+    Rows are returned as (id, session_id, created_at, value).
+    """
+
+    table = None
+    column = None
+
     def __init__(self, mariadb_connection: MariaDBConnection):
         """
-        Initialize the ShortTermMemory.
+        Initialize the table.
         :param mariadb_connection: An instance of MariaDBConnection.
         """
         self.mariadb_connection = mariadb_connection
 
-    def store_data(self, data: str) -> bool:
+    def schema(self) -> list:
+        """
+        The statements that create the table, or add the columns and indexes it is missing.
+        Rows already in the table when created_at is added get the time of the ALTER, not the
+        time they were stored, so since/until filters can't tell those rows apart.
+        """
+        table, column = self.table, self.column
+        return [
+            f"CREATE TABLE IF NOT EXISTS {table} (id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY, "
+            f"session_id VARCHAR(255) NULL, created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, {column} LONGTEXT)",
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY FIRST",
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS session_id VARCHAR(255) NULL",
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_session ON {table} (session_id, id)",
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_created ON {table} (created_at, id)",
+        ]
+
+    def check_schema(self):
+        """Refuse to read or write a table that check_memory_schema found without the columns used here."""
+        missing = self.mariadb_connection.outdated_tables.get(self.table)
+        if missing:
+            raise RuntimeError(
+                f"The {self.table} table has no {', '.join(missing)} column(s). "
+                "Run scripts/migrate_memory_schema.py, or set MARIADB_ENSURE_SCHEMA, to add them."
+            )
+
+    def store(self, value: str, session_id: str = None):
+        self.check_schema()
+        query = f"INSERT INTO {self.table} ({self.column}, session_id) VALUES (%s, %s)"
+        self.mariadb_connection.execute_write(query, (value, session_id))
+
+    def select(self, session_id: str = None, since: str = None, until: str = None) -> tuple:
+        """Build the SELECT and its parameters for the given filters."""
+        conditions = []
+        params = []
+        if session_id is not None:
+            conditions.append("session_id = %s")
+            params.append(session_id)
+        if since is not None:
+            conditions.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            conditions.append("created_at < %s")
+            params.append(until)
+        query = f"SELECT id, session_id, created_at, {self.column} FROM {self.table}"
+        return query, conditions, params
+
+    def page(
+        self,
+        session_id: str = None,
+        since: str = None,
+        until: str = None,
+        limit: int = 100,
+        newest_first: bool = True,
+        after_id: int = None,
+    ) -> list:
+        """
+        Retrieve one page of rows. Pages are keyed on id, so later pages cost no more than the first.
+        :param session_id: Only rows stored for this session.
+        :param since: Only rows stored at or after this time, as "YYYY-MM-DD HH:MM:SS".
+        :param until: Only rows stored before this time, as "YYYY-MM-DD HH:MM:SS".
+        :param limit: The most rows to return.
+        :param newest_first: Whether to return the newest rows first.
+        :param after_id: The id of the last row of the previous page.
+        :return: The rows.
+        """
+        self.check_schema()
+        query, conditions, params = self.select(session_id, since, until)
+        if after_id is not None:
+            conditions.append("id < %s" if newest_first else "id > %s")
+            params.append(after_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY id {'DESC' if newest_first else 'ASC'} LIMIT %s"
+        params.append(max(int(limit), 1))
+        return self.mariadb_connection.execute_query(query, tuple(params))
+
+    def export(self, session_id: str = None, since: str = None, until: str = None):
+        """
+        Stream every matching row, oldest first, without holding the table in memory.
+        :return: A generator of rows.
+        """
+        self.check_schema()
+        query, conditions, params = self.select(session_id, since, until)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        return self.mariadb_connection.stream_query(query, tuple(params))
+
+
+class ShortTermMemory(MariaDBTable):
+    table = "short_term_memory"
+    column = "data"
+
+    def store_data(self, data: str, session_id: str = None) -> bool:
         """
         Store data in short-term memory.
         :param data: The data to store.
+        :param session_id: The session the data belongs to.
         :return: True if the data is stored successfully.
         """
-        query = "INSERT INTO short_term_memory (data) VALUES (%s)"
-        self.mariadb_connection.execute_query(query, (data,))
+        self.store(data, session_id)
         return True
 
-    def retrieve_data(self) -> list:
+    def retrieve_data(self, **filters) -> list:
         """
-        Retrieve data from short-term memory.
+        Retrieve a page of data from short-term memory.
+        :param filters: The filters taken by MariaDBTable.page.
         :return: The retrieved data.
         """
-        query = "SELECT * FROM short_term_memory"
-        return self.mariadb_connection.execute_query(query)
+        return self.page(**filters)
 
 
-class LongTermMemory:
-    def __init__(self, mariadb_connection: MariaDBConnection):
-        """
-        Initialize the LongTermMemory.
-        :param mariadb_connection: An instance of MariaDBConnection.
-        """
-        self.mariadb_connection = mariadb_connection
+class LongTermMemory(MariaDBTable):
+    table = "long_term_memory"
+    column = "data"
 
-    def store_data(self, data: str) -> bool:
+    def store_data(self, data: str, session_id: str = None) -> bool:
         """
         Store data in long-term memory.
         :param data: The data to store.
+        :param session_id: The session the data belongs to.
         :return: True if the data is stored successfully.
         """
-        query = "INSERT INTO long_term_memory (data) VALUES (%s)"
-        self.mariadb_connection.execute_query(query, (data,))
+        self.store(data, session_id)
         return True
 
-    def retrieve_data(self) -> list:
+    def retrieve_data(self, **filters) -> list:
         """
-        Retrieve data from long-term memory.
+        Retrieve a page of data from long-term memory.
+        :param filters: The filters taken by MariaDBTable.page.
         :return: The retrieved data.
         """
-        query = "SELECT * FROM long_term_memory"
-        return self.mariadb_connection.execute_query(query)
+        return self.page(**filters)
 
 
-class Embeddings:
-    def __init__(self, mariadb_connection: MariaDBConnection):
-        """
-        Initialize the Embeddings.
-        :param mariadb_connection: An instance of MariaDBConnection.
-        """
-        self.mariadb_connection = mariadb_connection
+class Embeddings(MariaDBTable):
+    table = "embeddings"
+    column = "embedding"
 
-    def store_embedding(self, embedding: str) -> bool:
+    def store_embedding(self, embedding: str, session_id: str = None) -> bool:
         """
         Store an embedding.
         :param embedding: The embedding to store.
+        :param session_id: The session the embedding belongs to.
         :return: True if the embedding is stored successfully.
         """
-        query = "INSERT INTO embeddings (embedding) VALUES (%s)"
-        self.mariadb_connection.execute_query(query, (embedding,))
+        self.store(embedding, session_id)
         return True
 
-    def retrieve_embedding(self) -> list:
+    def retrieve_embedding(self, **filters) -> list:
         """
-        Retrieve embeddings.
+        Retrieve a page of embeddings.
+        :param filters: The filters taken by MariaDBTable.page.
         :return: The retrieved embeddings.
         """
-        query = "SELECT * FROM embeddings"
-        return self.mariadb_connection.execute_query(query)
+        return self.page(**filters)
 
 
-class RAG:
-    def __init__(self, mariadb_connection: MariaDBConnection):
-        """
-        Initialize the RAG.
-        :param mariadb_connection: An instance of MariaDBConnection.
-        """
-        self.mariadb_connection = mariadb_connection
+class RAG(MariaDBTable):
+    table = "rag"
+    column = "rag"
 
-    def store_rag(self, rag: str) -> bool:
+    def store_rag(self, rag: str, session_id: str = None) -> bool:
         """
         Store a RAG.
         :param rag: The RAG to store.
+        :param session_id: The session the RAG belongs to.
         :return: True if the RAG is stored successfully.
         """
-        query = "INSERT INTO rag (rag) VALUES (%s)"
-        self.mariadb_connection.execute_query(query, (rag,))
+        self.store(rag, session_id)
         return True
 
-    def retrieve_rag(self) -> list:
+    def retrieve_rag(self, **filters) -> list:
         """
-        Retrieve RAGs.
+        Retrieve a page of RAGs.
+        :param filters: The filters taken by MariaDBTable.page.
         :return: The retrieved RAGs.
         """
-        query = "SELECT * FROM rag"
-        return self.mariadb_connection.execute_query(query)
+        return self.page(**filters)
+
+
+MEMORY_TABLES = {table.table: table for table in (ShortTermMemory, LongTermMemory, Embeddings, RAG)}
+
+
+def check_memory_schema(mariadb_connection: MariaDBConnection) -> dict:
+    """
+    Find the memory tables that lack the columns the tables are read and written with,
+    and record them on the connection so that MariaDBTable refuses to use them.
+    :return: Maps each outdated or missing table to the columns it lacks.
+    """
+    placeholders = ",".join(["%s"] * len(MEMORY_TABLES))
+    rows = mariadb_connection.execute_query(
+        "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+        f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})",
+        tuple(MEMORY_TABLES),
+    )
+    columns = {}
+    for table, column in rows:
+        columns.setdefault(table, set()).add(column.lower())
+
+    outdated = {}
+    for name, table in MEMORY_TABLES.items():
+        missing = [
+            column
+            for column in ("id", "session_id", "created_at", table.column)
+            if column not in columns.get(name, set())
+        ]
+        if missing:
+            outdated[name] = missing
+    mariadb_connection.outdated_tables = outdated
+    return outdated
+
+
+def export_timeout(tools, **kwargs) -> float:
+    """The tool timeout for export_memory."""
+    return tools.pipeline.valves.MARIADB_EXPORT_TIMEOUT
+
+
+class MariaDBConnectionPool(ConnectionPool):
+    """
+    Pooled connections to one MariaDB database, pinged when borrowed and reconnected if they dropped.
+    """
+
+    default_port = 3306
+
+    def __init__(self, database: str, max_per_host: int = 5, idle_timeout: float = 300):
+        """
+        Initialize the pool.
+        :param database: The database to connect to.
+        :param max_per_host: The maximum number of connections open to the server.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        """
+        super().__init__(max_per_host, idle_timeout)
+        self.database = database
+
+    def open_connection(self, host: str, port: int, username: str, password: str):
+        return mysql.connector.connect(host=host, port=port, user=username, password=password, database=self.database)
+
+    def is_healthy(self, connection) -> bool:
+        try:
+            connection.ping(reconnect=True, attempts=1, delay=0)
+            return True
+        except mysql.connector.Error:
+            return False
+
+    def close_connection(self, connection):
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
 
 
 class Pipeline(FunctionCallingBlueprint):
     class Valves(FunctionCallingBlueprint.Valves):
-        pass
+        # Valves for the MariaDB connection pool
+        MARIADB_POOL_SIZE: int = 5
+        MARIADB_IDLE_TIMEOUT: int = 300
+        # Write-behind batching of memory, embedding and RAG writes, off at 0 rows
+        MARIADB_WRITE_BATCH_ROWS: int = 0
+        MARIADB_WRITE_BATCH_MS: int = 200
+        # Create the memory tables' columns and indexes on connect if they are missing. Off by default,
+        # since ALTER TABLE can lock a large table; run scripts/migrate_memory_schema.py once instead.
+        MARIADB_ENSURE_SCHEMA: bool = False
+        MARIADB_MAX_PAGE_SIZE: int = 500
+        # How long export_memory may run, instead of TOOL_TIMEOUT
+        MARIADB_EXPORT_TIMEOUT: int = 600
+        # Valves for the HTTP fetcher
+        HTTP_CACHE_DIR: str = os.path.join(tempfile.gettempdir(), "http_cache")
+        HTTP_MAX_BYTES: int = 1048576
+        HTTP_MAX_PER_HOST: int = 4
+        HTTP_TIMEOUT: int = 15
+        FETCH_MAX_CHARS: int = 4000
+        # Valves for the pooled SSH/SFTP connections
+        SSH_MAX_SESSIONS_PER_HOST: int = 4
+        SSH_IDLE_TIMEOUT: int = 300
+        SSH_KEEPALIVE: int = 30
+        SSH_CONNECT_TIMEOUT: int = 15
+        # Valves for running commands over SSH
+        SSH_CHANNELS_PER_CONNECTION: int = 8
+        SSH_EXEC_TIMEOUT: int = 60
+        SSH_EXEC_MAX_BYTES: int = 65536
+        SSH_FANOUT_PARALLELISM: int = 16
+        # Valves for SFTP transfers
+        SFTP_TRANSFER_WORKERS: int = 4
+        SFTP_CHUNK_SIZE_MB: int = 8
+        # Where interrupted transfers record their progress, outside the transferred directories
+        SFTP_JOURNAL_DIR: str = os.path.join(tempfile.gettempdir(), "sftp_journals")
+        # Valves for the pooled FTP connections and transfers
+        FTP_MAX_CONNECTIONS_PER_HOST: int = 4
+        FTP_IDLE_TIMEOUT: int = 60
+        FTP_BLOCK_SIZE: int = 65536
+        # Where the source size and mtime of each .part file are recorded, so a changed source restarts
+        FTP_JOURNAL_DIR: str = os.path.join(tempfile.gettempdir(), "ftp_journals")
+        # How long an SFTP or FTP transfer tool may run, instead of TOOL_TIMEOUT
+        TRANSFER_TIMEOUT: int = 600
+        FTP_TRANSFER_WORKERS: int = 4
 
     class Tools:
         def __init__(self, pipeline) -> None:
             self.pipeline = pipeline
+            self.fetcher = HTTPFetcher(
+                pipeline.valves.HTTP_CACHE_DIR,
+                pipeline.valves.HTTP_MAX_BYTES,
+                pipeline.valves.HTTP_MAX_PER_HOST,
+                pipeline.valves.HTTP_TIMEOUT,
+            )
+            self.ssh_pool = SSHConnectionPool(
+                pipeline.valves.SSH_MAX_SESSIONS_PER_HOST,
+                pipeline.valves.SSH_IDLE_TIMEOUT,
+                pipeline.valves.SSH_KEEPALIVE,
+                pipeline.valves.SSH_CHANNELS_PER_CONNECTION,
+                pipeline.valves.SSH_CONNECT_TIMEOUT,
+            )
+            self.ftp_pool = FTPConnectionPool(
+                pipeline.valves.FTP_MAX_CONNECTIONS_PER_HOST,
+                pipeline.valves.FTP_IDLE_TIMEOUT,
+            )
             self.mariadb_connection = None
 
         def make_http_request(self, url: str) -> str:
@@ -183,8 +668,7 @@ class Pipeline(FunctionCallingBlueprint):
             :return: The response from the server.
             """
             try:
-                response = requests.get(url)
-                return response.text
+                return self.fetcher.fetch(url)
             except requests.RequestException as e:
                 return f"Error making HTTP request: {str(e)}"
 
@@ -195,11 +679,19 @@ class Pipeline(FunctionCallingBlueprint):
             :return: The response from the server.
             """
             try:
-                response = requests.get(url, verify=False)
-                return response.text
+                return self.fetcher.fetch(url, verify=False)
             except requests.RequestException as e:
                 return f"Error making HTTPS request: {str(e)}"
 
+        def fetch_many(self, urls: List[str]) -> str:
+            """
+            Fetch several web pages at once as readable text. Prefer this over repeated make_http_request calls.
+            :param urls: The URLs to fetch.
+            :return: The text of each page, under its URL.
+            """
+            pages = run_coroutine(fetch_pages(self.fetcher, urls, self.pipeline.valves.FETCH_MAX_CHARS))
+            return "\n\n".join(f"# {url}\n{page}" for url, page in zip(urls, pages))
+
         def connect_to_ssh(self, host: str, username: str, password: str) -> str:
             """
             Connect to an SSH server.
@@ -209,13 +701,58 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the connection is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(hostname=host, username=username, password=password)
-                return f"Connected to SSH server {host} as {username}"
+                with self.ssh_pool.connection(host, username, password):
+                    return f"Connected to SSH server {host} as {username}"
             except paramiko.SSHException as e:
                 return f"Error connecting to SSH server: {str(e)}"
 
+        @tool_timeout(exec_timeout)
+        def ssh_exec(self, host: str, username: str, password: str, command: str) -> str:
+            """
+            Run a command on an SSH server.
+            :param host: The hostname or IP address of the SSH server.
+            :param username: The username to use for the SSH connection.
+            :param password: The password to use for the SSH connection.
+            :param command: The command to run.
+            :return: The command's exit status and output.
+            """
+            result = ssh_exec_on(
+                self.ssh_pool,
+                host,
+                username,
+                password,
+                command,
+                self.pipeline.valves.SSH_EXEC_TIMEOUT,
+                self.pipeline.valves.SSH_EXEC_MAX_BYTES,
+            )
+            return format_exec_result(result)
+
+        @tool_timeout(exec_timeout)
+        def ssh_exec_many(self, hosts: List[str], username: str, password: str, command: str) -> str:
+            """
+            Run the same command on several SSH servers at once. Prefer this over repeated ssh_exec calls.
+            :param hosts: The hostnames or IP addresses of the SSH servers.
+            :param username: The username to use for the SSH connections.
+            :param password: The password to use for the SSH connections.
+            :param command: The command to run.
+            :return: Each server's exit status and output.
+            """
+            with ThreadPoolExecutor(max_workers=max(self.pipeline.valves.SSH_FANOUT_PARALLELISM, 1)) as executor:
+                results = executor.map(
+                    lambda host: ssh_exec_on(
+                        self.ssh_pool,
+                        host,
+                        username,
+                        password,
+                        command,
+                        self.pipeline.valves.SSH_EXEC_TIMEOUT,
+                        self.pipeline.valves.SSH_EXEC_MAX_BYTES,
+                    ),
+                    hosts,
+                )
+                return "\n\n".join(format_exec_result(result) for result in results)
+
+        @tool_timeout(transfer_timeout)
         def upload_file_via_sftp(self, host: str, username: str, password: str, local_file: str, remote_file: str) -> str:
             """
             Upload a file via SFTP.
@@ -227,17 +764,51 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the upload is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username=username, password=password)
-                sftp = ssh.open_sftp()
-                sftp.put(local_file, remote_file)
-                sftp.close()
-                ssh.close()
-                return f"Uploaded file '{local_file}' to '{remote_file}'"
-            except paramiko.SSHException as e:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.upload(local_file, remote_file)
+            except (paramiko.SSHException, IOError) as e:
                 return f"Error uploading file: {str(e)}"
+            if summary["failed"]:
+                return f"Error uploading file: {summary['failed'][local_file]}"
+            if summary["skipped"]:
+                return f"'{remote_file}' is already up to date with '{local_file}'"
+            return f"Uploaded file '{local_file}' to '{remote_file}'"
 
+        @tool_timeout(transfer_timeout)
+        def upload_directory_via_sftp(self, host: str, username: str, password: str, local_dir: str, remote_dir: str) -> str:
+            """
+            Upload a directory and everything under it via SFTP, skipping files already up to date.
+            :param host: The hostname or IP address of the SFTP server.
+            :param username: The username to use for the SFTP connection.
+            :param password: The password to use for the SFTP connection.
+            :param local_dir: The local directory to upload.
+            :param remote_dir: The remote directory to upload to.
+            :return: A summary of the files uploaded, skipped and failed.
+            """
+            try:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.upload_directory(local_dir, remote_dir)
+            except (paramiko.SSHException, IOError) as e:
+                return f"Error uploading directory: {str(e)}"
+            return f"Uploaded '{local_dir}' to '{remote_dir}': {json.dumps(summary)}"
+
+        @tool_timeout(transfer_timeout)
         def download_file_via_sftp(self, host: str, username: str, password: str, remote_file: str, local_file: str) -> str:
             """
             Download a file via SFTP.
@@ -249,16 +820,49 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the download is successful.
             """
             try:
-                ssh = paramiko.SSHClient()
-                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                ssh.connect(host, username=username, password=password)
-                sftp = ssh.open_sftp()
-                sftp.get(remote_file, local_file)
-                sftp.close()
-                ssh.close()
-                return f"Downloaded file '{remote_file}' to '{local_file}'"
-            except paramiko.SSHException as e:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.download(remote_file, local_file)
+            except (paramiko.SSHException, IOError) as e:
                 return f"Error downloading file: {str(e)}"
+            if summary["failed"]:
+                return f"Error downloading file: {summary['failed'][remote_file]}"
+            if summary["skipped"]:
+                return f"'{local_file}' is already up to date with '{remote_file}'"
+            return f"Downloaded file '{remote_file}' to '{local_file}'"
+
+        @tool_timeout(transfer_timeout)
+        def download_directory_via_sftp(self, host: str, username: str, password: str, remote_dir: str, local_dir: str) -> str:
+            """
+            Download a remote directory and everything under it via SFTP, skipping files already up to date.
+            :param host: The hostname or IP address of the SFTP server.
+            :param username: The username to use for the SFTP connection.
+            :param password: The password to use for the SFTP connection.
+            :param remote_dir: The remote directory to download.
+            :param local_dir: The local directory to save the download to.
+            :return: A summary of the files downloaded, skipped and failed.
+            """
+            try:
+                transfer = SFTPTransfer(
+                    self.ssh_pool,
+                    host,
+                    username,
+                    password,
+                    self.pipeline.valves.SFTP_TRANSFER_WORKERS,
+                    self.pipeline.valves.SFTP_CHUNK_SIZE_MB * 1024 * 1024,
+                    self.pipeline.valves.SFTP_JOURNAL_DIR,
+                )
+                summary = transfer.download_directory(remote_dir, local_dir)
+            except (paramiko.SSHException, IOError) as e:
+                return f"Error downloading directory: {str(e)}"
+            return f"Downloaded '{remote_dir}' to '{local_dir}': {json.dumps(summary)}"
 
         def connect_to_ftp(self, host: str, username: str, password: str) -> str:
             """
@@ -269,12 +873,12 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the connection is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                return f"Connected to FTP server {host} as {username}"
+                with self.ftp_pool.connection(host, username, password):
+                    return f"Connected to FTP server {host} as {username}"
             except ftplib.all_errors as e:
                 return f"Error connecting to FTP server: {str(e)}"
 
+        @tool_timeout(transfer_timeout)
         def upload_file_via_ftp(self, host: str, username: str, password: str, local_file: str, remote_file: str) -> str:
             """
             Upload a file via FTP.
@@ -286,14 +890,40 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the upload is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                with open(local_file, 'rb') as file:
-                    ftp.storbinary(f"STOR {remote_file}", file)
+                with self.ftp_pool.connection(host, username, password) as ftp:
+                    ftp_upload(
+                        ftp, local_file, remote_file, self.pipeline.valves.FTP_BLOCK_SIZE, self.pipeline.valves.FTP_JOURNAL_DIR
+                    )
                 return f"Uploaded file '{local_file}' to '{remote_file}'"
             except ftplib.all_errors as e:
                 return f"Error uploading file: {str(e)}"
 
+        @tool_timeout(transfer_timeout)
+        def upload_files_via_ftp(self, host: str, username: str, password: str, local_files: List[str], remote_dir: str) -> str:
+            """
+            Upload several files via FTP at once. Prefer this over repeated upload_file_via_ftp calls.
+            :param host: The hostname or IP address of the FTP server.
+            :param username: The username to use for the FTP connection.
+            :param password: The password to use for the FTP connection.
+            :param local_files: The local files to upload.
+            :param remote_dir: The remote directory to upload them to.
+            :return: A summary of the files uploaded and failed.
+            """
+            pairs = [(local_file, posixpath.join(remote_dir, os.path.basename(local_file))) for local_file in local_files]
+            summary = ftp_transfer_many(
+                self.ftp_pool,
+                host,
+                username,
+                password,
+                "upload",
+                pairs,
+                self.pipeline.valves.FTP_TRANSFER_WORKERS,
+                self.pipeline.valves.FTP_BLOCK_SIZE,
+                self.pipeline.valves.FTP_JOURNAL_DIR,
+            )
+            return f"Uploaded files to '{remote_dir}': {json.dumps(summary)}"
+
+        @tool_timeout(transfer_timeout)
         def download_file_via_ftp(self, host: str, username: str, password: str, remote_file: str, local_file: str) -> str:
             """
             Download a file via FTP.
@@ -305,23 +935,76 @@ class Pipeline(FunctionCallingBlueprint):
             :return: A success message if the download is successful.
             """
             try:
-                ftp = ftplib.FTP(host)
-                ftp.login(username, password)
-                with open(local_file, 'wb') as file:
-                    ftp.retrbinary(f"RETR {remote_file}", file.write)
+                with self.ftp_pool.connection(host, username, password) as ftp:
+                    ftp_download(
+                        ftp, remote_file, local_file, self.pipeline.valves.FTP_BLOCK_SIZE, self.pipeline.valves.FTP_JOURNAL_DIR
+                    )
                 return f"Downloaded file '{remote_file}' to '{local_file}'"
             except ftplib.all_errors as e:
                 return f"Error downloading file: {str(e)}"
 
-        def connect_to_mariadb(self, host: str, user: str, password: str, database: str):
+        @tool_timeout(transfer_timeout)
+        def download_files_via_ftp(self, host: str, username: str, password: str, remote_files: List[str], local_dir: str) -> str:
+            """
+            Download several files via FTP at once. Prefer this over repeated download_file_via_ftp calls.
+            :param host: The hostname or IP address of the FTP server.
+            :param username: The username to use for the FTP connection.
+            :param password: The password to use for the FTP connection.
+            :param remote_files: The remote files to download.
+            :param local_dir: The local directory to save them to.
+            :return: A summary of the files downloaded and failed.
+            """
+            os.makedirs(local_dir, exist_ok=True)
+            pairs = [(os.path.join(local_dir, posixpath.basename(remote_file)), remote_file) for remote_file in remote_files]
+            summary = ftp_transfer_many(
+                self.ftp_pool,
+                host,
+                username,
+                password,
+                "download",
+                pairs,
+                self.pipeline.valves.FTP_TRANSFER_WORKERS,
+                self.pipeline.valves.FTP_BLOCK_SIZE,
+                self.pipeline.valves.FTP_JOURNAL_DIR,
+            )
+            return f"Downloaded files to '{local_dir}': {json.dumps(summary)}"
+
+        def connect_to_mariadb(self, host: str, user: str, password: str, database: str) -> str:
             """
             Connect to MariaDB.
             :param host: The host of the MariaDB server.
             :param user: The username to use for authentication.
             :param password: The password to use for authentication.
             :param database: The database to connect to.
+            :return: A success message, or which memory tables need migrating.
             """
-            self.mariadb_connection = MariaDBConnection(host, user, password, database)
+            if self.mariadb_connection is not None:
+                self.mariadb_connection.close_connection()
+            self.mariadb_connection = MariaDBConnection(
+                host,
+                user,
+                password,
+                database,
+                self.pipeline.valves.MARIADB_POOL_SIZE,
+                self.pipeline.valves.MARIADB_IDLE_TIMEOUT,
+                self.pipeline.valves.MARIADB_WRITE_BATCH_ROWS,
+                self.pipeline.valves.MARIADB_WRITE_BATCH_MS,
+            )
+            if self.pipeline.valves.MARIADB_ENSURE_SCHEMA:
+                for table in MEMORY_TABLES.values():
+                    self.mariadb_connection.ensure_schema(table(self.mariadb_connection).schema())
+
+            try:
+                outdated = check_memory_schema(self.mariadb_connection)
+            except mysql.connector.Error as e:
+                return f"Error connecting to MariaDB: {str(e)}"
+            if outdated:
+                tables = "; ".join(f"{table} lacks {', '.join(columns)}" for table, columns in outdated.items())
+                return (
+                    f"Connected to MariaDB database {database}, but its memory tables need migrating ({tables}). "
+                    "Run scripts/migrate_memory_schema.py before storing or retrieving memory."
+                )
+            return f"Connected to MariaDB database {database}"
 
         def authenticate_user(self, username: str, password: str) -> bool:
             """
@@ -333,73 +1016,155 @@ class Pipeline(FunctionCallingBlueprint):
             self.authenticator = Authenticator(self.mariadb_connection)
             return self.authenticator.authenticate_user(username, password)
 
-        def store_short_term_memory(self, data: str) -> bool:
+        def store_short_term_memory(self, data: str, session_id: str = None) -> bool:
             """
             Store data in short-term memory.
             :param data: The data to store.
+            :param session_id: The session the data belongs to.
             :return: True if the data is stored successfully.
             """
-            self.short_term_memory = ShortTermMemory(self.mariadb_connection)
-            return self.short_term_memory.store_data(data)
+            return ShortTermMemory(self.mariadb_connection).store_data(data, session_id)
 
-        def retrieve_short_term_memory(self) -> list:
+        def retrieve_short_term_memory(
+            self,
+            session_id: str = None,
+            since: str = None,
+            until: str = None,
+            limit: int = 20,
+            newest_first: bool = True,
+            after_id: int = None,
+        ) -> list:
             """
-            Retrieve data from short-term memory.
-            :return: The retrieved data.
+            Retrieve a page of data from short-term memory.
+            :param session_id: Only return rows stored for this session.
+            :param since: Only return rows stored at or after this time, as "YYYY-MM-DD HH:MM:SS".
+            :param until: Only return rows stored before this time, as "YYYY-MM-DD HH:MM:SS".
+            :param limit: The most rows to return.
+            :param newest_first: Whether to return the newest rows first.
+            :param after_id: For the next page, the id of the last row of the previous one.
+            :return: The rows, as (id, session_id, created_at, data).
             """
-            self.short_term_memory = ShortTermMemory(self.mariadb_connection)
-            return self.short_term_memory.retrieve_data()
+            return ShortTermMemory(self.mariadb_connection).page(
+                session_id, since, until, min(limit, self.pipeline.valves.MARIADB_MAX_PAGE_SIZE), newest_first, after_id
+            )
 
-        def store_long_term_memory(self, data: str) -> bool:
+        def store_long_term_memory(self, data: str, session_id: str = None) -> bool:
             """
             Store data in long-term memory.
             :param data: The data to store.
+            :param session_id: The session the data belongs to.
             :return: True if the data is stored successfully.
             """
-            self.long_term_memory = LongTermMemory(self.mariadb_connection)
-            return self.long_term_memory.store_data(data)
+            return LongTermMemory(self.mariadb_connection).store_data(data, session_id)
 
-        def retrieve_long_term_memory(self) -> list:
+        def retrieve_long_term_memory(
+            self,
+            session_id: str = None,
+            since: str = None,
+            until: str = None,
+            limit: int = 20,
+            newest_first: bool = True,
+            after_id: int = None,
+        ) -> list:
             """
-            Retrieve data from long-term memory.
-            :return: The retrieved data.
+            Retrieve a page of data from long-term memory.
+            :param session_id: Only return rows stored for this session.
+            :param since: Only return rows stored at or after this time, as "YYYY-MM-DD HH:MM:SS".
+            :param until: Only return rows stored before this time, as "YYYY-MM-DD HH:MM:SS".
+            :param limit: The most rows to return.
+            :param newest_first: Whether to return the newest rows first.
+            :param after_id: For the next page, the id of the last row of the previous one.
+            :return: The rows, as (id, session_id, created_at, data).
             """
-            self.long_term_memory = LongTermMemory(self.mariadb_connection)
-            return self.long_term_memory.retrieve_data()
+            return LongTermMemory(self.mariadb_connection).page(
+                session_id, since, until, min(limit, self.pipeline.valves.MARIADB_MAX_PAGE_SIZE), newest_first, after_id
+            )
 
-        def store_embedding(self, embedding: str) -> bool:
+        def store_embedding(self, embedding: str, session_id: str = None) -> bool:
             """
             Store an embedding.
             :param embedding: The embedding to store.
+            :param session_id: The session the embedding belongs to.
             :return: True if the embedding is stored successfully.
             """
-            self.embeddings = Embeddings(self.mariadb_connection)
-            return self.embeddings.store_embedding(embedding)
+            return Embeddings(self.mariadb_connection).store_embedding(embedding, session_id)
 
-        def retrieve_embedding(self) -> list:
+        def retrieve_embedding(
+            self,
+            session_id: str = None,
+            since: str = None,
+            until: str = None,
+            limit: int = 20,
+            newest_first: bool = True,
+            after_id: int = None,
+        ) -> list:
             """
-            Retrieve embeddings.
-            :return: The retrieved embeddings.
+            Retrieve a page of embeddings.
+            :param session_id: Only return rows stored for this session.
+            :param since: Only return rows stored at or after this time, as "YYYY-MM-DD HH:MM:SS".
+            :param until: Only return rows stored before this time, as "YYYY-MM-DD HH:MM:SS".
+            :param limit: The most rows to return.
+            :param newest_first: Whether to return the newest rows first.
+            :param after_id: For the next page, the id of the last row of the previous one.
+            :return: The rows, as (id, session_id, created_at, embedding).
             """
-            self.embeddings = Embeddings(self.mariadb_connection)
-            return self.embeddings.retrieve_embedding()
+            return Embeddings(self.mariadb_connection).page(
+                session_id, since, until, min(limit, self.pipeline.valves.MARIADB_MAX_PAGE_SIZE), newest_first, after_id
+            )
 
-        def store_rag(self, rag: str) -> bool:
+        def store_rag(self, rag: str, session_id: str = None) -> bool:
             """
             Store a RAG.
             :param rag: The RAG to store.
+            :param session_id: The session the RAG belongs to.
             :return: True if the RAG is stored successfully.
             """
-            self.rag = RAG(self.mariadb_connection)
-            return self.rag.store_rag(rag)
+            return RAG(self.mariadb_connection).store_rag(rag, session_id)
 
-        def retrieve_rag(self) -> list:
+        def retrieve_rag(
+            self,
+            session_id: str = None,
+            since: str = None,
+            until: str = None,
+            limit: int = 20,
+            newest_first: bool = True,
+            after_id: int = None,
+        ) -> list:
             """
-            Retrieve RAGs.
-            :return: The retrieved RAGs.
+            Retrieve a page of RAGs.
+            :param session_id: Only return rows stored for this session.
+            :param since: Only return rows stored at or after this time, as "YYYY-MM-DD HH:MM:SS".
+            :param until: Only return rows stored before this time, as "YYYY-MM-DD HH:MM:SS".
+            :param limit: The most rows to return.
+            :param newest_first: Whether to return the newest rows first.
+            :param after_id: For the next page, the id of the last row of the previous one.
+            :return: The rows, as (id, session_id, created_at, RAG).
             """
-            self.rag = RAG(self.mariadb_connection)
-            return self.rag.retrieve_rag()
+            return RAG(self.mariadb_connection).page(
+                session_id, since, until, min(limit, self.pipeline.valves.MARIADB_MAX_PAGE_SIZE), newest_first, after_id
+            )
+
+        @tool_timeout(export_timeout)
+        def export_memory(
+            self,
+            store: Literal["short_term_memory", "long_term_memory", "embeddings", "rag"],
+            path: str,
+            session_id: str = None,
+        ) -> str:
+            """
+            Export a memory store to a JSON Lines file, streaming it from the database.
+            :param store: The store to export.
+            :param path: The file to write.
+            :param session_id: Only export rows stored for this session.
+            :return: The number of rows exported.
+            """
+            count = 0
+            with open(path, "w") as file:
+                for row_id, row_session_id, created_at, value in MEMORY_TABLES[store](self.mariadb_connection).export(session_id):
+                    record = {"id": row_id, "session_id": row_session_id, "created_at": str(created_at), "value": value}
+                    file.write(json.dumps(record) + "\n")
+                    count += 1
+            return f"Exported {count} rows from {store} to '{path}'"
 
     def __init__(self):
         super().__init__()
@@ -408,6 +1173,93 @@ class Pipeline(FunctionCallingBlueprint):
             **{
                 **self.valves.model_dump(),
                 "pipelines": ["*"],  # Connect to all pipelines
+                "MARIADB_POOL_SIZE": int(os.getenv("MARIADB_POOL_SIZE", 5)),
+                "MARIADB_IDLE_TIMEOUT": int(os.getenv("MARIADB_IDLE_TIMEOUT", 300)),
+                "MARIADB_WRITE_BATCH_ROWS": int(os.getenv("MARIADB_WRITE_BATCH_ROWS", 0)),
+                "MARIADB_WRITE_BATCH_MS": int(os.getenv("MARIADB_WRITE_BATCH_MS", 200)),
+                "MARIADB_ENSURE_SCHEMA": os.getenv("MARIADB_ENSURE_SCHEMA", "false").lower() == "true",
+                "MARIADB_MAX_PAGE_SIZE": int(os.getenv("MARIADB_MAX_PAGE_SIZE", 500)),
+                "MARIADB_EXPORT_TIMEOUT": int(os.getenv("MARIADB_EXPORT_TIMEOUT", 600)),
+                "HTTP_CACHE_DIR": os.getenv(
+                    "HTTP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "http_cache")
+                ),
+                "HTTP_MAX_BYTES": int(os.getenv("HTTP_MAX_BYTES", 1048576)),
+                "HTTP_MAX_PER_HOST": int(os.getenv("HTTP_MAX_PER_HOST", 4)),
+                "HTTP_TIMEOUT": int(os.getenv("HTTP_TIMEOUT", 15)),
+                "FETCH_MAX_CHARS": int(os.getenv("FETCH_MAX_CHARS", 4000)),
+                "SSH_MAX_SESSIONS_PER_HOST": int(os.getenv("SSH_MAX_SESSIONS_PER_HOST", 4)),
+                "SSH_IDLE_TIMEOUT": int(os.getenv("SSH_IDLE_TIMEOUT", 300)),
+                "SSH_KEEPALIVE": int(os.getenv("SSH_KEEPALIVE", 30)),
+                "SSH_CONNECT_TIMEOUT": int(os.getenv("SSH_CONNECT_TIMEOUT", 15)),
+                "SSH_CHANNELS_PER_CONNECTION": int(os.getenv("SSH_CHANNELS_PER_CONNECTION", 8)),
+                "SSH_EXEC_TIMEOUT": int(os.getenv("SSH_EXEC_TIMEOUT", 60)),
+                "SSH_EXEC_MAX_BYTES": int(os.getenv("SSH_EXEC_MAX_BYTES", 65536)),
+                "SSH_FANOUT_PARALLELISM": int(os.getenv("SSH_FANOUT_PARALLELISM", 16)),
+                "SFTP_TRANSFER_WORKERS": int(os.getenv("SFTP_TRANSFER_WORKERS", 4)),
+                "SFTP_CHUNK_SIZE_MB": int(os.getenv("SFTP_CHUNK_SIZE_MB", 8)),
+                "SFTP_JOURNAL_DIR": os.getenv(
+                    "SFTP_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "sftp_journals")
+                ),
+                "FTP_MAX_CONNECTIONS_PER_HOST": int(os.getenv("FTP_MAX_CONNECTIONS_PER_HOST", 4)),
+                "FTP_IDLE_TIMEOUT": int(os.getenv("FTP_IDLE_TIMEOUT", 60)),
+                "FTP_BLOCK_SIZE": int(os.getenv("FTP_BLOCK_SIZE", 65536)),
+                "FTP_JOURNAL_DIR": os.getenv(
+                    "FTP_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "ftp_journals")
+                ),
+                "TRANSFER_TIMEOUT": int(os.getenv("TRANSFER_TIMEOUT", 600)),
+                "FTP_TRANSFER_WORKERS": int(os.getenv("FTP_TRANSFER_WORKERS", 4)),
             },
         )
         self.tools = self.Tools(self)
+
+    async def on_valves_updated(self):
+        await super().on_valves_updated()
+        # The fetcher and pools size themselves from the valves, so they are built again
+        self.tools.fetcher.close()
+        self.tools.fetcher = HTTPFetcher(
+            self.valves.HTTP_CACHE_DIR,
+            self.valves.HTTP_MAX_BYTES,
+            self.valves.HTTP_MAX_PER_HOST,
+            self.valves.HTTP_TIMEOUT,
+        )
+        self.tools.ssh_pool.close()
+        self.tools.ssh_pool = SSHConnectionPool(
+            self.valves.SSH_MAX_SESSIONS_PER_HOST,
+            self.valves.SSH_IDLE_TIMEOUT,
+            self.valves.SSH_KEEPALIVE,
+            self.valves.SSH_CHANNELS_PER_CONNECTION,
+            self.valves.SSH_CONNECT_TIMEOUT,
+        )
+        self.tools.ftp_pool.close()
+        self.tools.ftp_pool = FTPConnectionPool(
+            self.valves.FTP_MAX_CONNECTIONS_PER_HOST,
+            self.valves.FTP_IDLE_TIMEOUT,
+        )
+        connection = self.tools.mariadb_connection
+        if connection is not None:
+            # Flushes buffered writes before the pool is replaced
+            connection.close_connection()
+            self.tools.mariadb_connection = MariaDBConnection(
+                connection.host,
+                connection.user,
+                connection.password,
+                connection.pool.database,
+                self.valves.MARIADB_POOL_SIZE,
+                self.valves.MARIADB_IDLE_TIMEOUT,
+                self.valves.MARIADB_WRITE_BATCH_ROWS,
+                self.valves.MARIADB_WRITE_BATCH_MS,
+            )
+
+    async def on_shutdown(self):
+        await super().on_shutdown()
+        print(f"http_fetcher:{self.tools.fetcher.stats}")
+        print(f"ssh_pool:{self.tools.ssh_pool.stats}")
+        print(f"ftp_pool:{self.tools.ftp_pool.stats}")
+        self.tools.fetcher.close()
+        self.tools.ssh_pool.close()
+        self.tools.ftp_pool.close()
+        if self.tools.mariadb_connection is not None:
+            print(f"mariadb_pool:{self.tools.mariadb_connection.pool.stats}")
+            if self.tools.mariadb_connection.write_buffer is not None:
+                print(f"mariadb_write_buffer:{self.tools.mariadb_connection.write_buffer.stats}")
+            self.tools.mariadb_connection.close_connection()
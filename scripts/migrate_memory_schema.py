@@ -0,0 +1,52 @@
+"""
+title: MariaDB Memory Schema Migration
+description: Creates the memory tables used by mariadb_filter.py, or adds the id, session_id
+and created_at columns and the indexes that paging and retrieval rely on to existing tables.
+
+Run it once per database, at a quiet time: ALTER TABLE rewrites the table and can hold a lock
+on it while it does. Rows that exist before created_at is added all get the time of the ALTER
+as their created_at, not the time they were stored.
+
+    python scripts/migrate_memory_schema.py --host db --user memory --database memory --dry-run
+    MARIADB_PASSWORD=... python scripts/migrate_memory_schema.py --host db --user memory --database memory
+
+Run it from the pipelines server directory so that `schemas`, `utils` and `blueprints` import.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mariadb_filter import MEMORY_TABLES, MariaDBConnection
+
+
+def main(args):
+    tables = args.table or list(MEMORY_TABLES)
+    if args.dry_run:
+        for name in tables:
+            for statement in MEMORY_TABLES[name](None).schema():
+                print(f"{statement};")
+        return
+
+    connection = MariaDBConnection(args.host, args.user, args.password, args.database, pool_size=1)
+    try:
+        for name in tables:
+            start = time.monotonic()
+            print(f"Migrating {name}")
+            connection.ensure_schema(MEMORY_TABLES[name](connection).schema())
+            print(f"Migrated {name} in {time.monotonic() - start:.1f}s")
+    finally:
+        connection.close_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default=os.getenv("MARIADB_HOST", "localhost"))
+    parser.add_argument("--user", default=os.getenv("MARIADB_USER", ""))
+    parser.add_argument("--password", default=os.getenv("MARIADB_PASSWORD", ""))
+    parser.add_argument("--database", default=os.getenv("MARIADB_DATABASE", ""))
+    parser.add_argument("--table", action="append", choices=list(MEMORY_TABLES), help="Only migrate this table. Repeatable.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the statements instead of running them.")
+    main(parser.parse_args())